@@ -1,10 +1,16 @@
 from flask import Flask
 from flask_cors import CORS
 from flasgger import Swagger
+from uploads import UploadRequest, MAX_PACKAGE_SIZE, MAX_FORM_OVERHEAD
 
 app = Flask(__name__)
 CORS(app)
 
+# Uploaded tarballs are hashed and size checked while they are received, and
+# requests announcing a body larger than a package are refused before it is read.
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_PACKAGE_SIZE + MAX_FORM_OVERHEAD
+
 swagger = Swagger(
     app,
     template={
@@ -2,9 +2,9 @@ import os
 from dotenv import load_dotenv
 from flask import request, jsonify
 from datetime import datetime
-from uuid import uuid4
 from app import app
 from mongo import db
+from sessions import create_session, find_session, get_session_user, delete_session, delete_user_sessions, forget_session_users
 import hashlib
 from app import swagger
 import smtplib
@@ -31,14 +31,6 @@ except KeyError as err:
     print("Add SALT to .env file")
 
 
-def generate_uuid():
-    while True:
-        uuid = uuid4().hex
-        user = db.users.find_one({"uuid": uuid})
-        if not user:
-            return uuid
-
-
 @app.route("/auth/login", methods=["POST"])
 @swag_from("documentation/login.yaml", methods=["POST"])
 def login():
@@ -52,20 +44,13 @@ def login():
     if not user:
         return jsonify({"message": "Invalid email or password", "code": 401}), 401
 
-    uuid = generate_uuid() if user["loggedCount"] == 0 else user["uuid"]
+    # Every login opens a new session, so the user can be logged in on several devices.
+    uuid = create_session(user["_id"])
 
-    user["loggedCount"] += 1
+    db.users.update_one({"_id": user["_id"]}, {"$set": {"loginAt": datetime.utcnow()}})
 
-    db.users.update_one(
-        {"_id": user["_id"]},
-        {
-            "$set": {
-                "loginAt": datetime.utcnow(),
-                "uuid": uuid,
-                "loggedCount": user["loggedCount"],
-            }
-        },
-    )
+    # The other sessions of the user cached the login time they were opened with.
+    forget_session_users(user["_id"])
 
     return (
         jsonify(
@@ -83,13 +68,9 @@ def login():
 @app.route("/auth/signup", methods=["POST"])
 @swag_from("documentation/signup.yaml", methods=["POST"])
 def signup():
-    uuid = request.form.get("uuid")
     sudo_password = env_var["sudo_password"]
     salt = env_var["salt"]
 
-    if not uuid:
-        uuid = generate_uuid()
-
     username = request.form.get("username")
     email = request.form.get("email")
     email = email.lower()
@@ -119,8 +100,6 @@ def signup():
         "lastLogout": None,
         "loginAt": datetime.utcnow(),
         "createdAt": datetime.utcnow(),
-        "uuid": uuid,
-        "loggedCount": 1,
     }
 
     if hashed_password == sudo_hashed_password:
@@ -130,7 +109,8 @@ def signup():
         user["roles"] = ["user"]
 
     if not registry_user:
-        db.users.insert_one(user)
+        user_id = db.users.insert_one(user).inserted_id
+        uuid = create_session(user_id)
 
         return (
             jsonify(
@@ -162,24 +142,15 @@ def logout():
     if not uuid:
         return jsonify({"message": "User not found", "code": 404})
 
-    user = db.users.find_one({"uuid": uuid})
-    if not user:
+    session = find_session(uuid)
+    if not session:
         return jsonify({"message": "User not found", "code": 404})
 
-    user["loggedCount"] -= 1
+    # Only this session is closed, the other sessions of the user stay open.
+    delete_session(uuid)
 
-    uuid = "" if user["loggedCount"] == 0 else uuid
-
-    db.users.update_one(
-        {"_id": user["_id"]},
-        {
-            "$set": {
-                "lastLogout": datetime.utcnow(),
-                "uuid": uuid,
-                "loggedCount": user["loggedCount"],
-            }
-        },
-    )
+    db.users.update_one({"_id": session["user"]}, {"$set": {"lastLogout": datetime.utcnow()}})
+    forget_session_users(session["user"])
 
     return jsonify({"message": "Logout successful", "code": 200}), 200
 
@@ -190,7 +161,7 @@ def reset_password():
     password = request.form.get("password")
     oldpassword = request.form.get("oldpassword")
     uuid = request.form.get("uuid")
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
     salt = env_var["salt"]
 
     if not user:
@@ -204,10 +175,10 @@ def reset_password():
 
     password += salt
     hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    db.users.update_one(
-        {"uuid": uuid},
-        {"$set": {"password": hashed_password, "uuid": "", "loggedCount": 0}},
-    )
+    db.users.update_one({"_id": user["_id"]}, {"$set": {"password": hashed_password}})
+
+    # Changing the password logs the user out everywhere.
+    delete_user_sessions(user["_id"])
     return jsonify({"message": "Password reset successful", "code": 200}), 200
 
 
@@ -224,8 +195,8 @@ def forgot_password(*email):
     if not user:
         return jsonify({"message": "User not found", "code": 404}), 404
 
-    uuid = generate_uuid()
-    db.users.update_one({"email": email}, {"$set": {"uuid": uuid, "loggedCount": 1}})
+    # The reset link carries a new session, which is closed with the others on reset.
+    uuid = create_session(user["_id"])
 
     message = f"""\n
     Dear {user['username']},
@@ -0,0 +1,102 @@
+"""
+Benchmark of the package search query.
+
+Seeds a scratch database with generated packages and compares the latency of
+the previous unanchored `$regex` search against the `$text` search used by
+`GET /packages`.
+
+Usage:
+    python benchmark_search.py [number_of_packages] [number_of_queries]
+"""
+import math
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+from mongo import client, database_name, ensure_indexes
+from search import search_fields, text_query
+
+WORDS = [
+    "fortran", "stdlib", "lapack", "blas", "mpi", "json", "toml", "string",
+    "linear", "algebra", "solver", "ode", "fft", "random", "sparse", "matrix",
+    "parser", "test", "logger", "hdf5", "netcdf", "quadrature", "interp",
+    "geometry", "mesh", "cli", "regex", "hash", "sort", "stats",
+]
+
+
+def seed(database, number_of_packages):
+    database.packages.drop()
+    ensure_indexes(database)
+
+    packages = []
+    for i in range(number_of_packages):
+        words = random.sample(WORDS, 3)
+        name = "{}_{}{}".format(words[0], words[1], i)
+        description = "A Fortran library for {} and {}".format(words[1], words[2])
+        tags = ["fortran", words[2]]
+        packages.append(
+            {
+                "name": name,
+                "namespace": "benchmark",
+                "description": description,
+                "tags": tags,
+                "isDeprecated": False,
+                "updatedAt": datetime.utcnow(),
+                "search": search_fields(name, tags, description),
+            }
+        )
+    database.packages.insert_many(packages)
+
+
+def regex_query(query):
+    return {
+        "$and": [
+            {
+                "$or": [
+                    {"name": {"$regex": query}},
+                    {"tags": {"$in": [query]}},
+                    {"description": {"$regex": query}},
+                ]
+            },
+            {"isDeprecated": False},
+        ]
+    }
+
+
+def run(collection, queries, build_query, sort_order):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        list(collection.find(build_query(query)).sort(sort_order).limit(10))
+        collection.count_documents(build_query(query))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    # The nearest rank p99, the sample at rank ceil(0.99 * n).
+    p99 = timings[min(len(timings) - 1, math.ceil(len(timings) * 0.99) - 1)]
+    return statistics.median(timings), p99
+
+
+if __name__ == "__main__":
+    number_of_packages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    number_of_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    database = client["{}_benchmark".format(database_name)]
+    seed(database, number_of_packages)
+    queries = [random.choice(WORDS) for _ in range(number_of_queries)]
+
+    regex_p50, regex_p99 = run(
+        database.packages, queries, regex_query, [("name", -1)]
+    )
+    text_p50, text_p99 = run(
+        database.packages,
+        queries,
+        lambda query: {"$text": {"$search": text_query(query)}, "isDeprecated": False},
+        [("score", {"$meta": "textScore"})],
+    )
+
+    print("{} packages, {} queries".format(number_of_packages, number_of_queries))
+    print("$regex: p50 {:.2f} ms, p99 {:.2f} ms".format(regex_p50, regex_p99))
+    print("$text:  p50 {:.2f} ms, p99 {:.2f} ms".format(text_p50, text_p99))
+
+    client.drop_database(database)
@@ -0,0 +1,361 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from gridfs.errors import FileExists, NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app import app
+from mongo import db, file_storage
+
+
+def hash_file(file):
+    """
+    Function to compute the SHA-256 digest of a file, and rewind it.
+
+    Parameters:
+    file: The file object to be hashed.
+
+    Returns:
+    str: The hexadecimal digest of the file content.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(64 * 1024), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class GridFSBlobStore:
+    """
+    Stores tarballs in the `tarballs` GridFS bucket, with the digest as file id.
+
+    Downloads are streamed by the Flask worker.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def exists(self, digest):
+        return self.storage.exists(digest)
+
+    def put(self, tarball, digest, filename):
+        try:
+            self.storage.put(
+                tarball, _id=digest, content_type="application/gzip", filename=filename
+            )
+        except (FileExists, DuplicateKeyError):
+            # The same content was stored by a concurrent upload.
+            pass
+
+    def open(self, digest):
+        return self.storage.get(digest)
+
+    def delete(self, digest):
+        self.storage.delete(digest)
+
+    def accel_redirect(self, digest):
+        return None
+
+
+class LocalFile(io.FileIO):
+    """
+    Tarball opened from a LocalBlobStore, with the attributes of a GridFS file
+    used to serve it.
+    """
+
+    def __init__(self, path, filename):
+        super().__init__(path, "rb")
+        self.filename = filename
+        stat = os.fstat(self.fileno())
+        self.length = stat.st_size
+        self.upload_date = datetime.utcfromtimestamp(stat.st_mtime)
+
+
+class LocalBlobStore:
+    """
+    Stores tarballs as files named by their digest in a local directory.
+
+    When an internal nginx location serves the directory, downloads are handed over
+    to nginx with an X-Accel-Redirect header, so the Flask worker never reads them.
+
+    Parameters:
+    path (str): The directory of the tarballs.
+    accel_prefix (str): The internal nginx location serving the directory, if any.
+    """
+
+    def __init__(self, path, accel_prefix=None):
+        self.path = path
+        self.accel_prefix = accel_prefix.rstrip("/") if accel_prefix else None
+
+    def _relative_path(self, digest):
+        # Tarballs are spread over subdirectories named by the first two hex digits.
+        return os.path.join(digest[:2], digest)
+
+    def _path(self, digest):
+        return os.path.join(self.path, self._relative_path(digest))
+
+    def exists(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def put(self, tarball, digest, filename):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first and rename it, so a tarball is never
+        # served partially written.
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                shutil.copyfileobj(tarball, file)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def open(self, digest):
+        try:
+            return LocalFile(self._path(digest), "{}.tar.gz".format(digest))
+        except FileNotFoundError:
+            raise NoFile(digest)
+
+    def delete(self, digest):
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def accel_redirect(self, digest):
+        if not self.accel_prefix:
+            return None
+        return "{}/{}".format(self.accel_prefix, self._relative_path(digest).replace(os.sep, "/"))
+
+
+def create_blob_store():
+    """
+    Function to create the tarball store configured by the BLOB_STORE environment
+    variable: `gridfs` (the default) or `local`.
+
+    The local store keeps the tarballs in BLOB_STORE_PATH, and hands downloads over
+    to nginx if BLOB_STORE_ACCEL_PREFIX names the internal location serving it.
+
+    Returns:
+    The tarball store.
+    """
+    if os.getenv("BLOB_STORE", "gridfs") == "local":
+        return LocalBlobStore(
+            os.getenv("BLOB_STORE_PATH", "/var/lib/registry/tarballs"),
+            os.getenv("BLOB_STORE_ACCEL_PREFIX"),
+        )
+    return GridFSBlobStore(file_storage)
+
+
+blob_store = create_blob_store()
+
+# Uploads of content being deleted wait for the deletion, polling at this interval in seconds.
+DELETION_POLL_INTERVAL = 0.05
+
+# Deletions older than this, in seconds, were interrupted and are finished by the next upload.
+STALE_DELETION_TIMEOUT = 60
+
+
+def store_tarball(tarball, digest, filename):
+    """
+    Function to store a tarball by the SHA-256 digest of its content.
+
+    A tarball whose content is already stored is not written again, only the
+    reference count of the stored content is incremented. The blob is marked
+    as stored once its content is written, uploads of content not stored yet
+    write it too, so no version references content which was not written.
+
+    Parameters:
+    tarball: The file object of the tarball, positioned at its start.
+    digest (str): The hexadecimal SHA-256 digest of the tarball.
+    filename (str): The file name of the tarball.
+    """
+    while True:
+        # Most duplicate uploads end here, with a single write. Content being
+        # deleted by release_tarball is never referenced again.
+        if db.blobs.find_one_and_update(
+            {"_id": digest, "deleting": None, "stored": True}, {"$inc": {"refcount": 1}}
+        ):
+            return
+
+        try:
+            db.blobs.update_one(
+                {"_id": digest, "deleting": None},
+                {"$inc": {"refcount": 1}, "$setOnInsert": {"createdAt": datetime.utcnow()}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The content is being deleted, it is written again once the deletion is done.
+            finish_stale_deletion(digest)
+            time.sleep(DELETION_POLL_INTERVAL)
+            continue
+        break
+
+    # The reference is taken before the content is written, so that the content is
+    # not deleted by a concurrent release. The blob document only disappears after
+    # its content was deleted, so the content found here is not about to be deleted.
+    try:
+        if not blob_store.exists(digest):
+            blob_store.put(tarball, digest, filename)
+    except BaseException:
+        release_tarball(digest)
+        raise
+
+    db.blobs.update_one({"_id": digest}, {"$set": {"stored": True}})
+
+
+def release_tarball(digest):
+    """
+    Function to drop a reference to a stored tarball, deleting its content once
+    it is not referenced by any package version.
+
+    The blob document is marked as deleting before its content is deleted, and
+    removed afterwards, so store_tarball never reuses content about to be deleted.
+
+    Parameters:
+    digest (str): The hexadecimal SHA-256 digest of the tarball.
+    """
+    blob = db.blobs.find_one_and_update(
+        {"_id": digest}, {"$inc": {"refcount": -1}}, return_document=ReturnDocument.AFTER
+    )
+
+    if blob and blob["refcount"] <= 0:
+        # The blob is only deleted if no upload referenced it again in the meantime.
+        marked = db.blobs.update_one(
+            {"_id": digest, "refcount": {"$lte": 0}, "deleting": None},
+            {"$set": {"deleting": datetime.utcnow()}},
+        )
+        if marked.modified_count:
+            blob_store.delete(digest)
+            db.blobs.delete_one({"_id": digest, "deleting": {"$ne": None}})
+
+
+def finish_stale_deletion(digest):
+    # A deletion interrupted by a crash would block the uploads of the same content.
+    stale = datetime.utcnow() - timedelta(seconds=STALE_DELETION_TIMEOUT)
+    if db.blobs.find_one({"_id": digest, "deleting": {"$lt": stale}}):
+        blob_store.delete(digest)
+        db.blobs.delete_one({"_id": digest, "deleting": {"$lt": stale}})
+
+
+def open_tarball(digest):
+    """
+    Function to open a stored tarball.
+
+    Parameters:
+    digest (str): The hexadecimal SHA-256 digest of the tarball.
+
+    Returns:
+    The tarball file, with its filename, length and upload_date.
+
+    Raises:
+    NoFile: If no tarball is stored with this digest.
+    """
+    return blob_store.open(digest)
+
+
+def tarball_redirect(digest):
+    """
+    Function to get the internal nginx location serving a stored tarball.
+
+    Parameters:
+    digest (str): The hexadecimal SHA-256 digest of the tarball.
+
+    Returns:
+    str: The value of the X-Accel-Redirect header, or None if the tarball store
+    is not served by nginx.
+    """
+    return blob_store.accel_redirect(digest)
+
+
+def upload_chunk_key(upload_id, index):
+    # Chunks are stored under keys which can not be confused with a digest.
+    return "upload-{}-{}".format(upload_id, index)
+
+
+def store_upload_chunk(upload_id, index, chunk):
+    """
+    Function to store a chunk of a resumable upload, replacing a previous copy.
+
+    Parameters:
+    upload_id (ObjectId): The id of the upload session.
+    index (int): The number of the chunk.
+    chunk: The file object of the chunk, positioned at its start.
+    """
+    key = upload_chunk_key(upload_id, index)
+    blob_store.delete(key)
+    blob_store.put(chunk, key, key)
+
+
+def open_upload_chunk(upload_id, index):
+    """
+    Function to open a chunk of a resumable upload.
+
+    Parameters:
+    upload_id (ObjectId): The id of the upload session.
+    index (int): The number of the chunk.
+
+    Returns:
+    The chunk file.
+    """
+    return blob_store.open(upload_chunk_key(upload_id, index))
+
+
+def delete_upload_chunks(upload_id, indexes):
+    """
+    Function to delete the chunks of a resumable upload.
+
+    Parameters:
+    upload_id (ObjectId): The id of the upload session.
+    indexes (list): The numbers of the chunks.
+    """
+    for index in indexes:
+        blob_store.delete(upload_chunk_key(upload_id, index))
+
+
+@app.cli.command("migrate-tarballs")
+def migrate_tarballs():
+    """Copy the tarballs stored in GridFS to the configured tarball store."""
+    if isinstance(blob_store, GridFSBlobStore):
+        print("BLOB_STORE is gridfs, there is nothing to migrate.")
+        return
+
+    copied = 0
+    for file in file_storage.find():
+        if isinstance(file._id, ObjectId):
+            # Tarballs uploaded before content addressing are stored by their id.
+            # They are stored by their digest, and their versions updated to it.
+            digest = hash_file(file)
+            download_url = "/tarballs/{}".format(file._id)
+            package = db.packages.find_one(
+                {"versions.download_url": download_url},
+                {"versions": {"$elemMatch": {"download_url": download_url}}},
+            )
+            # Skip the tarballs of deleted versions, and the ones already migrated.
+            if not package or package["versions"][0].get("digest"):
+                continue
+            if not blob_store.exists(digest):
+                blob_store.put(file, digest, file.filename)
+                copied += 1
+            db.blobs.update_one(
+                {"_id": digest},
+                {"$inc": {"refcount": 1}, "$set": {"stored": True}, "$setOnInsert": {"createdAt": file.upload_date}},
+                upsert=True,
+            )
+            db.packages.update_one(
+                {"_id": package["_id"], "versions.download_url": download_url},
+                {"$set": {"versions.$.digest": digest}},
+            )
+        elif not file._id.startswith("upload-") and not blob_store.exists(file._id):
+            blob_store.put(file, file._id, file.filename)
+            copied += 1
+
+    print("Copied {} tarballs.".format(copied))
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries expire after a fixed time to live.
+
+    The cache is local to a server process, so writes made by other processes
+    are only picked up once the entries expire. The time to live is therefore
+    the upper bound on how stale a cached value can be.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Function to get a value from the cache.
+
+        Parameters:
+        key: The key of the value.
+
+        Returns:
+        The cached value, or None if the key is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Function to store a value in the cache, evicting the least recently used
+        entry when the cache is full.
+
+        Parameters:
+        key: The key of the value.
+        value: The value to be cached.
+
+        Returns:
+        list: The keys of the evicted entries.
+        """
+        evicted = []
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                evicted.append(self._entries.popitem(last=False)[0])
+                self.evictions += 1
+        return evicted
+
+    def delete(self, key):
+        """
+        Function to remove a value from the cache.
+
+        Parameters:
+        key: The key of the value.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Function to remove every value from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Function to get the counters of the cache for monitoring.
+
+        Returns:
+        dict: The size, capacity, hits, misses and evictions of the cache.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,75 @@
+from app import app
+from mongo import db
+
+
+def add_dependents(package_id, namespace_name, package_name, version, dependencies):
+    """
+    Function to record a package version as a dependent of the registry packages
+    it depends on.
+
+    The reverse dependencies hold one document per dependency and dependent
+    package, listing the versions of the dependent package requiring the dependency.
+
+    Parameters:
+    package_id (ObjectId): The id of the dependent package.
+    namespace_name (str): The namespace of the dependent package.
+    package_name (str): The name of the dependent package.
+    version (str): The version of the dependent package.
+    dependencies (list): The dependencies of the version, as stored on the version.
+    """
+    for dependency in dependencies if isinstance(dependencies, list) else []:
+        # Git and path dependencies are not registry packages.
+        if not dependency.get("namespace") or dependency.get("git") or dependency.get("path"):
+            continue
+
+        db.reverse_dependencies.update_one(
+            {
+                "dependency_namespace": dependency["namespace"],
+                "dependency_name": dependency["name"],
+                "package": package_id,
+            },
+            {
+                "$set": {"namespace": namespace_name, "name": package_name},
+                "$push": {"versions": {"version": version, "requirement": dependency.get("requirement")}},
+            },
+            upsert=True,
+        )
+
+
+def remove_dependents(package_id, version=None):
+    """
+    Function to remove a package, or one of its versions, from the reverse dependencies.
+
+    Parameters:
+    package_id (ObjectId): The id of the deleted package.
+    version (str): The deleted version, or None if the package was deleted.
+    """
+    if version is None:
+        db.reverse_dependencies.delete_many({"package": package_id})
+        return
+
+    db.reverse_dependencies.update_many(
+        {"package": package_id, "versions.version": version},
+        {"$pull": {"versions": {"version": version}}},
+    )
+    db.reverse_dependencies.delete_many({"package": package_id, "versions": {"$size": 0}})
+
+
+@app.cli.command("index-dependents")
+def index_dependents():
+    """Rebuild the reverse dependencies from the dependencies of every package version."""
+    db.reverse_dependencies.delete_many({})
+
+    namespace_names = {
+        namespace["_id"]: namespace["namespace"] for namespace in db.namespaces.find({}, {"namespace": 1})
+    }
+    packages = db.packages.find({}, {"name": 1, "namespace": 1, "versions.version": 1, "versions.dependencies": 1})
+    for package in packages:
+        for version in package.get("versions", []):
+            add_dependents(
+                package["_id"],
+                namespace_names.get(package["namespace"]),
+                package["name"],
+                version["version"],
+                version.get("dependencies"),
+            )
@@ -0,0 +1,318 @@
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from app import app
+from mongo import db
+
+# Daily download buckets older than this are compacted into monthly buckets.
+STATS_RETENTION_DAYS = int(os.getenv("DOWNLOAD_STATS_RETENTION_DAYS", 90))
+
+# Daily buckets are compacted by batches of this size.
+COMPACTION_BATCH_SIZE = int(os.getenv("DOWNLOAD_STATS_COMPACTION_BATCH_SIZE", 1000))
+
+# The flush thread compacts for at most this number of seconds between two flushes,
+# and carries on after the next flush until the compaction is done.
+COMPACTION_TIME_BUDGET = float(os.getenv("DOWNLOAD_STATS_COMPACTION_TIME_BUDGET", 1))
+
+# Batches claimed longer ago than this, in seconds, were interrupted and are claimed again.
+STALE_COMPACTION_TIMEOUT = 10 * 60
+
+
+def day_bucket(date):
+    return datetime(date.year, date.month, date.day)
+
+
+def month_bucket(date):
+    return datetime(date.year, date.month, 1)
+
+
+def week_bucket(date):
+    return day_bucket(date) - timedelta(days=date.weekday())
+
+
+class DownloadCounter:
+    """
+    Buffers tarball downloads in memory and writes them to the database in batches,
+    so that serving a download never waits on a database write.
+
+    Buffered counts are flushed every `interval` seconds by a background thread,
+    and when the process exits. A flush increments the download counts of the
+    versions and packages, and the daily buckets of the download statistics.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._compacted_on = None
+
+    def record(self, download_url):
+        """
+        Function to count a download of a package version.
+
+        Parameters:
+        download_url (str): The download url of the version.
+        """
+        with self._lock:
+            self._pending[(download_url, day_bucket(datetime.utcnow()))] += 1
+
+            # The flush thread is started on first use rather than at import time.
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def pending(self):
+        """
+        Function to get the number of downloads not yet written to the database.
+
+        Returns:
+        int: The number of buffered downloads.
+        """
+        with self._lock:
+            return sum(self._pending.values())
+
+    def flush(self):
+        """
+        Function to write the buffered downloads to the database.
+
+        The download counts of both the version and its package are incremented
+        with one bulk write, and the daily statistics buckets with another.
+        Counts that fail to be written to the packages are put back in the buffer
+        for the next flush. A failed statistics write is only logged, since
+        retrying it would count the downloads twice in the packages.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+
+        if not pending:
+            return
+
+        counts = Counter()
+        for (download_url, _), count in pending.items():
+            counts[download_url] += count
+        download_urls = list(counts)
+
+        try:
+            # Find the package and version of every downloaded url with one query.
+            versions = {
+                version["download_url"]: version
+                for version in db.packages.aggregate([
+                    {"$match": {"versions.download_url": {"$in": download_urls}}},
+                    {"$unwind": "$versions"},
+                    {"$match": {"versions.download_url": {"$in": download_urls}}},
+                    {
+                        "$project": {
+                            "version": "$versions.version",
+                            "download_url": "$versions.download_url",
+                        }
+                    },
+                ])
+            }
+            db.packages.bulk_write(
+                [
+                    UpdateOne(
+                        {"versions.download_url": download_url},
+                        {"$inc": {"downloads": count, "versions.$.downloads": count}},
+                    )
+                    for download_url, count in counts.items()
+                ],
+                ordered=False,
+            )
+        except BulkWriteError as err:
+            # Only the failed operations are retried, the others were applied.
+            print("Failed to flush download counts: {}".format(err))
+            failed_urls = {download_urls[error["index"]] for error in err.details["writeErrors"]}
+            with self._lock:
+                for key, count in pending.items():
+                    if key[0] in failed_urls:
+                        self._pending[key] += count
+            return
+        except PyMongoError as err:
+            print("Failed to flush download counts: {}".format(err))
+            with self._lock:
+                self._pending.update(pending)
+            return
+
+        # Each download counts towards the bucket of its version, and the bucket of
+        # all the versions of its package, which has a null version.
+        buckets = Counter()
+        for (download_url, day), count in pending.items():
+            version = versions.get(download_url)
+            if version:
+                buckets[(version["_id"], version["version"], day)] += count
+                buckets[(version["_id"], None, day)] += count
+
+        try:
+            if buckets:
+                db.download_stats.bulk_write(
+                    [
+                        UpdateOne(
+                            {"package": package_id, "version": version, "granularity": "day", "bucket": day},
+                            {"$inc": {"count": count}},
+                            upsert=True,
+                        )
+                        for (package_id, version, day), count in buckets.items()
+                    ],
+                    ordered=False,
+                )
+        except PyMongoError as err:
+            print("Failed to flush download statistics: {}".format(err))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+            # Compact the statistics once a day, a batch at a time so that the
+            # downloads are still flushed every interval.
+            today = day_bucket(datetime.utcnow())
+            if self._compacted_on != today:
+                try:
+                    if compact_download_stats(time_budget=COMPACTION_TIME_BUDGET):
+                        self._compacted_on = today
+                except PyMongoError as err:
+                    print("Failed to compact download statistics: {}".format(err))
+
+
+def compact_download_stats(now=None, time_budget=None):
+    """
+    Function to merge the daily download buckets older than the retention window
+    into monthly buckets.
+
+    Parameters:
+    now (datetime): The current time, defaults to datetime.utcnow().
+    time_budget (float): The number of seconds after which no batch is started, no limit if None.
+
+    Returns:
+    bool: True if every expired daily bucket was compacted, False if the time budget ran out.
+    """
+    cutoff = day_bucket(now or datetime.utcnow()) - timedelta(days=STATS_RETENTION_DAYS)
+    started = time.monotonic()
+
+    while time_budget is None or time.monotonic() - started < time_budget:
+        if not compact_download_stats_batch(cutoff):
+            return True
+    return False
+
+
+def compact_download_stats_batch(cutoff):
+    """
+    Function to merge a batch of expired daily download buckets into monthly buckets.
+
+    Every server process compacts the statistics, so the daily buckets are first
+    claimed with an id of the compaction. A bucket is then counted by the one
+    process whose claim it holds, even when compactions overlap. A claim older
+    than STALE_COMPACTION_TIMEOUT was interrupted and is taken over.
+
+    Parameters:
+    cutoff (datetime): The daily buckets before this day are compacted.
+
+    Returns:
+    bool: False once there are no expired daily buckets left to claim.
+    """
+    claim = ObjectId()
+    stale = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=STALE_COMPACTION_TIMEOUT))
+    expired = {
+        "granularity": "day",
+        "bucket": {"$lt": cutoff},
+        "$or": [{"compaction": None}, {"compaction": {"$lt": stale}}],
+    }
+
+    ids = [bucket["_id"] for bucket in db.download_stats.find(expired, {"_id": 1}).limit(COMPACTION_BATCH_SIZE)]
+    if not ids:
+        return False
+
+    db.download_stats.update_many({**expired, "_id": {"$in": ids}}, {"$set": {"compaction": claim}})
+    claimed = {"_id": {"$in": ids}, "compaction": claim}
+
+    # The claimed buckets are summed per month in the database.
+    months = db.download_stats.aggregate([
+        {"$match": claimed},
+        {
+            "$group": {
+                "_id": {
+                    "package": "$package",
+                    "version": "$version",
+                    "year": {"$year": "$bucket"},
+                    "month": {"$month": "$bucket"},
+                },
+                "count": {"$sum": "$count"},
+            }
+        },
+    ])
+
+    updates = []
+    for month in months:
+        updates.append(
+            UpdateOne(
+                {
+                    "package": month["_id"]["package"],
+                    "version": month["_id"]["version"],
+                    "granularity": "month",
+                    "bucket": datetime(month["_id"]["year"], month["_id"]["month"], 1),
+                },
+                {"$inc": {"count": month["count"]}},
+                upsert=True,
+            )
+        )
+
+    if updates:
+        db.download_stats.bulk_write(updates, ordered=False)
+    db.download_stats.delete_many(claimed)
+
+    # Buckets claimed by another compaction in the meantime are left to it.
+    return True
+
+
+def download_series(package_id, version, interval, since):
+    """
+    Function to get the number of downloads of a package per day, week or month.
+
+    The series is built from the statistics buckets only. Monthly buckets are used
+    for the periods whose daily buckets were compacted.
+
+    Parameters:
+    package_id (ObjectId): The id of the package.
+    version (str): The version, or None for all the versions of the package.
+    interval (str): The interval of the series: day, week or month.
+    since (datetime): The start of the series.
+
+    Returns:
+    list: The start of each interval with its number of downloads, oldest first.
+    """
+    truncate = {"day": day_bucket, "week": week_bucket, "month": month_bucket}[interval]
+
+    buckets = db.download_stats.find(
+        {"package": package_id, "version": version, "bucket": {"$gte": month_bucket(since)}}
+    )
+
+    series = Counter()
+    for bucket in buckets:
+        # Compacted months can not be split into days or weeks.
+        if bucket["granularity"] == "month" and interval != "month":
+            continue
+        if bucket["granularity"] == "day" and bucket["bucket"] < since:
+            continue
+        series[truncate(bucket["bucket"])] += bucket["count"]
+
+    return [
+        {"date": start.strftime("%Y-%m-%d"), "downloads": series[start]}
+        for start in sorted(series)
+    ]
+
+
+download_counter = DownloadCounter(interval=float(os.getenv("DOWNLOAD_FLUSH_INTERVAL", 10)))
+atexit.register(download_counter.flush)
+
+
+@app.cli.command("compact-download-stats")
+def compact_download_stats_command():
+    """Merge the expired daily download statistics into monthly buckets."""
+    compact_download_stats()
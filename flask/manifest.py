@@ -0,0 +1,121 @@
+import tarfile
+import zlib
+
+try:
+    import tomllib
+except ImportError:
+    # tomllib is part of the standard library since Python 3.11.
+    import tomli as tomllib
+
+# Manifests larger than this are not read, in bytes.
+MAX_MANIFEST_SIZE = 1024 * 1024
+
+
+def find_manifest(tarball):
+    """
+    Function to read the `fpm.toml` file of a package tarball.
+
+    The tarball is read as a stream, in a single pass and without extracting it,
+    up to the manifest. The manifest may be at the root of the tarball or in its
+    top level directory.
+
+    Parameters:
+    tarball: The file object of the tarball, positioned at its start.
+
+    Returns:
+    bytes: The content of the manifest, or None if the tarball has no manifest or
+    is not a tar archive.
+    """
+    try:
+        with tarfile.open(fileobj=tarball, mode="r|*") as archive:
+            for member in archive:
+                parts = [part for part in member.name.split("/") if part not in ("", ".")]
+                if not member.isfile() or len(parts) > 2 or parts[-1] != "fpm.toml":
+                    continue
+                if member.size > MAX_MANIFEST_SIZE:
+                    return None
+                return archive.extractfile(member).read()
+    except (tarfile.TarError, EOFError, OSError, zlib.error):
+        return None
+
+    return None
+
+
+def normalize_dependencies(dependencies):
+    """
+    Function to normalize the dependency table of a manifest.
+
+    A dependency is either a version requirement of a registry package
+    (`stdlib = "*"` or `stdlib = { namespace = "fortran-lang", v = "^0.2" }`),
+    a git repository or a local path.
+
+    Parameters:
+    dependencies (dict): The dependency table.
+
+    Returns:
+    list: The dependencies, sorted by name.
+    """
+    normalized = []
+    for name, spec in sorted((dependencies or {}).items()):
+        if isinstance(spec, str):
+            spec = {"v": spec}
+        if not isinstance(spec, dict):
+            continue
+
+        normalized.append(
+            {
+                "name": name,
+                "namespace": spec.get("namespace"),
+                "requirement": spec.get("v") if not ("git" in spec or "path" in spec) else None,
+                "git": spec.get("git"),
+                "ref": spec.get("tag") or spec.get("branch") or spec.get("rev"),
+                "path": spec.get("path"),
+            }
+        )
+    return normalized
+
+
+def string_list(value):
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list):
+        return [item for item in value if isinstance(item, str)]
+    return []
+
+
+def read_manifest(tarball):
+    """
+    Function to extract the metadata of a package from the manifest of its tarball.
+
+    The tarball is rewound afterwards.
+
+    Parameters:
+    tarball: The file object of the tarball, positioned at its start.
+
+    Returns:
+    dict: The normalized metadata, or None if the tarball has no valid manifest.
+    """
+    content = find_manifest(tarball)
+    tarball.seek(0)
+
+    if content is None:
+        return None
+
+    try:
+        manifest = tomllib.loads(content.decode("utf-8"))
+    except (UnicodeDecodeError, tomllib.TOMLDecodeError):
+        return None
+
+    return {
+        "name": manifest.get("name"),
+        "version": manifest.get("version"),
+        "license": manifest.get("license"),
+        "description": manifest.get("description") if isinstance(manifest.get("description"), str) else None,
+        "author": string_list(manifest.get("author")),
+        "maintainer": string_list(manifest.get("maintainer")),
+        "copyright": manifest.get("copyright") if isinstance(manifest.get("copyright"), str) else None,
+        "homepage": manifest.get("homepage") if isinstance(manifest.get("homepage"), str) else None,
+        "keywords": string_list(manifest.get("keywords")),
+        "dependencies": normalize_dependencies(manifest.get("dependencies")),
+        "dev_dependencies": normalize_dependencies(manifest.get("dev-dependencies")),
+    }
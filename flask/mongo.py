@@ -1,16 +1,173 @@
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, TEXT
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 from gridfs import GridFS
 from app import app
+from query_plans import CHECK_QUERY_PLANS, query_plan_recorder
 
 load_dotenv()
 database_name = os.environ['MONGO_DB_NAME']
 try:
     mongo_uri = os.environ['MONGO_URI']
-    client = MongoClient(mongo_uri)
+    client = MongoClient(mongo_uri, event_listeners=[query_plan_recorder] if CHECK_QUERY_PLANS else [])
 except KeyError as err:
     print("Add MONGO_URI to .env file")
 
 db = client[database_name]
 file_storage = GridFS(db, collection="tarballs")
+
+
+# Indexes of every collection, as (keys, options) pairs. Every query made by
+# the registry routes must be served by one of them, see query_plans.py.
+INDEXES = {
+    "packages": [
+        # Weighted full-text index for package search, see search.py.
+        # The indexed fields are already tokenized and stemmed by the registry,
+        # so MongoDB's own language specific stemming is disabled.
+        (
+            [("search.name", TEXT), ("search.tags", TEXT), ("search.description", TEXT)],
+            {
+                "name": "package_search",
+                "weights": {"search.name": 10, "search.tags": 5, "search.description": 1},
+                "default_language": "none",
+            },
+        ),
+        # The unique index on the package names is in UPGRADE_INDEXES. Versions are
+        # unique in their package through the filter of the update adding them, since
+        # a unique index does not prevent duplicates inside the array of a single document.
+        ([("namespace", 1), ("name", 1), ("versions.version", 1)], {}),
+        # Download counts are written to the version matching a download url.
+        ([("versions.download_url", 1)], {}),
+        # The packages of a user profile.
+        ([("author", 1)], {}),
+        ([("maintainers", 1)], {}),
+    ],
+    "namespaces": [
+        ([("namespace", 1)], {}),
+        # The namespaces of a user profile.
+        ([("author", 1)], {}),
+        ([("maintainers", 1)], {}),
+        ([("admins", 1)], {}),
+    ],
+    "users": [
+        ([("username", 1)], {}),
+        ([("email", 1)], {}),
+    ],
+    # Download statistics buckets, see downloads.py.
+    "download_stats": [
+        ([("package", 1), ("version", 1), ("granularity", 1), ("bucket", 1)], {"unique": True}),
+        ([("granularity", 1), ("bucket", 1)], {}),
+    ],
+    # Expired upload sessions are looked up to delete their chunks, see upload_sessions.py.
+    "upload_sessions": [
+        ([("expiresAt", 1)], {}),
+    ],
+    # Validation jobs are claimed oldest first, see validate_package.py.
+    "validation_jobs": [
+        ([("status", 1), ("createdAt", 1)], {}),
+        ([("package", 1), ("version", 1)], {}),
+        ([("digest", 1), ("status", 1)], {}),
+    ],
+    "validation_results": [
+        ([("digest", 1), ("toolchain", 1)], {"unique": True}),
+    ],
+    # Sessions are looked up by the hash of their token, which is their _id, and
+    # deleted once expired. All the sessions of a user are closed on password reset.
+    "sessions": [
+        ([("expiresAt", 1)], {"expireAfterSeconds": 0}),
+        ([("user", 1)], {}),
+    ],
+    # Upload tokens are looked up by their hash, which is their _id, and deleted
+    # once expired. Tokens without an expiry date are not deleted.
+    "upload_tokens": [
+        ([("expiresAt", 1)], {"expireAfterSeconds": 0}),
+        ([("namespace", 1)], {}),
+    ],
+    # Dependents of a package are listed by package id, see dependents.py.
+    "reverse_dependencies": [
+        ([("dependency_namespace", 1), ("dependency_name", 1), ("package", 1)], {"unique": True}),
+        ([("package", 1)], {}),
+    ],
+}
+
+
+# Unique indexes on collections which may hold duplicates written by earlier versions.
+# They are only created by `flask ensure-indexes`, which reports the duplicates that
+# prevent their creation, so that the server still starts with such a database.
+UPGRADE_INDEXES = {
+    "packages": [
+        # A package name is unique in its namespace, which makes concurrent first
+        # uploads of a package add their versions to the same document.
+        ([("namespace", 1), ("name", 1)], {"unique": True}),
+    ],
+}
+
+
+def ensure_indexes(database=db, upgrade=False):
+    """
+    Function to create the indexes of INDEXES.
+
+    Index creation is idempotent, so this is safe to call on every startup.
+
+    Parameters:
+    database: The database in which the indexes are created.
+    upgrade (bool): Whether the indexes of UPGRADE_INDEXES are created too.
+
+    Raises:
+    DuplicateKeyError: If a unique index of UPGRADE_INDEXES can not be created
+    because of duplicates.
+    """
+    for manifest in (INDEXES, UPGRADE_INDEXES) if upgrade else (INDEXES,):
+        for collection, indexes in manifest.items():
+            for keys, options in indexes:
+                database[collection].create_index(keys, **options)
+
+
+def missing_indexes(database=db):
+    """
+    Function to list the indexes of INDEXES and UPGRADE_INDEXES which do not exist in a database.
+
+    Parameters:
+    database: The database to compare with INDEXES.
+
+    Returns:
+    list: The collection and keys of every missing index.
+    """
+    missing = []
+    for collection, indexes in [*INDEXES.items(), *UPGRADE_INDEXES.items()]:
+        existing = [list(index["key"].items()) for index in database[collection].list_indexes()]
+        for keys, options in indexes:
+            # Text indexes are listed by their internal keys, so they are compared by name.
+            if options.get("name"):
+                found = options["name"] in database[collection].index_information()
+            else:
+                found = [(field, direction) for field, direction in keys] in existing
+            if not found:
+                missing.append((collection, keys))
+    return missing
+
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create the missing indexes, and list the ones which were missing."""
+    for collection, keys in missing_indexes():
+        print("Creating index {} on {}.".format(keys, collection))
+    ensure_indexes()
+
+    # The unique indexes are created one by one, to report all the duplicates at once.
+    for collection, indexes in UPGRADE_INDEXES.items():
+        for keys, options in indexes:
+            try:
+                db[collection].create_index(keys, **options)
+            except DuplicateKeyError:
+                print("Index {} on {} can not be created, these documents are duplicates:".format(keys, collection))
+                duplicates = db[collection].aggregate([
+                    {"$group": {"_id": {field: "$" + field for field, _ in keys}, "ids": {"$push": "$_id"}}},
+                    {"$match": {"ids.1": {"$exists": True}}},
+                ])
+                for duplicate in duplicates:
+                    print("  {}: {}".format(duplicate["_id"], ", ".join(str(_id) for _id in duplicate["ids"])))
+
+
+ensure_indexes()
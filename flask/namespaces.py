@@ -7,7 +7,9 @@ from flasgger.utils import swag_from
 from packages import checkUserUnauthorized
 
 from datetime import datetime
-from auth import generate_uuid
+from search import index_namespace, unindex_namespace
+from sessions import get_session_user
+from upload_tokens import issue_upload_token, UPLOAD_TOKEN_TTL_DAYS
 
 # Regular expression pattern for namespace name validation.
 NAMESPACE_NAME_PATTERN = r'^[a-zA-Z0-9_-]+$'
@@ -21,7 +23,7 @@ def create_namespace():
         return jsonify({"code": 401, "message": "Unauthorized"}), 401
     
     # Get the user document from the uuid.
-    user_doc = db.users.find_one({"uuid": uuid})
+    user_doc = get_session_user(uuid)
 
     if not user_doc:
         return jsonify({"code":  401, "message": "Unauthorized"}), 401
@@ -57,6 +59,7 @@ def create_namespace():
     }
 
     db.namespaces.insert_one(namespace_obj)
+    index_namespace(namespace_name)
 
     return jsonify({"code": 200, "message": "Namespace created successfully"}), 200
 
@@ -67,7 +70,7 @@ def create_upload_token(namespace_name):
     if not uuid:
         return jsonify({"code": 401, "message": "Unauthorized"}), 401
     
-    user_doc = db.users.find_one({"uuid": uuid})
+    user_doc = get_session_user(uuid)
 
     if not user_doc:
         return jsonify({"code": 401, "message": "Unauthorized"}), 401
@@ -82,19 +85,16 @@ def create_upload_token(namespace_name):
     if checkUserUnauthorized(user_id=user_doc["_id"], package_namespace=namespace_doc):
         return jsonify({"code": 401, "message": "Unauthorized"}), 401
     
-    # Generate an upload token for upload packages to the namespace.
-    upload_token = generate_uuid()
-    
-    upload_token_obj = {
-        "token": upload_token,
-        "createdAt": datetime.utcnow(),
-        "createdBy": user_doc["_id"]
-    }
+    # The token may be limited to some packages of the namespace, and to a validity in days.
+    packages = [name.strip() for name in request.form.get("packages", "").split(",") if name.strip()]
+    expires_in_days = request.form.get("expires_in_days", str(UPLOAD_TOKEN_TTL_DAYS))
+    expires_in_days = int(expires_in_days) if expires_in_days.isdigit() else 0
 
-    db.namespaces.update_one(
-        {"namespace": namespace_name},
-        {"$addToSet": {"upload_tokens": upload_token_obj}}
-    )
+    if not 0 < expires_in_days <= UPLOAD_TOKEN_TTL_DAYS:
+        return jsonify({"code": 400, "message": "Token validity should be between 1 and {} days".format(UPLOAD_TOKEN_TTL_DAYS)}), 400
+
+    # Generate an upload token for upload packages to the namespace.
+    upload_token = issue_upload_token(namespace_doc["_id"], user_doc["_id"], packages, expires_in_days)
 
     return jsonify({"code": 200, "message": "Upload token created", "uploadToken": upload_token})
 
@@ -105,7 +105,10 @@ def delete_namespace(namespace_name):
     if not uuid:
         return jsonify({"code": 401, "message": "Unauthorized"}), 401
 
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
+
+    if not user:
+        return jsonify({"code": 401, "message": "Unauthorized"}), 401
 
     # Check if the user is authorized to delete the package.
     if not "admin" in user["roles"]:
@@ -129,6 +132,8 @@ def delete_namespace(namespace_name):
     namespace_deleted = db.namespaces.delete_one({"namespace": namespace["_id"]})
 
     if namespace_deleted.deleted_count > 0:
+        db.upload_tokens.delete_many({"namespace": namespace["_id"]})
+        unindex_namespace(namespace_name)
         return jsonify({"message": "Namespace deleted successfully","code":200}), 200
     else:
         return jsonify({"message": "Internal Server Error", "code": 500}),200
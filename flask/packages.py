@@ -1,18 +1,35 @@
+import os
 from app import app
 from mongo import db
 from mongo import file_storage
 from bson.objectid import ObjectId
-from flask import request, jsonify, abort, send_file
+from bson import json_util
+from flask import request, jsonify, abort, Response
+from werkzeug.wsgi import wrap_file
+from bson.errors import InvalidId
 from gridfs.errors import NoFile
-from datetime import datetime
-from auth import generate_uuid
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
+from sessions import get_session_user
 from app import swagger
 from flasgger.utils import swag_from
 from urllib.parse import unquote
 import math
+import base64
+import binascii
 import semantic_version
 from license_expression import get_spdx_licensing
-# from validate_package import validate_package
+from search import search_fields, text_query, all_terms_query, suggest, fuzzy_search, index_package, unindex_package
+from cache import TTLCache
+from downloads import download_counter, download_series
+from uploads import HashingSpooledFile
+from manifest import read_manifest
+from resolve import parse_requirement, resolve_dependencies, resolution_cache
+from dependents import add_dependents, remove_dependents
+from versions import version_sort_key, refresh_latest_version, requirement_query
+from upload_tokens import find_upload_token, token_allows
+from blobs import hash_file, store_tarball, release_tarball, open_tarball, tarball_redirect
+from validate_package import enqueue_validation
 
 parameters = {
     "name": "name",
@@ -22,6 +39,23 @@ parameters = {
     "downloads": "downloads",
 }
 
+# Search responses cached per server process. Entries are dropped on every package
+# write made by this process, and expire after SEARCH_CACHE_TTL seconds so that
+# writes made by other processes are visible within that time.
+search_cache = TTLCache(
+    maxsize=int(os.getenv("SEARCH_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", 60)),
+)
+
+def invalidate_search_cache():
+    """
+    Function to drop the cached search responses after a package is created, updated or deleted.
+    """
+    search_cache.clear()
+
+# Published tarballs never change, so they can be cached for a year.
+TARBALL_MAX_AGE = 365 * 24 * 60 * 60
+
 def is_valid_version_str(version_str):
     """
     Function to verify whether the version string is valid or not.
@@ -56,6 +90,121 @@ def is_valid_license_identifier(license_str):
     except:
         return False
 
+# Stages resolving the namespace name and author username of the packages in a page.
+SEARCH_RESULT_STAGES = [
+    {
+        "$lookup": {
+            "from": "namespaces",
+            "localField": "namespace",
+            "foreignField": "_id",
+            "as": "namespace",
+        }
+    },
+    {
+        "$lookup": {
+            "from": "users",
+            "localField": "author",
+            "foreignField": "_id",
+            "as": "author",
+        }
+    },
+]
+
+SEARCH_RESULT_PROJECTION = {
+    "_id": 1,
+    "name": 1,
+    "namespace": {"$arrayElemAt": ["$namespace.namespace", 0]},
+    "author": {"$arrayElemAt": ["$author.username", 0]},
+    "description": 1,
+    "tags": 1,
+    "updatedAt": 1,
+}
+
+# Number of values returned in each facet of the search results.
+FACET_SIZE = 20
+
+def facet_stages(field):
+    """
+    Function to build the pipeline counting the search results per value of a field.
+
+    Parameters:
+    field (str): The field of the package documents.
+
+    Returns:
+    list: The stages of the facet, most common values first.
+    """
+    return [
+        {"$group": {"_id": "$" + field, "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+        {"$limit": FACET_SIZE},
+    ]
+
+SEARCH_FACETS = {
+    "license": facet_stages("license") + [
+        {"$project": {"_id": 0, "value": "$_id", "count": 1}},
+    ],
+    "tag": [{"$unwind": "$tags"}] + facet_stages("tags") + [
+        {"$project": {"_id": 0, "value": "$_id", "count": 1}},
+    ],
+    "namespace": facet_stages("namespace") + [
+        {
+            "$lookup": {
+                "from": "namespaces",
+                "localField": "_id",
+                "foreignField": "_id",
+                "as": "namespace",
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "value": {"$arrayElemAt": ["$namespace.namespace", 0]},
+                "count": 1,
+            }
+        },
+    ],
+}
+
+def encode_cursor(sorted_by, values):
+    """
+    Function to encode the position of the last package of a page as an opaque cursor.
+
+    Parameters:
+    sorted_by (str): The sort key of the listing.
+    values (list): The sort key value and the _id of the last package.
+
+    Returns:
+    str: The URL safe cursor token.
+    """
+    cursor = json_util.dumps({"sorted_by": sorted_by, "values": values})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+def decode_cursor(sorted_by, token):
+    """
+    Function to decode a cursor token created by encode_cursor.
+
+    Parameters:
+    sorted_by (str): The sort key of the listing the cursor is used with.
+    token (str): The cursor token received from the client.
+
+    Returns:
+    list: The sort key value and the _id of the last package of the previous page.
+
+    Raises:
+    ValueError: If the token is malformed or was created for another sort key.
+    """
+    try:
+        cursor = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, TypeError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(cursor, dict) or cursor.get("sorted_by") != sorted_by:
+        raise ValueError("Invalid cursor")
+    values = cursor.get("values")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor")
+    return values
+
 @app.route("/packages", methods=["GET"])
 @swag_from("documentation/search_packages.yaml", methods=["GET"])
 def search_packages():
@@ -63,65 +212,210 @@ def search_packages():
     page = request.args.get("page")
     sorted_by = request.args.get("sorted_by")
     sort = request.args.get("sort")
-    sorted_by = sorted_by.lower() if sorted_by else "name"
+    sorted_by = sorted_by.lower() if sorted_by else "relevance"
     query = query if query else "fortran"
     sort = -1 if sort == "desc" else 1
     sorted_by = (
         parameters[sorted_by.lower()]
         if sorted_by.lower() in parameters.keys()
-        else "name"
+        else "relevance"
     )
     page = int(page) if page else 0
+    cursor = request.args.get("cursor")
+    license_filter = request.args.get("license")
+    tag_filter = request.args.get("tag")
+    namespace_filter = request.args.get("namespace")
     query = unquote(query.strip().lower())
     packages_per_page = 10
 
+    # Tokenize the query the same way the package search fields are tokenized.
+    search_string = text_query(query)
+
+    if not search_string:
+        return jsonify({
+            "code": 200,
+            "packages": [],
+            "total_pages": 0,
+            "next_cursor": None,
+            "facets": {facet: [] for facet in SEARCH_FACETS},
+        }), 200
+
+    # Queries are cached by their normalized form, so differences in case or
+    # word form between queries do not cause cache misses.
+    cache_key = (
+        search_string, page, cursor, sorted_by, sort, license_filter, tag_filter, namespace_filter
+    )
+    response = search_cache.get(cache_key)
+    if response is not None:
+        return jsonify(response), 200
+
+    # Every term of the query must be found in a package, not only one of them.
     mongo_db_query = {
-        "$and": [
+        "$text": {"$search": search_string},
+        **all_terms_query(search_string),
+        "isDeprecated": False,
+    }
+
+    if license_filter:
+        mongo_db_query["license"] = license_filter
+    if tag_filter:
+        mongo_db_query["tags"] = tag_filter
+
+    # Packages only reference the id of their namespace, so the namespace filter is
+    # applied on the looked up namespace, in the same aggregation.
+    filter_stages = []
+    if namespace_filter:
+        filter_stages = [
             {
-                "$or": [
-                    {"name": {"$regex": query}},
-                    {"tags": {"$in": [query]}},
-                    {"description": {"$regex": query}},
-                ]
+                "$lookup": {
+                    "from": "namespaces",
+                    "localField": "namespace",
+                    "foreignField": "_id",
+                    "as": "namespace_filter",
+                }
             },
-            {"isDeprecated": False},
+            {"$match": {"namespace_filter.namespace": namespace_filter}},
+            {"$project": {"namespace_filter": 0}},
         ]
-    }
 
-    packages = (
-        db.packages.find(
-            mongo_db_query,
+    # Results are ranked by text score unless a sort parameter is given.
+    # The _id is used as a tie breaker to keep the order of pages stable.
+    sort_key = "score" if sorted_by == "relevance" else sorted_by
+    sort_order = {sort_key: -1, "_id": 1}
+
+    # With a cursor the page starts right after the last package of the previous
+    # page, instead of skipping over all the packages of the previous pages.
+    if cursor:
+        try:
+            last_value, last_id = decode_cursor(sorted_by, cursor)
+        except ValueError:
+            return jsonify({"code": 400, "message": "Invalid cursor"}), 400
+
+        after_last = [
+            {sort_key: {"$lt": last_value}},
+            {sort_key: last_value, "_id": {"$gt": last_id}},
+        ]
+        # Packages missing the sort field, like the ones uploaded before the download
+        # counter, sort last but are not less than any value.
+        if last_value is not None:
+            after_last.append({sort_key: None})
+
+        page_start = [
+            {"$match": {"$or": after_last}},
+            {"$sort": sort_order},
+        ]
+    else:
+        page_start = [
+            {"$sort": sort_order},
+            {"$skip": page * packages_per_page},
+        ]
+
+    matching = [
+        {"$match": mongo_db_query},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ] + filter_stages
+
+    # The sort value is taken before the lookups, which replace the namespace and
+    # author ids with the joined documents.
+    page_stages = page_start + [
+        {"$limit": packages_per_page},
+        {"$addFields": {"sort_value": "$" + sort_key}},
+    ] + SEARCH_RESULT_STAGES + [
+        {"$project": {**SEARCH_RESULT_PROJECTION, "sort_value": 1}},
+    ]
+
+    # The total number of matching packages and their number per license, tag and
+    # namespace do not depend on the page, they are cached for all the pages.
+    counts_key = ("counts", search_string, license_filter, tag_filter, namespace_filter)
+    counts = search_cache.get(counts_key)
+
+    if counts is None:
+        # A single aggregation returns the requested page, with the namespace name and
+        # author username resolved, together with the counts.
+        result = next(db.packages.aggregate(matching + [
             {
-                "_id": 0,
-                "name": 1,
-                "namespace": 1,
-                "author": 1,
-                "description": 1,
-                "tags": 1,
-                "updatedAt": 1,
+                "$facet": {
+                    "packages": page_stages,
+                    "total": [{"$count": "count"}],
+                    **SEARCH_FACETS,
+                }
             },
+        ]))
+        counts = {
+            "total": result["total"][0]["count"] if result["total"] else 0,
+            "facets": {facet: result[facet] for facet in SEARCH_FACETS},
+        }
+        search_cache.set(counts_key, counts)
+        packages = result["packages"]
+    else:
+        # Without the facets, the cursor condition follows the text match, and the
+        # sort only keeps the packages of the page in memory. No index serves a sort
+        # after a $text match, so every matching package is still read.
+        packages = list(db.packages.aggregate(matching + page_stages))
+
+    total_pages = math.ceil(counts["total"] / packages_per_page)
+
+    next_cursor = None
+    if len(packages) == packages_per_page:
+        next_cursor = encode_cursor(
+            sorted_by, [packages[-1].get("sort_value"), packages[-1]["_id"]]
         )
-        .sort(sorted_by, -1)
-        .limit(packages_per_page)
-        .skip(page * packages_per_page)
-    )
 
-    if packages:
-        # Count the number of documents in the database related to query.
-        total_documents = db.packages.count_documents(mongo_db_query)
+    # When the query matches less than a page of packages, the page is completed
+    # with the packages whose name is similar to the query, to tolerate typos.
+    if not cursor and page == 0 and len(packages) < packages_per_page:
+        found_ids = {package["_id"] for package in packages}
+        similar_ids = [
+            package_id
+            for package_id in fuzzy_search(query, packages_per_page + len(packages))
+            if package_id not in found_ids
+        ][:packages_per_page - len(packages)]
+
+        if similar_ids:
+            similar_query = {
+                key: value for key, value in mongo_db_query.items() if key not in ("$text", "$and")
+            }
+            similar_packages = db.packages.aggregate(
+                [{"$match": {**similar_query, "_id": {"$in": similar_ids}}}]
+                + filter_stages
+                + SEARCH_RESULT_STAGES
+                + [{"$project": SEARCH_RESULT_PROJECTION}]
+            )
+            ranks = {package_id: rank for rank, package_id in enumerate(similar_ids)}
+            packages.extend(sorted(similar_packages, key=lambda package: ranks[package["_id"]]))
+            total_pages = max(total_pages, 1)
 
-        total_pages = math.ceil(total_documents / packages_per_page)
+    for package in packages:
+        del package["_id"]
+        package.pop("sort_value", None)
+
+    response = {
+        "code": 200,
+        "packages": packages,
+        "total_pages": total_pages,
+        "next_cursor": next_cursor,
+        "facets": counts["facets"],
+    }
+    search_cache.set(cache_key, response)
 
-        search_packages = []
-        for i in packages:
-            namespace = db.namespaces.find_one({"_id": i["namespace"]})
-            author = db.users.find_one({"_id": i["author"]})
-            i["namespace"] = namespace["namespace"]
-            i["author"] = author["username"]
-            search_packages.append(i)
-        return jsonify({"code": 200, "packages": search_packages, "total_pages": total_pages}), 200
-    else:
-        return jsonify({"status": "error", "message": "packages not found", "code": 404}), 404
+    return jsonify(response), 200
+
+@app.route("/packages/suggest", methods=["GET"])
+@swag_from("documentation/suggest_packages.yaml", methods=["GET"])
+def suggest_packages():
+    prefix = request.args.get("prefix", "").strip()
+    limit = request.args.get("limit", "10")
+
+    if not limit.isdigit() or int(limit) == 0:
+        return jsonify({"message": "Limit should be a positive integer", "code": 400}), 400
+
+    limit = min(int(limit), 50)
+
+    if not prefix:
+        return jsonify({"code": 200, "suggestions": []}), 200
+
+    # Suggestions are answered from the in-memory prefix index only.
+    return jsonify({"code": 200, "suggestions": suggest(prefix, limit)}), 200
 
 @app.route("/packages", methods=["POST"])
 def upload():
@@ -131,150 +425,352 @@ def upload():
     package_license = request.form.get("package_license")
     tarball = request.files["tarball"]
 
+    error, package_upload = check_upload(upload_token, package_name, package_version, package_license)
+    if error is not None:
+        return error
+
+    if isinstance(tarball.stream, HashingSpooledFile):
+        # The digest was computed while the tarball was received.
+        tarball_digest = tarball.stream.hexdigest()
+    else:
+        tarball_digest = hash_file(tarball.stream)
+
+    return publish_package(package_upload, tarball.stream, tarball_digest)
+
+
+def check_upload(upload_token, package_name, package_version, package_license):
+    """
+    Function to check that a package version can be uploaded with an upload token.
+
+    Parameters:
+    upload_token (str): The upload token of the namespace.
+    package_name (str): The name of the package.
+    package_version (str): The version to be uploaded.
+    package_license (str): The license of the package.
+
+    Returns:
+    tuple: The error response and None if the upload is refused, otherwise None
+    and the upload details used by publish_package.
+    """
     if not upload_token:
-        return jsonify({"code": 400, "message": "Upload token missing"})
+        return jsonify({"code": 400, "message": "Upload token missing"}), None
     
     if not package_name:
-        return jsonify({"code": 400, "message": "Package name is missing"})
+        return jsonify({"code": 400, "message": "Package name is missing"}), None
     
     if not package_version:
-        return jsonify({"code": 400, "message": "Package version is missing"})
+        return jsonify({"code": 400, "message": "Package version is missing"}), None
     
     if not package_license:
-        return jsonify({"code": 400, "message": "Package license is missing"})
+        return jsonify({"code": 400, "message": "Package license is missing"}), None
     
     # Check whether version string is valid or not.
     if package_version == "0.0.0" or not is_valid_version_str(package_version):
-        return jsonify({"code": 400, "message": "Version is not valid"})
+        return jsonify({"code": 400, "message": "Version is not valid"}), None
     
     # Check whether license identifier is valid or not.
     if not is_valid_license_identifier(license_str=package_license):
-        return jsonify({"code": 400, "message": "Invalid license identifier"})
+        return jsonify({"code": 400, "message": "Invalid license identifier"}), None
     
-    # Find the document that contains the upload token.
-    namespace_doc = db.namespaces.find_one({"upload_tokens": {"$elemMatch": {"token": upload_token}}})
+    # Find the upload token by its hash.
+    upload_token_doc = find_upload_token(upload_token)
+    namespace_doc = upload_token_doc and db.namespaces.find_one({"_id": upload_token_doc["namespace"]})
 
     # Check if there is a namespace connected to the given upload_token:
     if not namespace_doc:
-        return jsonify({"code": 401, "message": "Namespace not found or invalid upload token"})
-    
-    # Get the matching subdocument from the upload_token array
-    upload_token_doc = next(item for item in namespace_doc['upload_tokens'] if item['token'] == upload_token)
+        return jsonify({"code": 401, "message": "Namespace not found or invalid upload token"}), None
+
+    # The token may be limited to some packages of the namespace.
+    if not token_allows(upload_token_doc, package_name):
+        return jsonify({"code": 401, "message": "Upload token is not allowed to publish this package"}), None
 
     # Get the user connected to the upload token.
     user_id = upload_token_doc["createdBy"]
     user = db.users.find_one({"_id": user_id})
 
     if not user:
-        return jsonify({"code": 404, "message": "User not found"})
+        return jsonify({"code": 404, "message": "User not found"}), None
     
     # User should be either namespace maintainer or namespace admin to upload a package.
     if checkUserUnauthorized(user_id=user["_id"], package_namespace=namespace_doc):
-        return jsonify({"message": "Unauthorized", "code": 401}), 401
+        return (jsonify({"message": "Unauthorized", "code": 401}), 401), None
     
     package_doc = db.packages.find_one({"name": package_name, "namespace": namespace_doc["_id"]})
 
-    tarball_name = "{}-{}.tar.gz".format(package_name, package_version)
-    # Upload the tarball to the Grid FS storage.
-    file_object_id = file_storage.put(tarball, content_type="application/gzip", filename=tarball_name)
+    # Check if version of the package already exists in the backend,
+    # before anything is written.
+    if package_doc and any(
+        version["version"] == package_version for version in package_doc["versions"]
+    ):
+        return (jsonify({"message": "Version already exists", "code": 400}), 400), None
+
+    return None, {
+        "name": package_name,
+        "version": package_version,
+        "license": package_license,
+        "namespace": namespace_doc,
+        "user": user,
+        "package": package_doc,
+    }
+
+
+def package_metadata(manifest):
+    """
+    Function to get the fields of a package document set from the manifest of its latest version.
 
+    Parameters:
+    manifest (dict): The metadata returned by read_manifest, or None.
 
-    # TODO: Uncomment this when the package validation is enabled
+    Returns:
+    dict: The description, tags, copyright, homepage and authors of the package.
+    """
+    # Tarballs without a manifest keep the placeholder metadata.
+    if not manifest:
+        return {
+            "description": "Sample Test description",
+            "copyright": "Test copyright",
+            "tags": ["fortran", "fpm"],
+        }
 
-    # validate the package
-    # valid_package = validate_package(tarball_name, tarball_name)
-    # if not valid_package:
-    #     return jsonify({"status": "error", "message": "Invalid package", "code": 400}), 400
+    return {
+        "description": manifest["description"] or "",
+        "copyright": manifest["copyright"] or "",
+        "tags": manifest["keywords"],
+        "homepage": manifest["homepage"],
+        "authors": manifest["author"],
+    }
 
 
+def version_metadata(manifest):
+    """
+    Function to get the fields of a version document set from its manifest.
+
+    Parameters:
+    manifest (dict): The metadata returned by read_manifest, or None.
+
+    Returns:
+    dict: The dependencies and authors of the version.
+    """
+    if not manifest:
+        return {"dependencies": [], "dev_dependencies": []}
+
+    return {
+        "dependencies": manifest["dependencies"],
+        "dev_dependencies": manifest["dev_dependencies"],
+        "authors": manifest["author"],
+    }
+
+
+def publish_package(package_upload, tarball, tarball_digest):
+    """
+    Function to store the tarball of a checked upload and add the version to its package.
+
+    Parameters:
+    package_upload (dict): The upload details returned by check_upload.
+    tarball: The file object of the tarball, positioned at its start.
+    tarball_digest (str): The hexadecimal SHA-256 digest of the tarball.
+
+    Returns:
+    Response: The response of the upload.
+    """
+    package_name = package_upload["name"]
+    package_version = package_upload["version"]
+    package_license = package_upload["license"]
+    namespace_doc = package_upload["namespace"]
+    user = package_upload["user"]
+    package_doc = package_upload["package"]
+
+    tarball_name = "{}-{}.tar.gz".format(package_name, package_version)
+
+    # Read the metadata of the package from the fpm.toml manifest of the tarball,
+    # so it never has to be opened again to answer a request.
+    manifest = read_manifest(tarball)
+    metadata = package_metadata(manifest)
+
+    # Tarballs are stored by the digest of their content, so identical tarballs
+    # are stored once. Each version gets its own download url, which keeps the
+    # downloads of versions sharing a tarball apart.
+    store_tarball(tarball, tarball_digest, tarball_name)
+    tarball_id = ObjectId()
+
+
+    version_obj = {
+        "version": package_version,
+        # The versions of a package are ordered by the database on this key.
+        "sort_key": version_sort_key(package_version),
+        "tarball": tarball_name,
+        "digest": tarball_digest,
+        **version_metadata(manifest),
+        "createdAt": datetime.utcnow(),
+        "isDeprecated": False,
+        "download_url": f"/tarballs/{tarball_id}",
+        "downloads": 0,
+        # The package is built by a validation worker after the upload.
+        "status": "pending",
+    }
+
+    # The metadata is kept on the version, to be restored on the package when a
+    # later version is deleted, see versions.refresh_latest_version.
+    if manifest:
+        version_obj["package_metadata"] = {
+            **metadata,
+            "search": search_fields(package_name, metadata["tags"], metadata["description"]),
+        }
+
     # No previous recorded versions of the package found.
     if not package_doc:
         package_obj = {
             "name": package_name,
             "namespace": namespace_doc["_id"],
-            "description": "Sample Test description",
             "license": package_license,
             "createdAt": datetime.utcnow(),
             "updatedAt": datetime.utcnow(),
             "author": user["_id"],
             "maintainers": [user["_id"]],
-            "copyright": "Test copyright",
-            "tags": ["fortran", "fpm"],
             "isDeprecated": False,
+            "downloads": 0,
+            **metadata,
+            "versions": [version_obj],
+            "latest_version": package_version,
+            "latest_sort_key": version_obj["sort_key"],
         }
+        package_obj["search"] = search_fields(
+            package_obj["name"], package_obj["tags"], package_obj["description"]
+        )
 
-        version_obj = {
-            "version": package_version,
-            "tarball": tarball_name,
-            "dependencies": "Test dependencies",
-            "createdAt": datetime.utcnow(),
-            "isDeprecated": False,
-            "download_url": f"/tarballs/{file_object_id}"
-        }
+        try:
+            package_id = db.packages.insert_one(package_obj).inserted_id
+        except DuplicateKeyError:
+            # The package was created by a concurrent upload, add the version to it.
+            package_doc = db.packages.find_one({"name": package_name, "namespace": namespace_doc["_id"]})
+        else:
+            # Add the package id to the namespace.
+            db.namespaces.update_one(
+                {"_id": namespace_doc["_id"]},
+                {"$addToSet": {"packages": package_id}, "$set": {"updatedAt": datetime.utcnow()}},
+            )
 
-        package_obj["versions"] = []
+            # Current user is the author of the package.
+            db.users.update_one({"_id": user["_id"]}, {"$addToSet": {"authorOf": package_id}})
 
-        # Append the first version document.
-        package_obj["versions"].append(version_obj)
-        db.packages.insert_one(package_obj)
+            index_package(package_obj, namespace_doc["namespace"])
 
-        package = db.packages.find_one(
-            {"name": package_name, "versions.version": package_version, "namespace": namespace_doc["_id"]}
+    if package_doc:
+        package_id = package_doc["_id"]
+
+        # The version is only added if a concurrent upload did not add it first.
+        result = db.packages.update_one(
+            {"_id": package_id, "versions.version": {"$ne": package_version}},
+            {
+                "$push": {"versions": {"$each": [version_obj], "$sort": {"sort_key": 1}}},
+                "$set": {"updatedAt": datetime.utcnow()},
+            },
         )
+        if not result.modified_count:
+            release_tarball(tarball_digest)
+            return jsonify({"message": "Version already exists", "code": 400}), 400
 
-        namespace_doc["packages"] = []
+        # The metadata of the package is the one of its latest version.
+        package = refresh_latest_version(package_id)
+        is_latest = manifest and package and package["latest_sort_key"] == version_obj["sort_key"]
 
-        # Add the package id to the namespace.
-        namespace_doc["packages"].append(package["_id"])
-        namespace_doc["updatedAt"] = datetime.utcnow()
-        db.namespaces.update_one({"_id": namespace_doc["_id"]}, {"$set": namespace_doc})
+        if is_latest and not package_doc["isDeprecated"]:
+            # The tags of the package may have changed.
+            unindex_package(package_doc, namespace_doc["namespace"])
+            index_package({**package_doc, **metadata}, namespace_doc["namespace"])
 
-        if "authorOf" not in user:
-            user["authorOf"] = []
+    invalidate_search_cache()
+    resolution_cache.invalidate(namespace_doc["namespace"], package_name, package_version)
+    add_dependents(package_id, namespace_doc["namespace"], package_name, package_version, version_obj["dependencies"])
+    enqueue_validation(package_id, package_name, package_version, tarball_digest)
 
-        # Current user is the author of the package.
-        user["authorOf"].append(package["_id"])
-        db.users.update_one({"_id": user["_id"]}, {"$set": user})
+    return jsonify({"message": "Package Uploaded Successfully.", "code": 200})
 
-        return jsonify({"message": "Package Uploaded Successfully.", "code": 200})
-    else:
-        # Check if version of the package already exists in the backend.
-        package_version_doc = db.packages.find_one({
-            "name": package_name, "namespace": namespace_doc["_id"], "versions.version": package_version
-        })
 
-        if package_version_doc:
-            return jsonify({"message": "Version already exists", "code": 400}), 400
+@app.route('/tarballs/<oid>', methods=["GET"])
+def serve_gridfs_file(oid):
+    download_url = f"/tarballs/{oid}"
 
-        new_version = {
-            "tarball": tarball_name,
-            "version": package_version,
-            "dependencies": "Test dependencies",
-            "isDeprecated": False,
-            "createdAt": datetime.utcnow(),
-            "download_url": f"/tarballs/{file_object_id}"
-        }
+    # Find the version the download url belongs to.
+    package = db.packages.find_one(
+        {"versions.download_url": download_url},
+        {"versions": {"$elemMatch": {"download_url": download_url}}},
+    )
 
-        package_doc["versions"].append(new_version)
-        package_doc["versions"] = sorted(package_doc["versions"], key=lambda x: x['version'])
-        package_doc["updatedAt"] = datetime.utcnow()
-        db.packages.update_one(
-            {"_id": package_doc["_id"]},
-            {"$set": package_doc},
-        )
+    if not package:
+        abort(404)
 
-        return jsonify({"message": "Package Uploaded Successfully.", "code": 200})
-    
-@app.route('/tarballs/<oid>', methods=["GET"])
-def serve_gridfs_file(oid):
-    try:
-        file = file_storage.get(ObjectId(oid))
+    version = package["versions"][0]
+    digest = version.get("digest")
 
-        # Return the file data as a Flask response object
-        return send_file(file, download_name=file.filename, as_attachment=True, mimetype=file.content_type)
-    except NoFile:
+    # Tarballs in a store served by nginx are handed over to it, the worker only
+    # answers revalidations.
+    redirect = tarball_redirect(digest) if digest else None
+    if redirect:
+        response = Response(mimetype="application/gzip")
+        response.headers["Content-Disposition"] = "attachment; filename={}".format(version["tarball"])
+        set_tarball_cache_headers(response, digest)
+        response.make_conditional(request)
+
+        if response.status_code == 200:
+            response.headers["X-Accel-Redirect"] = redirect
+            # Range requests are answered by nginx, and are not complete downloads,
+            # neither are HEAD requests.
+            if request.method == "GET" and not request.range:
+                download_counter.record(download_url)
+
+        return response
+
+    try:
+        if digest:
+            file = open_tarball(digest)
+        else:
+            # Tarballs uploaded before content addressing are stored by their id.
+            file = file_storage.get(ObjectId(oid))
+    except (InvalidId, NoFile):
         abort(404)
 
+    # Stream the file, seeking to the requested chunks for range requests.
+    response = Response(
+        wrap_file(request.environ, file),
+        mimetype="application/gzip",
+        direct_passthrough=True,
+    )
+    response.headers["Content-Disposition"] = "attachment; filename={}".format(
+        version.get("tarball", file.filename)
+    )
+
+    # Tarballs uploaded before digests were recorded use their id as ETag.
+    set_tarball_cache_headers(response, digest or getattr(file, "sha256", None) or oid)
+    response.last_modified = file.upload_date
+
+    # Answers If-None-Match / If-Modified-Since with 304 and Range with 206.
+    response.make_conditional(request, accept_ranges=True, complete_length=file.length)
+
+    # Only complete downloads are counted, not revalidations, resumed downloads or
+    # HEAD requests. The download is written to the database later, in a batch with others.
+    if response.status_code == 200 and request.method == "GET":
+        download_counter.record(download_url)
+
+    return response
+
+
+def set_tarball_cache_headers(response, etag):
+    """
+    Function to set the caching headers of a tarball download.
+
+    The content of a tarball never changes, so the digest of the content is used
+    as a strong ETag and the tarball can be cached for a year.
+
+    Parameters:
+    response (Response): The download response.
+    etag (str): The ETag of the tarball.
+    """
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = TARBALL_MAX_AGE
+    response.cache_control.immutable = True
+
 
 @app.route("/packages", methods=["PUT"])
 def update_package():
@@ -282,7 +778,7 @@ def update_package():
     if not uuid:
         return jsonify({"status": "error", "message": "Unauthorized", "code": 401}), 401
 
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
 
     if not user:
         return jsonify({"status": "error", "message": "Unauthorized", "code": 401}), 401
@@ -304,16 +800,19 @@ def update_package():
         return jsonify({"status": "error", "message": "Package doesn't exist", "code": 404}), 404
 
     isDeprecated = True if isDeprecated == "true" else False
-    package["isDeprecated"] = isDeprecated
-    package["updatedAt"] = datetime.utcnow()
-    db.packages.update_one({"_id": package["_id"]}, {"$set": package})
-    return jsonify({"message": "Package Updated Successfully.", "code": 200})
-
+    wasDeprecated = package["isDeprecated"]
+    db.packages.update_one(
+        {"_id": package["_id"]},
+        {"$set": {"isDeprecated": isDeprecated, "updatedAt": datetime.utcnow()}},
+    )
+    invalidate_search_cache()
 
-def check_version(current_version, new_version):
-    current_list = list(map(int, current_version.split(".")))
-    new_list = list(map(int, new_version.split(".")))
-    return new_list > current_list
+    # Deprecated packages are not suggested.
+    if isDeprecated and not wasDeprecated:
+        unindex_package(package, package_namespace["namespace"])
+    elif wasDeprecated and not isDeprecated:
+        index_package(package, package_namespace["namespace"])
+    return jsonify({"message": "Package Updated Successfully.", "code": 200})
 
 
 @app.route("/packages/<namespace_name>/<package_name>", methods=["GET"])
@@ -326,9 +825,11 @@ def get_package(namespace_name, package_name):
     if not namespace:
         return jsonify({"status": "error", "message": "Namespace not found", "code": 404}), 404
 
-    # Get package from a package_name and namespace's id.
+    # Get package from a package_name and namespace's id. The metadata kept on the
+    # versions is the one of the package.
     package = db.packages.find_one(
-        {"name": package_name, "namespace": namespace["_id"]}
+        {"name": package_name, "namespace": namespace["_id"]},
+        {"versions.package_metadata": 0},
     )
 
     # Check if package is not found.
@@ -366,22 +867,11 @@ def get_package(namespace_name, package_name):
         if len(versions) == 0:
             return jsonify({"message": "cached versions list is empty", "code": 400})
 
-        # Sort the versions received in request body.
-        sorted_versions = sort_versions(versions)
-
-        # Get the latest version stored in the backend database.
-        latest_version_backend = package["versions"][-1]["version"]
-
         # Get the latest version that is in the local registry for that package.
-        latest_version_local_registry = sorted_versions[0]
-
-        latest_version_backend_list = list(map(int, latest_version_backend.split(".")))
-        latest_version_local_registry_list = list(
-            map(int, latest_version_local_registry.split("."))
-        )
+        latest_sort_key_local_registry = max(version_sort_key(version) for version in versions)
 
         # Check if the local registry already has the latest version.
-        if latest_version_backend_list <= latest_version_local_registry_list:
+        if (package.get("latest_sort_key") or "") <= latest_sort_key_local_registry:
             return (
                 jsonify({"message": "Latest version is already there in local registry"}),
                 200,
@@ -403,6 +893,64 @@ def get_package(namespace_name, package_name):
         return jsonify({"data": package, "code": 200}), 200
         
 
+@app.route("/packages/<namespace_name>/<package_name>/stats", methods=["GET"])
+@swag_from("documentation/package_stats.yaml", methods=["GET"])
+def get_package_stats(namespace_name, package_name):
+    interval = request.args.get("interval", "day")
+    version = request.args.get("version")
+
+    # Default length of the series in days, for each interval.
+    periods = {"day": 30, "week": 182, "month": 365}
+
+    if interval not in periods:
+        return jsonify({"message": "Interval should be day, week or month", "code": 400}), 400
+
+    period = request.args.get("period", str(periods[interval]))
+
+    if not period.isdigit() or int(period) == 0:
+        return jsonify({"message": "Period should be a positive number of days", "code": 400}), 400
+
+    period = min(int(period), 3650)
+
+    # Get namespace from namespace name.
+    namespace = db.namespaces.find_one({"namespace": namespace_name})
+
+    # Check if namespace exists.
+    if not namespace:
+        return jsonify({"message": "Namespace not found", "code": 404}), 404
+
+    package = db.packages.find_one(
+        {"name": package_name, "namespace": namespace["_id"]},
+        {"downloads": 1, "versions.version": 1, "versions.downloads": 1},
+    )
+
+    # Check if package is not found.
+    if not package:
+        return jsonify({"message": "Package not found", "code": 404}), 404
+
+    if version:
+        version_data = next(
+            filter(lambda obj: obj["version"] == version, package["versions"]), None
+        )
+        if not version_data:
+            return jsonify({"message": "Package version not found", "code": 404}), 404
+        downloads = version_data.get("downloads", 0)
+    else:
+        downloads = package.get("downloads", 0)
+
+    since = datetime.utcnow() - timedelta(days=period)
+    series = download_series(package["_id"], version, interval, since)
+
+    return jsonify({
+        "data": {
+            "downloads": downloads,
+            "interval": interval,
+            "series": series,
+        },
+        "code": 200,
+    }), 200
+
+
 @app.route("/packages/<namespace_name>/<package_name>/<version>", methods=["GET"])
 @swag_from("documentation/get_version.yaml", methods=["GET"])
 def get_package_from_version(namespace_name, package_name, version):
@@ -419,7 +967,8 @@ def get_package_from_version(namespace_name, package_name, version):
             "name": package_name,
             "namespace": namespace["_id"],
             "versions.version": version,
-        }
+        },
+        {"versions.package_metadata": 0},
     )
 
     # Check if package is not found.
@@ -452,6 +1001,149 @@ def get_package_from_version(namespace_name, package_name, version):
         return jsonify({"data": package_response_data, "code": 200})
 
 
+@app.route("/packages/<namespace_name>/<package_name>/<version>/status", methods=["GET"])
+@swag_from("documentation/version_status.yaml", methods=["GET"])
+def get_package_version_status(namespace_name, package_name, version):
+    # Get namespace from namespace name.
+    namespace = db.namespaces.find_one({"namespace": namespace_name})
+
+    if not namespace:
+        return jsonify({"message": "Namespace not found", "code": 404}), 404
+
+    package = db.packages.find_one(
+        {"name": package_name, "namespace": namespace["_id"], "versions.version": version},
+        {"versions": {"$elemMatch": {"version": version}}},
+    )
+
+    if not package:
+        return jsonify({"message": "Package not found", "code": 404}), 404
+
+    # Versions uploaded before validation was enabled have no status.
+    status = package["versions"][0].get("status", "unvalidated")
+
+    # The build output of the last validation job of the version.
+    job = db.validation_jobs.find_one(
+        {"package": package["_id"], "version": version}, sort=[("createdAt", -1)]
+    )
+
+    return jsonify({
+        "code": 200,
+        "status": status,
+        "attempts": job["attempts"] if job else 0,
+        "log": job.get("log") if job else None,
+    }), 200
+
+
+@app.route("/packages/<namespace_name>/<package_name>/<version>/resolve", methods=["GET"])
+@swag_from("documentation/resolve_dependencies.yaml", methods=["GET"])
+def get_package_version_resolution(namespace_name, package_name, version):
+    # Get namespace from namespace name.
+    namespace = db.namespaces.find_one({"namespace": namespace_name})
+
+    if not namespace:
+        return jsonify({"message": "Namespace not found", "code": 404}), 404
+
+    package = db.packages.find_one(
+        {"name": package_name, "namespace": namespace["_id"], "versions.version": version},
+        {"versions": {"$elemMatch": {"version": version}}},
+    )
+
+    if not package:
+        return jsonify({"message": "Package not found", "code": 404}), 404
+
+    # The whole dependency closure is returned, so a client fetches a project in one request.
+    resolution = resolve_dependencies(namespace_name, package_name, package["versions"][0])
+
+    return jsonify({"data": resolution, "code": 200}), 200
+
+
+@app.route("/packages/<namespace_name>/<package_name>/match", methods=["GET"])
+@swag_from("documentation/match_version.yaml", methods=["GET"])
+def get_package_matching_version(namespace_name, package_name):
+    requirement = request.args.get("req")
+    spec = parse_requirement(requirement)
+
+    if spec is None:
+        return jsonify({"message": "Invalid version requirement", "code": 400}), 400
+
+    # Get namespace from namespace name.
+    namespace = db.namespaces.find_one({"namespace": namespace_name})
+
+    if not namespace:
+        return jsonify({"message": "Namespace not found", "code": 404}), 404
+
+    # The requirement is evaluated by the database on the sort keys of the versions,
+    # which also returns the highest matching version.
+    package_query = {"name": package_name, "namespace": namespace["_id"]}
+    matches = list(db.packages.aggregate([
+        {"$match": package_query},
+        {"$unwind": "$versions"},
+        {"$match": {"$and": [
+            {"versions.isDeprecated": False},
+            requirement_query(spec.clause, "versions.sort_key"),
+        ]}},
+        {"$sort": {"versions.sort_key": -1}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "versions.package_metadata": 0}},
+        {"$project": {"version_data": "$versions"}},
+    ]))
+
+    if not matches:
+        if not db.packages.find_one(package_query, {"_id": 1}):
+            return jsonify({"message": "Package not found", "code": 404}), 404
+        return jsonify({"message": "No version matches the requirement", "code": 404}), 404
+
+    return jsonify({
+        "data": {
+            "name": package_name,
+            "namespace": namespace_name,
+            "requirement": requirement,
+            "version_data": matches[0]["version_data"],
+        },
+        "code": 200,
+    }), 200
+
+
+@app.route("/packages/<namespace_name>/<package_name>/dependents", methods=["GET"])
+@swag_from("documentation/package_dependents.yaml", methods=["GET"])
+def get_package_dependents(namespace_name, package_name):
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit", "20")
+
+    if not limit.isdigit() or int(limit) == 0:
+        return jsonify({"message": "Limit should be a positive integer", "code": 400}), 400
+
+    limit = min(int(limit), 100)
+
+    query = {"dependency_namespace": namespace_name, "dependency_name": package_name}
+    total = db.reverse_dependencies.count_documents(query)
+
+    # Dependents are listed in the order of their package ids, so a cursor only
+    # needs the last id and every page is read from the index.
+    if cursor:
+        try:
+            _, last_id = decode_cursor("package", cursor)
+        except ValueError:
+            return jsonify({"message": "Invalid cursor", "code": 400}), 400
+        query["package"] = {"$gt": last_id}
+
+    dependents = list(db.reverse_dependencies.find(query).sort("package", 1).limit(limit))
+
+    next_cursor = None
+    if len(dependents) == limit:
+        next_cursor = encode_cursor("package", [dependents[-1]["package"], dependents[-1]["package"]])
+
+    return jsonify({
+        "code": 200,
+        "dependents": [
+            {"namespace": dependent["namespace"], "name": dependent["name"], "versions": dependent["versions"]}
+            for dependent in dependents
+        ],
+        "total": total,
+        "next_cursor": next_cursor,
+    }), 200
+
+
 @app.route("/packages/<namespace_name>/<package_name>/delete", methods=["POST"])
 def delete_package(namespace_name, package_name):
     uuid = request.form.get("uuid")
@@ -459,7 +1151,10 @@ def delete_package(namespace_name, package_name):
     if not uuid:
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
 
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
+
+    if not user:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
 
     # Check if the user is authorized to delete the package.
     if not "admin" in user["roles"]:
@@ -494,6 +1189,15 @@ def delete_package(namespace_name, package_name):
     )
 
     if package_deleted.deleted_count > 0:
+        for version in package["versions"]:
+            if version.get("digest"):
+                release_tarball(version["digest"])
+
+        invalidate_search_cache()
+        resolution_cache.invalidate(namespace_name, package_name)
+        remove_dependents(package["_id"])
+        if not package["isDeprecated"]:
+            unindex_package(package, namespace_name)
         return jsonify({"message": "Package deleted successfully", "code": 200}), 200
     else:
         return jsonify({"message": "Internal Server Error", "code": 500})
@@ -508,7 +1212,10 @@ def delete_package_version(namespace_name, package_name, version):
     if not uuid:
         return jsonify({"status": "error", "message": "Unauthorized", "code": 401}), 401
 
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
+
+    if not user:
+        return jsonify({"status": "error", "message": "Unauthorized", "code": 401}), 401
 
     # Check if the user is authorized to delete the package.
     if not "admin" in user["roles"]:
@@ -530,13 +1237,27 @@ def delete_package_version(namespace_name, package_name, version):
     if not namespace:
         return jsonify({"message": "Namespace does not found", "code": 404})
 
-    # Perform the pull operation.
-    result = db.packages.update_one(
+    # Perform the pull operation, getting the removed version back.
+    package = db.packages.find_one_and_update(
         {"name": package_name, "namespace": namespace["_id"]},
         {"$pull": {"versions": {"version": version}}},
+        projection={"name": 1, "tags": 1, "isDeprecated": 1, "versions": {"$elemMatch": {"version": version}}},
     )
 
-    if result.matched_count:
+    if package:
+        for version_data in package.get("versions", []):
+            if version_data.get("digest"):
+                release_tarball(version_data["digest"])
+
+        # Deleting the latest version restores the metadata of the previous one.
+        updated_package = refresh_latest_version(package["_id"])
+        if updated_package and not package["isDeprecated"] and updated_package.get("tags") != package.get("tags"):
+            unindex_package(package, namespace_name)
+            index_package(updated_package, namespace_name)
+
+        invalidate_search_cache()
+        resolution_cache.invalidate(namespace_name, package_name)
+        remove_dependents(package["_id"], version)
         return jsonify({"message": "Package version deleted successfully"}), 200
     else:
         return jsonify({"status": "error", "message": "Package version not found", "code": 404}), 404
@@ -545,10 +1266,25 @@ def delete_package_version(namespace_name, package_name, version):
 @app.route("/packages/list", methods=["GET"])
 def get_packages():
     page = int(request.args.get("page", 0))
+    cursor = request.args.get("cursor")
+    packages_per_page = 10
+
+    # Packages are listed in _id order, so a cursor only needs the last _id.
+    if cursor:
+        try:
+            _, last_id = decode_cursor("_id", cursor)
+        except ValueError:
+            return jsonify({"message": "Invalid cursor", "code": 400}), 400
+        packages = db.packages.find({"_id": {"$gt": last_id}})
+    else:
+        packages = db.packages.find().skip(page * packages_per_page)
 
-    packages = db.packages.find().limit(10).skip(page * 10)
+    packages = packages.sort("_id", 1).limit(packages_per_page)
     response_packages = []
+    last_id = None
     for package in packages:
+        last_id = package["_id"]
+
         # Get the namespace id of the package.
         namespace_id = package["namespace"]
 
@@ -567,15 +1303,12 @@ def get_packages():
             }
         )
 
-    return jsonify({"packages": response_packages})
+    next_cursor = None
+    if len(response_packages) == packages_per_page:
+        next_cursor = encode_cursor("_id", [last_id, last_id])
 
+    return jsonify({"packages": response_packages, "next_cursor": next_cursor})
 
-def sort_versions(versions):
-    """
-    Sorts the list of version in the reverse order. Such that the latest version comes at
-    0th index.
-    """
-    return sorted(versions, key=lambda x: [int(i) for i in x.split(".")], reverse=True)
 
 # This function checks if user is authorized to upload/update a package in a namespace.
 def checkUserUnauthorized(user_id, package_namespace):
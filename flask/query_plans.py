@@ -0,0 +1,181 @@
+import os
+import threading
+from pymongo import monitoring
+
+# Record the queries sent to MongoDB so that their plans can be checked, see base_case.py.
+CHECK_QUERY_PLANS = os.getenv("CHECK_QUERY_PLANS", "").lower() in ("1", "true", "yes")
+
+# Queries expected to read most of a collection, by collection and filtered fields.
+ALLOWED_SCANS = {
+    # The suggestions are loaded from every package which is not deprecated, see search.py.
+    ("packages", ("isDeprecated",)),
+}
+
+# Fields added to commands by the driver, which explain does not accept.
+DRIVER_FIELDS = ("lsid", "txnNumber", "$db", "$clusterTime", "$readPreference", "readConcern", "writeConcern")
+
+
+def lookup_queries(pipeline):
+    """
+    Function to get the queries made by the $lookup and $unionWith stages of a pipeline.
+
+    A $lookup reads the foreign collection once per document, by its foreign
+    field, which is explained as a find on that field. A $lookup or $unionWith
+    with a pipeline is explained as an aggregation of its pipeline, unless the
+    pipeline uses variables of the local document, which can not be explained
+    on their own. Stages nested in $facet are included.
+
+    Parameters:
+    pipeline (list): The pipeline.
+
+    Returns:
+    list: The collection, filter and command of every query.
+    """
+    queries = []
+    for stage in pipeline:
+        if "$facet" in stage:
+            for facet in stage["$facet"].values():
+                queries += lookup_queries(facet)
+
+        lookup = stage.get("$lookup") or stage.get("$unionWith")
+        if isinstance(lookup, str):
+            lookup = {"coll": lookup}
+        if not lookup:
+            continue
+
+        collection = lookup.get("from", lookup.get("coll"))
+        if "foreignField" in lookup:
+            # The value does not change the plan of an equality on the foreign field.
+            query_filter = {lookup["foreignField"]: None}
+            queries.append((collection, query_filter, {"find": collection, "filter": query_filter}))
+        if "pipeline" in lookup and "let" not in lookup:
+            queries += aggregate_queries(collection, lookup["pipeline"])
+    return queries
+
+
+def aggregate_queries(collection, pipeline, command=None):
+    """
+    Function to get the queries made by an aggregation.
+
+    Only the $match at the start of a pipeline reads the collection. The
+    $match stages after other stages, including the ones in $facet, filter
+    documents already read, so they are not explained on their own. The
+    collections read by $lookup and $unionWith are, see lookup_queries.
+
+    Parameters:
+    collection (str): The aggregated collection.
+    pipeline (list): The pipeline.
+    command (dict): The aggregate command, built from the pipeline if None.
+
+    Returns:
+    list: The collection, filter and command of every query.
+    """
+    match = (pipeline[0].get("$match") if pipeline else None) or {}
+    command = command or {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+    return [(collection, match, command)] + lookup_queries(pipeline)
+
+
+def command_queries(command_name, command):
+    """
+    Function to get the queries made by a command sent to MongoDB.
+
+    Write batches are split into one query per statement, since they can only
+    be explained one statement at a time.
+
+    Parameters:
+    command_name (str): The name of the command.
+    command (dict): The command.
+
+    Returns:
+    list: The collection, filter and command to explain of every query, empty if
+    the command does not query a collection.
+    """
+    collection = command.get(command_name)
+    if command_name in ("find", "findAndModify"):
+        return [(collection, command.get("filter", command.get("query")) or {}, command)]
+    if command_name in ("update", "delete"):
+        batch = command_name + "s"
+        return [
+            (collection, statement.get("q") or {}, {**command, batch: [statement]})
+            for statement in command.get(batch, [])
+        ]
+    if command_name == "aggregate":
+        return aggregate_queries(collection, command.get("pipeline") or [], command)
+    return []
+
+
+def collection_scans(plan):
+    """
+    Function to find the collection scans of the winning plan of an explain output.
+
+    Parameters:
+    plan: The explain output, or a part of it.
+
+    Returns:
+    bool: True if a winning plan scans the whole collection.
+    """
+    if isinstance(plan, list):
+        return any(collection_scans(item) for item in plan)
+    if not isinstance(plan, dict):
+        return False
+    if plan.get("stage") == "COLLSCAN":
+        return True
+    # Only the winning plans are checked, rejected plans are never run.
+    return any(collection_scans(value) for key, value in plan.items() if key != "rejectedPlans")
+
+
+class QueryPlanRecorder(monitoring.CommandListener):
+    """
+    Records the queries sent to MongoDB, so that the plans chosen for them can be
+    checked for collection scans once a test has run.
+
+    Every query of a command is recorded on its own, see command_queries.
+    Queries without a filter, or listed in ALLOWED_SCANS, read the whole
+    collection on purpose and are not recorded.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        command = {key: value for key, value in event.command.items() if key not in DRIVER_FIELDS}
+
+        recorded = []
+        for collection, query_filter, query in command_queries(event.command_name, command):
+            if not query_filter or (collection, tuple(sorted(query_filter))) in ALLOWED_SCANS:
+                continue
+            recorded.append((event.database_name, query))
+
+        with self._lock:
+            self.commands.extend(recorded)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def check(self, client):
+        """
+        Function to explain the recorded queries, and forget them.
+
+        Parameters:
+        client (MongoClient): The client to explain the queries with.
+
+        Returns:
+        list: The queries whose plan scans a whole collection.
+        """
+        with self._lock:
+            commands, self.commands = self.commands, []
+
+        scans = []
+        for database_name, command in commands:
+            # Explaining is not recorded, the explain command has no filter of its own.
+            plan = client[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+            if collection_scans(plan.get("queryPlanner", plan)):
+                scans.append(command)
+        return scans
+
+
+query_plan_recorder = QueryPlanRecorder()
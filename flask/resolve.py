@@ -0,0 +1,267 @@
+import os
+import threading
+import semantic_version
+from mongo import db
+from cache import TTLCache
+
+
+def parse_requirement(requirement):
+    """
+    Function to parse the version requirement of a dependency.
+
+    Requirements use the npm syntax (`^0.2`, `~1.0.1`, `>=1.0 <2.0`, `0.3.0`),
+    a missing requirement or `*` accepts any version.
+
+    Parameters:
+    requirement (str): The version requirement.
+
+    Returns:
+    NpmSpec: The parsed requirement, or None if it is not valid.
+    """
+    try:
+        return semantic_version.NpmSpec(requirement or "*")
+    except ValueError:
+        return None
+
+
+def parse_version(version):
+    try:
+        return semantic_version.Version(version)
+    except ValueError:
+        return None
+
+
+def registry_dependencies(version):
+    # Versions uploaded before the manifest was read have no dependency list.
+    dependencies = version.get("dependencies")
+    return dependencies if isinstance(dependencies, list) else []
+
+
+class Resolver:
+    """
+    Resolves the dependency closure of a package version from the dependencies
+    stored on the version documents.
+
+    Every package of the closure is resolved to a single version: the highest
+    version which is not deprecated and satisfies the requirements of all the
+    versions depending on it. Requirements are collected until the resolution
+    no longer changes, so a requirement found deep in the closure also
+    constrains the versions selected before it was found.
+    """
+
+    def __init__(self):
+        self._packages = {}
+
+    def find_package(self, namespace_name, package_name):
+        key = (namespace_name, package_name)
+        if key not in self._packages:
+            namespace = db.namespaces.find_one({"namespace": namespace_name}, {"_id": 1})
+            self._packages[key] = namespace and db.packages.find_one(
+                {"name": package_name, "namespace": namespace["_id"]},
+                {"versions.version": 1, "versions.dependencies": 1, "versions.isDeprecated": 1,
+                 "versions.tarball": 1, "versions.download_url": 1, "versions.digest": 1},
+            )
+        return self._packages[key]
+
+    def select_version(self, package, requirements):
+        candidates = []
+        for version in package["versions"]:
+            parsed = parse_version(version["version"])
+            if parsed and not version.get("isDeprecated") and all(parsed in spec for spec in requirements):
+                candidates.append((parsed, version))
+        return max(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+    def walk(self, root, constraints):
+        resolved = {}
+        external = []
+        unresolved = []
+        changed = False
+
+        queue = [root]
+        while queue:
+            namespace_name, package_name, version = queue.pop(0)
+            required_by = "{}/{}@{}".format(namespace_name, package_name, version["version"])
+
+            for dependency in registry_dependencies(version):
+                if dependency.get("git") or dependency.get("path"):
+                    external.append({**dependency, "required_by": required_by})
+                    continue
+
+                unresolved_dependency = {
+                    "namespace": dependency.get("namespace"),
+                    "name": dependency["name"],
+                    "requirement": dependency.get("requirement"),
+                    "required_by": required_by,
+                }
+
+                spec = parse_requirement(dependency.get("requirement"))
+                if not dependency.get("namespace") or spec is None:
+                    unresolved.append({**unresolved_dependency, "reason": "Invalid dependency"})
+                    continue
+
+                key = (dependency["namespace"], dependency["name"])
+                if dependency.get("requirement") not in constraints.setdefault(key, {}):
+                    constraints[key][dependency.get("requirement")] = spec
+                    changed = True
+
+                package = self.find_package(*key)
+                if not package:
+                    unresolved.append({**unresolved_dependency, "reason": "Package not found"})
+                    continue
+
+                selected = self.select_version(package, constraints[key].values())
+                if not selected:
+                    unresolved.append({**unresolved_dependency, "reason": "No version satisfies the requirements"})
+                    continue
+
+                if key not in resolved:
+                    resolved[key] = selected
+                    queue.append((key[0], key[1], selected))
+
+        return resolved, external, unresolved, changed
+
+    def resolve(self, namespace_name, package_name, version):
+        """
+        Function to resolve the dependency closure of a package version.
+
+        Parameters:
+        namespace_name (str): The namespace of the package.
+        package_name (str): The name of the package.
+        version (dict): The version document.
+
+        Returns:
+        tuple: The resolution, and the requirements on every package of the closure.
+        """
+        constraints = {}
+        while True:
+            resolved, external, unresolved, changed = self.walk(
+                (namespace_name, package_name, version), constraints
+            )
+            if not changed:
+                break
+
+        dependencies = []
+        for (dependency_namespace, dependency_name), selected in sorted(resolved.items()):
+            dependencies.append(
+                {
+                    "namespace": dependency_namespace,
+                    "name": dependency_name,
+                    "version": selected["version"],
+                    "tarball": selected.get("tarball"),
+                    "download_url": selected.get("download_url"),
+                    "digest": selected.get("digest"),
+                    "dependencies": [
+                        {key: dependency.get(key) for key in ("namespace", "name", "requirement")}
+                        for dependency in registry_dependencies(selected)
+                        if not (dependency.get("git") or dependency.get("path"))
+                    ],
+                }
+            )
+
+        resolution = {
+            "package": {"namespace": namespace_name, "name": package_name, "version": version["version"]},
+            "dependencies": dependencies,
+            "external": external,
+            "unresolved": unresolved,
+        }
+        return resolution, constraints
+
+
+class ResolutionCache:
+    """
+    Cache of dependency resolutions per package version.
+
+    Each resolution is registered with the requirements it placed on every package
+    of its closure. A new version of a package drops the resolutions it could
+    change: those whose requirements it satisfies. Resolutions expire after
+    RESOLVE_CACHE_TTL seconds, which bounds how long versions published by
+    other server processes are missed.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.resolutions = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._dependents = {}
+        self._packages = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            resolution = self.resolutions.get(key)
+            if resolution is None:
+                # The resolution expired or was never cached.
+                self._forget(key)
+            return resolution
+
+    def set(self, key, resolution, constraints):
+        with self._lock:
+            self._forget(key)
+            for evicted in self.resolutions.set(key, resolution):
+                self._forget(evicted)
+
+            self._packages[key] = list(constraints)
+            for package_key, requirements in constraints.items():
+                self._dependents.setdefault(package_key, {})[key] = list(requirements.values())
+
+    def _forget(self, key):
+        # The requirements of a resolution are kept only while it is cached.
+        for package_key in self._packages.pop(key, ()):
+            dependents = self._dependents.get(package_key)
+            if dependents is not None:
+                dependents.pop(key, None)
+                if not dependents:
+                    del self._dependents[package_key]
+
+    def invalidate(self, namespace_name, package_name, version=None):
+        """
+        Function to drop the resolutions which may change after a package changed.
+
+        Parameters:
+        namespace_name (str): The namespace of the package.
+        package_name (str): The name of the package.
+        version (str): The published version, or None if versions were deleted
+        or deprecated, which drops every resolution depending on the package.
+        """
+        parsed = parse_version(version) if version else None
+
+        with self._lock:
+            dependents = self._dependents.get((namespace_name, package_name), {})
+            for key, requirements in list(dependents.items()):
+                if parsed is None or all(parsed in spec for spec in requirements):
+                    self._forget(key)
+                    self.resolutions.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self.resolutions.clear()
+            self._dependents.clear()
+            self._packages.clear()
+
+
+resolution_cache = ResolutionCache(
+    maxsize=int(os.getenv("RESOLVE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("RESOLVE_CACHE_TTL", 300)),
+)
+
+
+def resolve_dependencies(namespace_name, package_name, version):
+    """
+    Function to get the dependency closure of a package version, from the cache
+    when possible.
+
+    Parameters:
+    namespace_name (str): The namespace of the package.
+    package_name (str): The name of the package.
+    version (dict): The version document.
+
+    Returns:
+    dict: The resolved dependencies, the git and path dependencies, and the
+    dependencies which could not be resolved.
+    """
+    key = (namespace_name, package_name, version["version"])
+    resolution = resolution_cache.get(key)
+
+    if resolution is None:
+        resolution, constraints = Resolver().resolve(namespace_name, package_name, version)
+        resolution_cache.set(key, resolution, constraints)
+
+    return resolution
@@ -0,0 +1,548 @@
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from app import app
+from mongo import db
+
+# Splits package names on separators (`_`, `-`, `.`) and camelCase / digit
+# boundaries, so `fortran_stdlib`, `M_strings` and `FortranDocs` are all
+# searchable by their individual words.
+TOKEN_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+# Words that carry no meaning in package descriptions.
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is",
+    "it", "of", "on", "or", "that", "the", "this", "to", "with",
+}
+
+# Name tokens are also indexed by their prefixes, starting at this length,
+# so that partially typed package names still match.
+MIN_PREFIX_LENGTH = 3
+
+
+def stem(token):
+    """
+    Function to reduce a token to its stem.
+
+    Only plural suffixes are stripped. Short tokens are kept as they are, since
+    they are mostly acronyms (fpm, blas, mpi, ...), and verb suffixes are kept
+    because they are part of too many names (string, solved, ...).
+
+    Parameters:
+    token (str): The lowercase token to be stemmed.
+
+    Returns:
+    str: The stemmed token.
+    """
+    if len(token) < 5 or token.isdigit():
+        return token
+    if token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """
+    Function to split a text into normalized search tokens.
+
+    Parameters:
+    text (str): The text to be tokenized.
+
+    Returns:
+    list: The stemmed, lowercase tokens in order of appearance.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text or ""):
+        token = token.lower()
+        if len(token) < 2 or token in STOP_WORDS:
+            continue
+        tokens.append(stem(token))
+    return tokens
+
+
+def name_tokens(name):
+    """
+    Function to generate the search tokens of a package name.
+
+    Besides the words of the name, the name with its separators removed and
+    the prefixes of every word are included.
+
+    Parameters:
+    name (str): The package name.
+
+    Returns:
+    list: The unique search tokens of the name.
+    """
+    tokens = tokenize(name)
+    words = [word.lower() for word in TOKEN_PATTERN.findall(name or "")]
+    tokens.append(stem("".join(words)))
+
+    for word in words:
+        for length in range(MIN_PREFIX_LENGTH, len(word)):
+            tokens.append(word[:length])
+
+    return list(dict.fromkeys(token for token in tokens if token))
+
+
+def search_fields(name, tags, description):
+    """
+    Function to build the text indexed fields of a package document.
+
+    The fields are stored under the `search` key of the package and are covered
+    by the weighted `package_search` text index.
+
+    Parameters:
+    name (str): The package name.
+    tags (list): The package tags.
+    description (str): The package description.
+
+    Returns:
+    dict: The `search` subdocument of the package.
+    """
+    tag_tokens = []
+    for tag in tags or []:
+        tag_tokens.extend(tokenize(tag))
+
+    return {
+        "name": " ".join(name_tokens(name)),
+        "tags": " ".join(dict.fromkeys(tag_tokens)),
+        "description": " ".join(tokenize(description)),
+    }
+
+
+def text_query(query):
+    """
+    Function to convert a user query to a `$text` search string.
+
+    Parameters:
+    query (str): The query received from the user.
+
+    Returns:
+    str: The search string, empty if the query has no searchable tokens.
+    """
+    return " ".join(dict.fromkeys(tokenize(query)))
+
+
+def all_terms_query(search_string):
+    """
+    Function to build the filter requiring every term of a `$text` search string.
+
+    `$text` matches the packages containing any of the terms, so this filter is
+    applied with it to only keep the packages containing all of them, each in
+    any of the search fields. The `$text` index still selects the candidates.
+
+    Parameters:
+    search_string (str): The search string returned by text_query.
+
+    Returns:
+    dict: The filter, empty if the search string has a single term.
+    """
+    terms = search_string.split()
+    if len(terms) < 2:
+        return {}
+
+    return {
+        "$and": [
+            {
+                "$or": [
+                    {"search." + field: {"$regex": "(^| ){}( |$)".format(re.escape(term))}}
+                    for field in ("name", "tags", "description")
+                ]
+            }
+            for term in terms
+        ]
+    }
+
+
+class PrefixIndex:
+    """
+    Sorted array of terms answering prefix queries with a binary search.
+
+    Every term is stored with its kind (package, namespace or tag) and the set of
+    the entries it was added for, since the same package name can exist in many
+    namespaces and the same tag is used by many packages. Adding or removing the
+    same entry twice has the effect of doing it once.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._owners = {}
+
+    def add(self, term, kind, owner):
+        key = (term.lower(), kind, term)
+        if key not in self._owners:
+            self._owners[key] = set()
+            insort(self._keys, key)
+        self._owners[key].add(owner)
+
+    def remove(self, term, kind, owner):
+        key = (term.lower(), kind, term)
+        if key not in self._owners:
+            return
+        self._owners[key].discard(owner)
+        if not self._owners[key]:
+            del self._owners[key]
+            del self._keys[bisect_left(self._keys, key)]
+
+    def search(self, prefix, limit):
+        """
+        Function to get the terms starting with a prefix.
+
+        Parameters:
+        prefix (str): The case insensitive prefix.
+        limit (int): The maximum number of terms returned.
+
+        Returns:
+        list: The matching terms in alphabetical order, with their kind.
+        """
+        prefix = prefix.lower()
+        suggestions = []
+        for key in self._keys[bisect_left(self._keys, (prefix,)):]:
+            if len(suggestions) == limit or not key[0].startswith(prefix):
+                break
+            suggestions.append({"value": key[2], "type": key[1]})
+        return suggestions
+
+
+def trigrams(term):
+    """
+    Function to split a term into its trigrams.
+
+    The term is padded with two spaces at the start and one at the end, so that
+    the first letters of a term weigh more than the others.
+
+    Parameters:
+    term (str): The lowercase term.
+
+    Returns:
+    set: The trigrams of the term.
+    """
+    padded = "  {} ".format(term)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def fuzzy_terms(name):
+    """
+    Function to get the terms of a package or namespace name indexed for fuzzy search.
+
+    Parameters:
+    name (str): The package or namespace name.
+
+    Returns:
+    set: The lowercase name and its words of at least three characters.
+    """
+    words = [word.lower() for word in TOKEN_PATTERN.findall(name)]
+    return {name.lower()} | {word for word in words if len(word) >= 3}
+
+
+class TrigramIndex:
+    """
+    Inverted index from trigrams to terms, answering typo tolerant queries ranked
+    by trigram similarity. Each term maps to the ids of the packages it belongs to.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._packages = {}
+        self._sizes = {}
+
+    def add(self, term, package_id):
+        if term not in self._packages:
+            term_trigrams = trigrams(term)
+            for trigram in term_trigrams:
+                self._postings.setdefault(trigram, set()).add(term)
+            self._packages[term] = set()
+            self._sizes[term] = len(term_trigrams)
+        self._packages[term].add(package_id)
+
+    def remove(self, term, package_id):
+        if term not in self._packages:
+            return
+        self._packages[term].discard(package_id)
+        if not self._packages[term]:
+            for trigram in trigrams(term):
+                self._postings[trigram].discard(term)
+                if not self._postings[trigram]:
+                    del self._postings[trigram]
+            del self._packages[term]
+            del self._sizes[term]
+
+    def search(self, query, threshold, limit):
+        """
+        Function to get the packages with a term similar to the query.
+
+        The similarity of two terms is the number of trigrams they share divided by
+        the number of distinct trigrams of both terms. Only the terms sharing at least
+        one trigram with the query are visited.
+
+        Parameters:
+        query (str): The lowercase query.
+        threshold (float): The minimum similarity of a match.
+        limit (int): The maximum number of packages returned.
+
+        Returns:
+        list: The ids of the matching packages, most similar first.
+        """
+        query_trigrams = trigrams(query)
+        overlaps = Counter()
+        for trigram in query_trigrams:
+            overlaps.update(self._postings.get(trigram, ()))
+
+        similarities = {}
+        for term, overlap in overlaps.items():
+            similarity = overlap / (len(query_trigrams) + self._sizes[term] - overlap)
+            if similarity < threshold:
+                continue
+            for package_id in self._packages[term]:
+                similarities[package_id] = max(similarity, similarities.get(package_id, 0))
+
+        return sorted(similarities, key=similarities.get, reverse=True)[:limit]
+
+
+# Minimum trigram similarity of a fuzzy search match.
+FUZZY_THRESHOLD = 0.4
+
+# In-memory indexes of the package and namespace names, loaded from the database
+# on first use. They are updated in place on every write made by this process and
+# rebuilt every SEARCH_INDEX_REFRESH seconds to pick up writes of other processes.
+suggestion_index = PrefixIndex()
+fuzzy_index = TrigramIndex()
+index_refresh = float(os.getenv("SEARCH_INDEX_REFRESH", 300))
+index_loaded_at = None
+
+# Held while the indexes are read or written. Rebuilding the indexes is done
+# without it, and only takes it to replace them.
+index_lock = threading.Lock()
+
+# Held while the indexes are rebuilt, so a single rebuild runs at a time.
+refresh_lock = threading.Lock()
+
+# Writes made while the indexes are rebuilt, replayed on the rebuilt indexes,
+# or None if no rebuild is running.
+index_writes = None
+
+
+def build_indexes():
+    """
+    Function to build the in-memory indexes from the database.
+
+    Returns:
+    tuple: The suggestion index and the fuzzy search index.
+    """
+    suggestions = PrefixIndex()
+    fuzzy = TrigramIndex()
+    namespace_names = {}
+    for namespace in db.namespaces.find({}, {"namespace": 1}):
+        namespace_names[namespace["_id"]] = namespace["namespace"]
+        suggestions.add(namespace["namespace"], "namespace", namespace["namespace"])
+
+    packages = db.packages.find(
+        {"isDeprecated": False}, {"name": 1, "namespace": 1, "tags": 1}
+    )
+    for package in packages:
+        suggestions.add(package["name"], "package", package["_id"])
+        for tag in package.get("tags") or []:
+            suggestions.add(tag, "tag", package["_id"])
+
+        namespace_name = namespace_names.get(package["namespace"], "")
+        for term in fuzzy_terms(package["name"]) | fuzzy_terms(namespace_name):
+            fuzzy.add(term, package["_id"])
+
+    return suggestions, fuzzy
+
+
+def refresh_indexes():
+    """
+    Function to rebuild the in-memory indexes and replace the current ones.
+
+    The caller holds refresh_lock.
+    """
+    global suggestion_index, fuzzy_index, index_loaded_at, index_writes
+
+    with index_lock:
+        index_writes = []
+
+    try:
+        suggestions, fuzzy = build_indexes()
+    except BaseException:
+        with index_lock:
+            index_writes = None
+        raise
+
+    with index_lock:
+        # The rebuild may have read some of these writes from the database already,
+        # the entries of the indexes are sets, so they are not applied twice.
+        for write in index_writes:
+            write(suggestions, fuzzy)
+        suggestion_index = suggestions
+        fuzzy_index = fuzzy
+        index_writes = None
+        index_loaded_at = time.monotonic()
+
+
+def refresh_indexes_in_background():
+    try:
+        refresh_indexes()
+    except Exception:
+        # The current indexes are kept, and rebuilt again on the next use.
+        app.logger.exception("Failed to refresh the search indexes")
+    finally:
+        refresh_lock.release()
+
+
+def load_indexes():
+    """
+    Function to make sure the in-memory indexes are loaded.
+
+    Only the first call of a process waits for the indexes to be built. Indexes
+    older than SEARCH_INDEX_REFRESH seconds are rebuilt by a background thread,
+    and used until the rebuilt ones replace them.
+    """
+    with index_lock:
+        loaded_at = index_loaded_at
+
+    if loaded_at is None:
+        with refresh_lock:
+            with index_lock:
+                loaded = index_loaded_at is not None
+            if not loaded:
+                refresh_indexes()
+        return
+
+    if time.monotonic() - loaded_at >= index_refresh and refresh_lock.acquire(blocking=False):
+        threading.Thread(target=refresh_indexes_in_background, daemon=True).start()
+
+
+def reset_indexes():
+    """
+    Function to drop the in-memory indexes, so they are reloaded on next use.
+    """
+    global index_loaded_at
+
+    with index_lock:
+        index_loaded_at = None
+
+
+def write_indexes(write):
+    """
+    Function to apply a write to the in-memory indexes.
+
+    Parameters:
+    write: A function updating the suggestion index and fuzzy search index it is given.
+    """
+    with index_lock:
+        if index_writes is not None:
+            index_writes.append(write)
+
+        # Packages written before the indexes are loaded are read by load_indexes.
+        if index_loaded_at is not None:
+            write(suggestion_index, fuzzy_index)
+
+
+def index_package(package, namespace_name):
+    """
+    Function to add a package to the in-memory indexes.
+
+    Parameters:
+    package (dict): The package document.
+    namespace_name (str): The name of the namespace of the package.
+    """
+    def write(suggestions, fuzzy):
+        suggestions.add(package["name"], "package", package["_id"])
+        for tag in package.get("tags") or []:
+            suggestions.add(tag, "tag", package["_id"])
+        for term in fuzzy_terms(package["name"]) | fuzzy_terms(namespace_name):
+            fuzzy.add(term, package["_id"])
+
+    write_indexes(write)
+
+
+def unindex_package(package, namespace_name):
+    """
+    Function to remove a package from the in-memory indexes.
+
+    Parameters:
+    package (dict): The package document.
+    namespace_name (str): The name of the namespace of the package.
+    """
+    def write(suggestions, fuzzy):
+        suggestions.remove(package["name"], "package", package["_id"])
+        for tag in package.get("tags") or []:
+            suggestions.remove(tag, "tag", package["_id"])
+        for term in fuzzy_terms(package["name"]) | fuzzy_terms(namespace_name):
+            fuzzy.remove(term, package["_id"])
+
+    write_indexes(write)
+
+
+def index_namespace(namespace_name):
+    """
+    Function to add a namespace to the in-memory indexes.
+
+    Parameters:
+    namespace_name (str): The name of the namespace.
+    """
+    write_indexes(lambda suggestions, fuzzy: suggestions.add(namespace_name, "namespace", namespace_name))
+
+
+def unindex_namespace(namespace_name):
+    """
+    Function to remove a namespace from the in-memory indexes.
+
+    Parameters:
+    namespace_name (str): The name of the namespace.
+    """
+    write_indexes(lambda suggestions, fuzzy: suggestions.remove(namespace_name, "namespace", namespace_name))
+
+
+def suggest(prefix, limit):
+    """
+    Function to get the package names, namespaces and tags starting with a prefix.
+
+    Parameters:
+    prefix (str): The prefix typed by the user.
+    limit (int): The maximum number of suggestions.
+
+    Returns:
+    list: The suggestions, with their type.
+    """
+    load_indexes()
+    with index_lock:
+        return suggestion_index.search(prefix, limit)
+
+
+def fuzzy_search(query, limit):
+    """
+    Function to get the packages whose name or namespace name is similar to the query.
+
+    Parameters:
+    query (str): The query received from the user.
+    limit (int): The maximum number of packages.
+
+    Returns:
+    list: The ids of the packages, most similar first.
+    """
+    load_indexes()
+    with index_lock:
+        return fuzzy_index.search(query.lower(), FUZZY_THRESHOLD, limit)
+
+
+@app.cli.command("reindex-packages")
+def reindex_packages():
+    """Rebuild the search fields of every package."""
+    for package in db.packages.find({}, {"name": 1, "tags": 1, "description": 1}):
+        db.packages.update_one(
+            {"_id": package["_id"]},
+            {
+                "$set": {
+                    "search": search_fields(
+                        package["name"], package.get("tags"), package.get("description")
+                    )
+                }
+            },
+        )
@@ -6,16 +6,33 @@ import auth
 import user
 import packages
 import namespaces
+import upload_sessions
 import validate_package
+import uploads
 
 @app.route("/")
 def index():
     return jsonify({"message": "Python flask mongo", "code": 200})
 
+@app.route("/metrics")
+def metrics():
+    return jsonify({
+        "search_cache": packages.search_cache.stats(),
+        "pending_downloads": packages.download_counter.pending(),
+        "code": 200,
+    })
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template("404.html")
 
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return jsonify({
+        "code": 413,
+        "message": "Package exceeds the maximum size of {} bytes".format(uploads.MAX_PACKAGE_SIZE),
+    }), 413
+
 @app.errorhandler(500)
 def internal_server_error(e):
     return render_template("500.html")
@@ -0,0 +1,193 @@
+import os
+import secrets
+from datetime import datetime, timedelta
+from app import app
+from mongo import db
+from cache import TTLCache
+from upload_tokens import hash_token
+
+# Sessions expire after this number of days.
+SESSION_TTL_DAYS = int(os.getenv("SESSION_TTL_DAYS", 30))
+
+# Verified sessions are cached by each server process for this number of seconds,
+# with their user. A session deleted, or a user changed, by another process stays
+# as it was here for at most this time.
+session_cache = TTLCache(
+    maxsize=int(os.getenv("SESSION_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("SESSION_CACHE_TTL", 30)),
+)
+
+# The fields of the user cached with a session, the ones read by the routes.
+SESSION_USER_FIELDS = {
+    "username": 1,
+    "email": 1,
+    "password": 1,
+    "roles": 1,
+    "createdAt": 1,
+    "loginAt": 1,
+    "lastLogout": 1,
+}
+
+
+def create_session(user_id):
+    """
+    Function to open a session for a user.
+
+    A user may have several sessions at once, one per login.
+
+    Parameters:
+    user_id (ObjectId): The id of the user.
+
+    Returns:
+    str: The session token, sent by the client as `uuid`. Only its hash is stored.
+    """
+    token = secrets.token_hex(16)
+    db.sessions.insert_one(
+        {
+            "_id": hash_token(token),
+            "user": user_id,
+            "createdAt": datetime.utcnow(),
+            "expiresAt": datetime.utcnow() + timedelta(days=SESSION_TTL_DAYS),
+        }
+    )
+    return token
+
+
+def find_cached_session(token):
+    """
+    Function to get a session which is not expired and its user, from the cache when possible.
+
+    Parameters:
+    token (str): The session token.
+
+    Returns:
+    dict: The cache entry, with the `session` and its `user`, or None if the token is unknown or expired.
+    """
+    if not token:
+        return None
+
+    token_hash = hash_token(token)
+    entry = session_cache.get(token_hash)
+
+    if entry is None:
+        # The session is read with its user in a single query, both by their _id.
+        sessions = list(
+            db.sessions.aggregate(
+                [
+                    {"$match": {"_id": token_hash}},
+                    {"$lookup": {"from": "users", "localField": "user", "foreignField": "_id", "as": "users"}},
+                    {
+                        "$project": {
+                            "user": 1,
+                            "createdAt": 1,
+                            "expiresAt": 1,
+                            "users._id": 1,
+                            **{"users." + field: 1 for field in SESSION_USER_FIELDS},
+                        }
+                    },
+                ]
+            )
+        )
+        if not sessions:
+            return None
+        session = sessions[0]
+        users = session.pop("users")
+        entry = {"session": session, "user": users[0] if users else None}
+        session_cache.set(token_hash, entry)
+
+    # Expired sessions are deleted by the TTL index, but only once a minute.
+    if entry["session"]["expiresAt"] <= datetime.utcnow():
+        return None
+
+    return entry
+
+
+def find_session(token):
+    """
+    Function to get a session which is not expired, from the cache when possible.
+
+    Parameters:
+    token (str): The session token.
+
+    Returns:
+    dict: The session, or None if the token is unknown or expired.
+    """
+    entry = find_cached_session(token)
+    return entry and entry["session"]
+
+
+def get_session_user(token):
+    """
+    Function to get the user of a session, from the cache when possible.
+
+    Parameters:
+    token (str): The session token.
+
+    Returns:
+    dict: The fields of the user in SESSION_USER_FIELDS, or None if the session is not valid.
+    """
+    entry = find_cached_session(token)
+    return entry and entry["user"]
+
+
+def forget_session_users(user_id):
+    """
+    Function to drop the cached sessions of a user, so that its changes are read again.
+
+    Only the cache of this process is cleared, the other processes read the
+    changes once their entries expire.
+
+    Parameters:
+    user_id (ObjectId): The id of the user.
+    """
+    for session in db.sessions.find({"user": user_id}, {"_id": 1}):
+        session_cache.delete(session["_id"])
+
+
+def delete_session(token):
+    """
+    Function to close a session.
+
+    Parameters:
+    token (str): The session token.
+
+    Returns:
+    bool: True if the session existed.
+    """
+    token_hash = hash_token(token)
+    session_cache.delete(token_hash)
+    return db.sessions.delete_one({"_id": token_hash}).deleted_count > 0
+
+
+def delete_user_sessions(user_id):
+    """
+    Function to close all the sessions of a user.
+
+    Parameters:
+    user_id (ObjectId): The id of the user.
+    """
+    forget_session_users(user_id)
+    db.sessions.delete_many({"user": user_id})
+
+
+@app.cli.command("migrate-sessions")
+def migrate_sessions():
+    """Move the session uuids stored on the users to the sessions collection."""
+    migrated = 0
+    for user in db.users.find({"uuid": {"$exists": True}}, {"uuid": 1}):
+        if user["uuid"]:
+            db.sessions.update_one(
+                {"_id": hash_token(user["uuid"])},
+                {
+                    "$setOnInsert": {
+                        "user": user["_id"],
+                        "createdAt": datetime.utcnow(),
+                        "expiresAt": datetime.utcnow() + timedelta(days=SESSION_TTL_DAYS),
+                    }
+                },
+                upsert=True,
+            )
+            migrated += 1
+        db.users.update_one({"_id": user["_id"]}, {"$unset": {"uuid": "", "loggedCount": ""}})
+
+    print("Migrated {} sessions.".format(migrated))
@@ -0,0 +1,195 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import request, jsonify
+from app import app
+from mongo import db
+from uploads import HashingSpooledFile, MAX_PACKAGE_SIZE, UPLOAD_SPOOL_SIZE
+from blobs import store_upload_chunk, open_upload_chunk, delete_upload_chunks
+from packages import check_upload, publish_package
+from upload_tokens import hash_token
+
+# Maximum size of a chunk of a resumable upload, in bytes.
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+
+# Upload sessions not finalized within this time are deleted with their chunks.
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+
+
+def request_upload_token():
+    """
+    Function to get the upload token sent with a request.
+
+    The token is sent in an `Authorization: Bearer` header, or in the form body.
+    It is never read from the URL, which ends up in access logs and proxies.
+
+    Returns:
+    str: The upload token, or None if the request has none.
+    """
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token.strip():
+        return token.strip()
+    return request.form.get("upload_token")
+
+
+def find_upload_session(upload_id, upload_token):
+    """
+    Function to get an upload session which is not expired.
+
+    Parameters:
+    upload_id (str): The id of the upload session.
+    upload_token (str): The upload token the session was created with.
+
+    Returns:
+    dict: The upload session, or None if there is no such session for this token.
+    """
+    try:
+        upload_id = ObjectId(upload_id)
+    except InvalidId:
+        return None
+
+    return db.upload_sessions.find_one(
+        {"_id": upload_id, "upload_token": hash_token(upload_token or ""), "expiresAt": {"$gt": datetime.utcnow()}}
+    )
+
+
+@app.route("/uploads", methods=["POST"])
+def create_upload_session():
+    upload_token = request_upload_token()
+    package_name = request.form.get("package_name")
+    package_version = request.form.get("package_version")
+    package_license = request.form.get("package_license")
+
+    # Refuse the upload before any chunk is sent, the checks are run again on finalize.
+    error, _ = check_upload(upload_token, package_name, package_version, package_license)
+    if error is not None:
+        return error
+
+    upload_session = {
+        # Only the hash of the token is stored, it is sent again with every request.
+        "upload_token": hash_token(upload_token),
+        "package_name": package_name,
+        "package_version": package_version,
+        "package_license": package_license,
+        "chunks": {},
+        "createdAt": datetime.utcnow(),
+        "expiresAt": datetime.utcnow() + timedelta(seconds=UPLOAD_SESSION_TTL),
+    }
+    upload_id = db.upload_sessions.insert_one(upload_session).inserted_id
+
+    return jsonify({
+        "code": 200,
+        "upload_id": str(upload_id),
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "expires_at": upload_session["expiresAt"],
+    }), 200
+
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def get_upload_session(upload_id):
+    upload_session = find_upload_session(upload_id, request_upload_token())
+
+    if not upload_session:
+        return jsonify({"code": 404, "message": "Upload session not found"}), 404
+
+    # The client resends the chunks missing from this list.
+    chunks = sorted(
+        ({"index": int(index), "size": size} for index, size in upload_session["chunks"].items()),
+        key=lambda chunk: chunk["index"],
+    )
+
+    return jsonify({"code": 200, "chunks": chunks, "expires_at": upload_session["expiresAt"]}), 200
+
+
+@app.route("/uploads/<upload_id>/chunks/<int:index>", methods=["PUT"])
+def upload_chunk(upload_id, index):
+    upload_session = find_upload_session(upload_id, request_upload_token())
+
+    if not upload_session:
+        return jsonify({"code": 404, "message": "Upload session not found"}), 404
+
+    if index > MAX_PACKAGE_SIZE // UPLOAD_CHUNK_SIZE:
+        return jsonify({"code": 400, "message": "Chunk number is out of range"}), 400
+
+    if request.content_length is not None and request.content_length > UPLOAD_CHUNK_SIZE:
+        return jsonify({"code": 413, "message": "Chunk exceeds the chunk size"}), 413
+
+    # The chunk is spooled to disk above UPLOAD_SPOOL_SIZE, like uploaded files.
+    chunk = HashingSpooledFile(max_size=UPLOAD_SPOOL_SIZE)
+    shutil.copyfileobj(request.stream, chunk)
+
+    if chunk.size > UPLOAD_CHUNK_SIZE:
+        return jsonify({"code": 413, "message": "Chunk exceeds the chunk size"}), 413
+
+    chunk.seek(0)
+    store_upload_chunk(upload_session["_id"], index, chunk)
+
+    db.upload_sessions.update_one(
+        {"_id": upload_session["_id"]}, {"$set": {"chunks.{}".format(index): chunk.size}}
+    )
+
+    return jsonify({"code": 200, "index": index, "size": chunk.size, "digest": chunk.hexdigest()}), 200
+
+
+@app.route("/uploads/<upload_id>/finalize", methods=["POST"])
+def finalize_upload_session(upload_id):
+    upload_token = request_upload_token()
+    digest = request.form.get("digest")
+
+    upload_session = find_upload_session(upload_id, upload_token)
+
+    if not upload_session:
+        return jsonify({"code": 404, "message": "Upload session not found"}), 404
+
+    if not digest:
+        return jsonify({"code": 400, "message": "Digest is missing"}), 400
+
+    # The chunks must be numbered from 0 without gaps.
+    indexes = sorted(int(index) for index in upload_session["chunks"])
+    missing = sorted(set(range(indexes[-1] + 1 if indexes else 1)) - set(indexes))
+    if missing:
+        return jsonify({"code": 400, "message": "Chunks are missing", "missing": missing}), 400
+
+    # The version, license and authorization may have changed since the session was created.
+    error, package_upload = check_upload(
+        upload_token,
+        upload_session["package_name"],
+        upload_session["package_version"],
+        upload_session["package_license"],
+    )
+    if error is not None:
+        return error
+
+    # Join the chunks, hashing and size checking the tarball as for a single upload.
+    tarball = HashingSpooledFile(max_size=UPLOAD_SPOOL_SIZE)
+    for index in indexes:
+        with open_upload_chunk(upload_session["_id"], index) as chunk:
+            shutil.copyfileobj(chunk, tarball)
+
+    if tarball.hexdigest() != digest.lower():
+        return jsonify({"code": 400, "message": "Digest does not match the uploaded chunks"}), 400
+
+    tarball.seek(0)
+    response = publish_package(package_upload, tarball, digest.lower())
+
+    db.upload_sessions.delete_one({"_id": upload_session["_id"]})
+    delete_upload_chunks(upload_session["_id"], indexes)
+
+    return response
+
+
+def expire_upload_sessions():
+    """
+    Function to delete the expired upload sessions and their chunks.
+    """
+    for upload_session in db.upload_sessions.find({"expiresAt": {"$lte": datetime.utcnow()}}):
+        delete_upload_chunks(upload_session["_id"], [int(index) for index in upload_session["chunks"]])
+        db.upload_sessions.delete_one({"_id": upload_session["_id"]})
+
+
+@app.cli.command("expire-upload-sessions")
+def expire_upload_sessions_command():
+    """Delete the expired upload sessions and their chunks."""
+    expire_upload_sessions()
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import secrets
+from datetime import datetime, timedelta
+from app import app
+from mongo import db
+
+# Upload tokens expire after this number of days, unless another validity is requested.
+UPLOAD_TOKEN_TTL_DAYS = int(os.getenv("UPLOAD_TOKEN_TTL_DAYS", 365))
+
+
+def hash_token(token):
+    """
+    Function to hash an upload token.
+
+    Only the hash of a token is stored, and tokens are looked up by their hash.
+    Tokens are random, so a fast unsalted hash is enough to make a leaked
+    collection unusable.
+
+    Parameters:
+    token (str): The upload token.
+
+    Returns:
+    str: The hexadecimal SHA-256 digest of the token.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_upload_token(namespace_id, user_id, packages=None, expires_in_days=UPLOAD_TOKEN_TTL_DAYS):
+    """
+    Function to create an upload token for a namespace.
+
+    Parameters:
+    namespace_id (ObjectId): The id of the namespace the token uploads to.
+    user_id (ObjectId): The id of the user creating the token.
+    packages (list): The names of the packages the token may publish, all the
+    packages of the namespace if empty.
+    expires_in_days (int): The validity of the token in days.
+
+    Returns:
+    str: The upload token, which is not stored and can not be recovered.
+    """
+    token = secrets.token_hex(16)
+    db.upload_tokens.insert_one(
+        {
+            "_id": hash_token(token),
+            "namespace": namespace_id,
+            "createdBy": user_id,
+            "createdAt": datetime.utcnow(),
+            "expiresAt": datetime.utcnow() + timedelta(days=expires_in_days),
+            "scopes": packages or ["*"],
+        }
+    )
+    return token
+
+
+def find_upload_token(token):
+    """
+    Function to get an upload token which is not expired.
+
+    Parameters:
+    token (str): The upload token.
+
+    Returns:
+    dict: The upload token document, or None if the token is unknown or expired.
+    """
+    # Expired tokens are deleted by the TTL index, but only once a minute.
+    return db.upload_tokens.find_one(
+        {
+            "_id": hash_token(token),
+            "$or": [{"expiresAt": None}, {"expiresAt": {"$gt": datetime.utcnow()}}],
+        }
+    )
+
+
+def token_allows(token_doc, package_name):
+    """
+    Function to check whether an upload token may publish a package.
+
+    Parameters:
+    token_doc (dict): The upload token document.
+    package_name (str): The name of the package.
+
+    Returns:
+    bool: True if the package is in the scopes of the token.
+    """
+    scopes = token_doc.get("scopes") or ["*"]
+    return "*" in scopes or package_name in scopes
+
+
+@app.cli.command("migrate-upload-tokens")
+def migrate_upload_tokens():
+    """Move the upload tokens embedded in the namespaces to the upload_tokens collection."""
+    migrated = 0
+    for namespace in db.namespaces.find({"upload_tokens": {"$exists": True}}, {"upload_tokens": 1}):
+        for upload_token in namespace["upload_tokens"]:
+            # Tokens created before the collection existed do not expire.
+            db.upload_tokens.update_one(
+                {"_id": hash_token(upload_token["token"])},
+                {
+                    "$setOnInsert": {
+                        "namespace": namespace["_id"],
+                        "createdBy": upload_token["createdBy"],
+                        "createdAt": upload_token["createdAt"],
+                        "expiresAt": None,
+                        "scopes": ["*"],
+                    }
+                },
+                upsert=True,
+            )
+            migrated += 1
+        db.namespaces.update_one({"_id": namespace["_id"]}, {"$unset": {"upload_tokens": ""}})
+
+    print("Migrated {} upload tokens.".format(migrated))
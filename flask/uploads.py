@@ -0,0 +1,53 @@
+import hashlib
+import os
+from tempfile import SpooledTemporaryFile
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Maximum size of a package tarball, in bytes.
+MAX_PACKAGE_SIZE = int(os.getenv("MAX_PACKAGE_SIZE", 50 * 1024 * 1024))
+
+# Uploaded files are kept in memory up to this size, and spooled to disk above it.
+UPLOAD_SPOOL_SIZE = int(os.getenv("UPLOAD_SPOOL_SIZE", 1024 * 1024))
+
+# Room left in a request for the form fields besides the tarball.
+MAX_FORM_OVERHEAD = 64 * 1024
+
+
+class HashingSpooledFile(SpooledTemporaryFile):
+    """
+    Temporary file receiving an uploaded file, which computes the SHA-256 digest
+    and the size of the file while it is written, and refuses files larger than
+    MAX_PACKAGE_SIZE.
+    """
+
+    def __init__(self, max_size):
+        super().__init__(max_size=max_size)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_PACKAGE_SIZE:
+            raise RequestEntityTooLarge()
+        self.sha256.update(data)
+        return super().write(data)
+
+    def hexdigest(self):
+        """
+        Function to get the digest of the content written to the file.
+
+        Returns:
+        str: The hexadecimal SHA-256 digest.
+        """
+        return self.sha256.hexdigest()
+
+
+class UploadRequest(Request):
+    """
+    Request whose uploaded files are received in HashingSpooledFile objects, so
+    that an upload never holds more than UPLOAD_SPOOL_SIZE bytes of a file in memory.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile(max_size=UPLOAD_SPOOL_SIZE)
@@ -7,6 +7,7 @@ from flask import request, jsonify
 from app import swagger
 from flasgger.utils import swag_from
 from auth import forgot_password
+from sessions import get_session_user, delete_user_sessions
 
 load_dotenv()
 
@@ -82,7 +83,7 @@ def delete_user():
     if not uuid:
         return jsonify({"message": "Unauthorized", "code": 401}), 401
     else:
-        user = db.users.find_one({"uuid": uuid})
+        user = get_session_user(uuid)
 
     if not user:
         return "Invalid email or password", 401
@@ -93,13 +94,15 @@ def delete_user():
         if hashed_password != user["password"]:
             return jsonify({"message": "Invalid email or password", "code": 401}), 401
         else:
-            db.users.delete_one({"uuid": uuid})
+            db.users.delete_one({"_id": user["_id"]})
+            delete_user_sessions(user["_id"])
             return jsonify({"message": "User deleted", "code": 200}), 200
 
     elif username and "admin" in user["roles"]:
         delete_user = db.users.find_one({"username": username})
         if delete_user:
             db.users.delete_one({"username": username})
+            delete_user_sessions(delete_user["_id"])
             return jsonify({"message": "User deleted", "code": 200}), 200
         else:
             return jsonify({"message": "User not found", "code": 404}), 404
@@ -115,7 +118,7 @@ def account():
     if not uuid:
         return jsonify({"message": "Unauthorized", "code": 401}), 401
     else:
-        user = db.users.find_one({"uuid": uuid})
+        user = get_session_user(uuid)
 
     if not user:
         return jsonify({"message": "User not found", "code": 404}), 404
@@ -137,7 +140,7 @@ def admin():
     if not uuid:
         return jsonify({"message": "Unauthorized", "code": 401}), 401
     else:
-        user = db.users.find_one({"uuid": uuid})
+        user = get_session_user(uuid)
 
     if not user:
         return jsonify({"message": "User not found", "code": 404}), 404
@@ -158,7 +161,7 @@ def transfer_account():
     if not uuid:
         return jsonify({"message": "Unauthorized", "code": 401}), 401
     else:
-        user = db.users.find_one({"uuid": uuid})
+        user = get_session_user(uuid)
 
     if not user:
         return jsonify({"message": "User not found", "code": 404}), 404
@@ -169,19 +172,19 @@ def transfer_account():
         old_user = request.form.get("old_username")
         new_user = request.form.get("new_username")
         new_email = request.form.get("new_email")
-        db.users.update_one(
+        transferred_user = db.users.find_one_and_update(
             {"username": old_user},
             {
                 "$set": {
                     "email": new_email,
                     "username": new_user,
-                    "uuid": "",
-                    "loggedCount": 0,
                     "loginAt": None,
                     "lastLogout": None,
                 }
             },
         )
+        if transferred_user:
+            delete_user_sessions(transferred_user["_id"])
         forgot_password(new_email)
         return (
             jsonify(
@@ -218,7 +221,7 @@ def add_maintainers_to_package(username):
         return jsonify({"message": "Please enter the namespace name", "code": 400}), 400
 
     # Get the user from the database using uuid.
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
 
     # Check if current user is authorized to access this API.
     if not user or user["username"] != username:
@@ -298,7 +301,7 @@ def remove_maintainers_from_package(username):
         return jsonify({"message": "Please enter the namespace name", "code": 400}), 400
 
     # Get the user from the database using uuid.
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
 
     # Check if current user is authorized to access this API.
     if not user or user["username"] != username:
@@ -375,7 +378,7 @@ def add_maintainers_to_namespace(username):
         return jsonify({"message": "Please enter the namespace name", "code": 400}), 400
 
     # Get the user from the database using uuid.
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
 
     # Check if current user is authorized to access this API.
     if not user or user["username"] != username:
@@ -445,7 +448,7 @@ def remove_maintainers_from_namespace(username):
         return jsonify({"message": "Please enter the namespace name", "code": 400}), 400
 
     # Get the user from the database using uuid.
-    user = db.users.find_one({"uuid": uuid})
+    user = get_session_user(uuid)
 
     # Check if current user is authorized to access this API.
     if not user or user["username"] != username:
@@ -1,34 +1,368 @@
 import os
-import docker
-import tarfile
+import queue
+import socket
+import threading
+import time
+import uuid
+import click
+from datetime import datetime, timedelta
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
 from app import app
+from mongo import db
+from blobs import open_tarball
 
-#package testing container
-client = docker.from_env()
-container = client.containers.run(
-    "registry",
-    tty=True,
-    detach=True,
-    network_disabled=False
-)
-
-
-# Copying package file to container
-def copy_to(package, dst, container):
-    data = package.read()
-    container.put_archive(os.path.dirname(dst), data)
-
-
-def validate_package(tarball,packagename):
-    copy_to(tarball, f'/home/registry/{packagename}.zip', container)
-    container.exec_run('unzip package.zip')
-    build_response = container.exec_run('sh -c "/home/registry/fpm build"')
-    # execute_response = container.exec_run('sh -c "timeout 15s fpm run"',demux=True)
-    if build_response.output[0] == None:
-        if '<ERROR>' in build_response.output[1].decode():
-            # package build failed 
-            return False
-        else:
-            # package build success 
-            return True
+# Time allowed to build a package, in seconds.
+VALIDATION_TIMEOUT = int(os.getenv("VALIDATION_TIMEOUT", 600))
 
+# A job claimed by a worker which did not finish it within its lease is claimed
+# again by another worker, up to this number of attempts.
+VALIDATION_MAX_ATTEMPTS = int(os.getenv("VALIDATION_MAX_ATTEMPTS", 3))
+VALIDATION_LEASE = VALIDATION_TIMEOUT + 60
+
+# Number of builds after which a sandbox container is replaced by a new one.
+SANDBOX_MAX_JOBS = int(os.getenv("SANDBOX_MAX_JOBS", 20))
+
+# Seconds an idle worker waits before looking for new jobs.
+VALIDATION_POLL_INTERVAL = float(os.getenv("VALIDATION_POLL_INTERVAL", 2))
+
+
+class ValidationTimeout(Exception):
+    """
+    Raised by a runner when the build of a package takes longer than VALIDATION_TIMEOUT.
+    """
+
+
+class DockerRunner:
+    """
+    Builds packages with fpm in a pool of warm containers of the `registry` image
+    (see validate_package.Dockerfile).
+
+    A container is reused by the following builds once the package is removed
+    from it, which keeps the dependencies fetched by fpm. It is replaced by a new
+    container after SANDBOX_MAX_JOBS builds, or when a build fails to run.
+
+    Parameters:
+    image (str): The image of the containers.
+    timeout (int): Time allowed to build a package, in seconds.
+    pool_size (int): Number of containers, one per worker.
+    """
+
+    def __init__(self, image, timeout, pool_size):
+        # Docker is only needed by the validation workers, not by the web server.
+        import docker
+
+        self.client = docker.from_env()
+        self.image = image
+        self.timeout = timeout
+        # Builds are cached per image, so a new toolchain builds every package again.
+        self.toolchain = os.getenv("VALIDATION_TOOLCHAIN") or self.client.images.get(image).id
+        self.pool = queue.Queue()
+        self.jobs = {}
+        for _ in range(pool_size):
+            self.pool.put(self.start_sandbox())
+
+    def start_sandbox(self):
+        container = self.client.containers.run(
+            self.image, command="sleep infinity", detach=True, network_disabled=False
+        )
+        self.jobs[container.id] = 0
+        return container
+
+    def release_sandbox(self, container, reusable):
+        self.jobs[container.id] += 1
+
+        if reusable and self.jobs[container.id] < SANDBOX_MAX_JOBS:
+            reset = container.exec_run("rm -rf /home/registry/package")
+            if reset.exit_code == 0:
+                self.pool.put(container)
+                return
+
+        del self.jobs[container.id]
+        container.remove(force=True)
+        self.pool.put(self.start_sandbox())
+
+    def run(self, tarball, package_name):
+        """
+        Function to build a package.
+
+        Parameters:
+        tarball: The file object of the package tarball.
+        package_name (str): The name of the package.
+
+        Returns:
+        tuple: Whether the package was built, and the output of the build.
+        """
+        container = self.pool.get()
+        reusable = False
+        try:
+            container.exec_run("mkdir -p /home/registry/package")
+            # Docker extracts the gzip compressed tarball into the directory.
+            container.put_archive("/home/registry/package", tarball.read())
+
+            # The package is built where its fpm.toml is, at the root of the tarball or in
+            # its top level directory, as read by manifest.find_manifest. The build is
+            # killed by `timeout` if it takes too long, with exit code 124.
+            build = container.exec_run([
+                "sh", "-c",
+                "cd /home/registry/package"
+                " && manifest=$(ls fpm.toml */fpm.toml 2>/dev/null | head -n 1)"
+                ' && cd "$(dirname "${{manifest:-fpm.toml}}")"'
+                " && timeout {}s /home/registry/fpm build".format(self.timeout),
+            ])
+            output = build.output.decode(errors="replace")
+
+            if build.exit_code == 124:
+                raise ValidationTimeout(output + "\nBuild timed out after {} seconds.".format(self.timeout))
+            reusable = True
+            return build.exit_code == 0 and "<ERROR>" not in output, output
+        finally:
+            self.release_sandbox(container, reusable)
+
+
+class FakeRunner:
+    """
+    Runner which does not build packages, used to run the registry and its tests
+    without Docker. Every package passes, unless `passed` is set to False.
+    """
+
+    toolchain = "fake"
+
+    def __init__(self, passed=True):
+        self.passed = passed
+
+    def run(self, tarball, package_name):
+        return self.passed, "Package was not built, VALIDATION_RUNNER is fake."
+
+
+def create_runner(pool_size=1):
+    """
+    Function to create the package runner configured by the VALIDATION_RUNNER
+    environment variable: `docker` (the default) or `fake`.
+
+    Parameters:
+    pool_size (int): Number of packages built at the same time.
+
+    Returns:
+    The package runner.
+    """
+    if os.getenv("VALIDATION_RUNNER", "docker") == "fake":
+        return FakeRunner()
+    return DockerRunner(os.getenv("VALIDATION_IMAGE", "registry"), VALIDATION_TIMEOUT, pool_size)
+
+
+def enqueue_validation(package_id, package_name, version, digest):
+    """
+    Function to queue the validation of an uploaded package version.
+
+    Parameters:
+    package_id (ObjectId): The id of the package.
+    package_name (str): The name of the package.
+    version (str): The uploaded version.
+    digest (str): The digest of the tarball of the version.
+    """
+    db.validation_jobs.insert_one(
+        {
+            "package": package_id,
+            "package_name": package_name,
+            "version": version,
+            "digest": digest,
+            "status": "queued",
+            "attempts": 0,
+            "createdAt": datetime.utcnow(),
+        }
+    )
+
+
+def claim_job(worker_id):
+    """
+    Function to claim the oldest queued job, or a job whose lease has expired.
+
+    The claim is a single atomic update, so a job is never run by two workers
+    within its lease.
+
+    Parameters:
+    worker_id (str): The id of the claiming worker.
+
+    Returns:
+    dict: The claimed job, or None if there is no job to run.
+    """
+    now = datetime.utcnow()
+    return db.validation_jobs.find_one_and_update(
+        {
+            "$or": [
+                {"status": "queued"},
+                {"status": "running", "leaseExpiresAt": {"$lt": now}},
+            ]
+        },
+        {
+            "$set": {
+                "status": "running",
+                "worker": worker_id,
+                "leaseExpiresAt": now + timedelta(seconds=VALIDATION_LEASE),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("createdAt", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def set_version_status(job, status):
+    db.packages.update_one(
+        {"_id": job["package"], "versions.version": job["version"]},
+        {"$set": {"versions.$.status": status}},
+    )
+
+
+def complete_job(job, worker_id, passed, log):
+    """
+    Function to record the result of a job on the job and its package version.
+
+    The result is dropped if the lease of the worker expired and the job was
+    claimed by another worker.
+
+    Parameters:
+    job (dict): The job.
+    worker_id (str): The id of the worker which ran the job.
+    passed (bool): Whether the package was built.
+    log (str): The output of the build.
+    """
+    status = "passed" if passed else "failed"
+    result = db.validation_jobs.update_one(
+        {"_id": job["_id"], "worker": worker_id, "status": "running"},
+        {"$set": {"status": "done", "result": status, "log": log, "finishedAt": datetime.utcnow()}},
+    )
+
+    if result.modified_count:
+        set_version_status(job, status)
+
+
+def complete_queued_jobs(digest, passed, log):
+    """
+    Function to record the result of a build on the queued jobs of the same tarball,
+    which is uploaded for many versions or packages, so it is built only once.
+
+    Parameters:
+    digest (str): The digest of the built tarball.
+    passed (bool): Whether the package was built.
+    log (str): The output of the build.
+    """
+    status = "passed" if passed else "failed"
+    for job in db.validation_jobs.find({"digest": digest, "status": "queued"}):
+        # A job claimed by a worker in the meantime is left to it.
+        result = db.validation_jobs.update_one(
+            {"_id": job["_id"], "status": "queued"},
+            {"$set": {"status": "done", "result": status, "log": log, "finishedAt": datetime.utcnow()}},
+        )
+        if result.modified_count:
+            set_version_status(job, status)
+
+
+def process_next_job(worker_id, runner):
+    """
+    Function to claim and run one validation job.
+
+    The result of a build is cached by the digest of the tarball and the toolchain
+    of the runner, so identical content is only built again after a toolchain change.
+
+    Parameters:
+    worker_id (str): The id of the worker.
+    runner: The package runner.
+
+    Returns:
+    bool: Whether a job was claimed.
+    """
+    job = claim_job(worker_id)
+
+    if not job:
+        return False
+
+    if job["attempts"] > VALIDATION_MAX_ATTEMPTS:
+        complete_job(job, worker_id, False, "Validation did not finish after {} attempts.".format(VALIDATION_MAX_ATTEMPTS))
+        return True
+
+    cached = db.validation_results.find_one({"digest": job["digest"], "toolchain": runner.toolchain})
+    if cached:
+        complete_job(job, worker_id, cached["passed"], cached["log"])
+        return True
+
+    try:
+        tarball = open_tarball(job["digest"])
+    except NoFile:
+        # The version was deleted before it was validated.
+        complete_job(job, worker_id, False, "Package tarball not found.")
+        return True
+
+    try:
+        passed, log = runner.run(tarball, job["package_name"])
+    except ValidationTimeout as err:
+        # Timeouts are not cached, the build may pass on a less busy worker.
+        complete_job(job, worker_id, False, str(err))
+        return True
+    except Exception as err:
+        # The job is claimed again once its lease expires.
+        print("Failed to validate {} {}: {}".format(job["package_name"], job["version"], err))
+        return True
+    finally:
+        tarball.close()
+
+    db.validation_results.update_one(
+        {"digest": job["digest"], "toolchain": runner.toolchain},
+        {"$set": {"passed": passed, "log": log, "createdAt": datetime.utcnow()}},
+        upsert=True,
+    )
+    complete_job(job, worker_id, passed, log)
+    complete_queued_jobs(job["digest"], passed, log)
+    return True
+
+
+def run_worker(worker_id, runner, stop):
+    while not stop.is_set():
+        if not process_next_job(worker_id, runner):
+            stop.wait(VALIDATION_POLL_INTERVAL)
+
+
+@app.cli.command("validation-workers")
+@click.option("--workers", default=int(os.getenv("VALIDATION_WORKERS", 2)), help="Number of packages built at the same time.")
+def validation_workers(workers):
+    """Run a pool of workers validating the uploaded packages."""
+    runner = create_runner(pool_size=workers)
+    stop = threading.Event()
+    host = socket.gethostname()
+
+    threads = []
+    for _ in range(workers):
+        worker_id = "{}-{}".format(host, uuid.uuid4().hex[:8])
+        thread = threading.Thread(target=run_worker, args=(worker_id, runner, stop), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+@app.cli.command("revalidate-packages")
+def revalidate_packages():
+    """Queue the validation of every package version, after a toolchain change."""
+    # Versions with a validation in progress are skipped.
+    in_progress = {
+        (job["package"], job["version"])
+        for job in db.validation_jobs.find({"status": {"$in": ["queued", "running"]}}, {"package": 1, "version": 1})
+    }
+
+    queued = 0
+    for package in db.packages.find({}, {"name": 1, "versions.version": 1, "versions.digest": 1}):
+        for version in package.get("versions", []):
+            if version.get("digest") and (package["_id"], version["version"]) not in in_progress:
+                enqueue_validation(package["_id"], package["name"], version["version"], version["digest"])
+                queued += 1
+
+    # Versions of unchanged tarballs are answered from the cache of results,
+    # and the versions sharing a tarball are validated by a single build.
+    print("Queued {} package versions.".format(queued))
@@ -0,0 +1,166 @@
+import semantic_version
+from pymongo import ReturnDocument
+from app import app
+from mongo import db
+
+# Marks a release after its version core, it sorts after the prerelease marker "-",
+# since a release has a higher precedence than its prereleases.
+RELEASE = "~"
+
+# Separates the prerelease identifiers, it sorts before any identifier character,
+# so that a prerelease sorts before the longer prereleases it starts.
+SEPARATOR = "!"
+
+
+# Requirement operators, as MongoDB comparison operators on the sort keys.
+OPERATORS = {"<": "$lt", "<=": "$lte", ">": "$gt", ">=": "$gte", "==": "$eq", "!=": "$ne"}
+
+# Fields of a package set from the manifest of its latest version, kept on every
+# version under `package_metadata`, see packages.publish_package.
+PACKAGE_METADATA_FIELDS = ("description", "copyright", "tags", "homepage", "authors", "search")
+
+
+def encode_number(number):
+    # A length prefix makes longer numbers sort after shorter ones.
+    digits = str(number)
+    return "{:02d}{}".format(len(digits), digits)
+
+
+def core_key(version):
+    return "".join(encode_number(number) for number in (version.major, version.minor, version.patch))
+
+
+def version_sort_key(version):
+    """
+    Function to compute the key ordering a version by semver precedence.
+
+    Comparing the keys as strings, as MongoDB does, orders the versions like
+    semantic_version: 0.9.0 < 0.10.0 and 1.0.0-alpha < 1.0.0-alpha.1 < 1.0.0-beta
+    < 1.0.0. Numeric prerelease identifiers sort before alphanumeric ones, and
+    build metadata is ignored.
+
+    Parameters:
+    version (str): The version.
+
+    Returns:
+    str: The sort key, or an empty string, sorting first, if the version is not valid.
+    """
+    try:
+        parsed = semantic_version.Version(version)
+    except ValueError:
+        return ""
+
+    key = core_key(parsed)
+    if not parsed.prerelease:
+        return key + RELEASE
+
+    identifiers = [
+        "0" + encode_number(int(identifier)) if identifier.isdigit() else "1" + identifier
+        for identifier in parsed.prerelease
+    ]
+    return key + "-" + SEPARATOR.join(identifiers)
+
+
+def requirement_query(clause, field):
+    """
+    Function to translate a parsed version requirement into a query on sort keys.
+
+    As in npm, a prerelease only satisfies the bounds of a requirement with
+    the same core (`^1.2.0-beta` accepts 1.2.0-beta.2 but not 1.3.0-beta),
+    which is checked on the prefix of its sort key.
+
+    Parameters:
+    clause: The clause of a semantic_version.NpmSpec.
+    field (str): The field holding the sort key.
+
+    Returns:
+    dict: The query matching the sort keys of the versions satisfying the requirement.
+    """
+    if isinstance(clause, semantic_version.base.AnyOf):
+        return {"$or": [requirement_query(item, field) for item in clause.clauses]}
+    if isinstance(clause, semantic_version.base.AllOf):
+        return {"$and": [requirement_query(item, field) for item in clause.clauses]} if clause.clauses else {}
+    if isinstance(clause, semantic_version.base.Always):
+        return {}
+    if isinstance(clause, semantic_version.base.Never):
+        return {field: {"$in": []}}
+
+    # The prereleases of the core of the bound sort between its core and its release.
+    core = core_key(clause.target)
+    prereleases = {field: {"$gt": core + "-", "$lt": core + RELEASE}}
+
+    conditions = [{field: {OPERATORS[clause.operator]: version_sort_key(str(clause.target))}}]
+    if clause.prerelease_policy == clause.PRERELEASE_SAMEPATCH:
+        conditions.append({"$or": [{field: {"$regex": RELEASE + "$"}}, prereleases]})
+    elif (
+        clause.prerelease_policy == clause.PRERELEASE_NATURAL
+        and clause.operator in ("<", "!=")
+        and not clause.target.prerelease
+    ):
+        conditions.append({"$nor": [prereleases]})
+    return {"$and": conditions}
+
+
+def refresh_latest_version(package_id):
+    """
+    Function to store the latest version of a package, and its metadata, on the package.
+
+    The versions are kept sorted by their sort key, so the latest one is the last.
+    The update reads the versions it is computed from, which makes it safe with
+    concurrent uploads and deletions. Versions uploaded without a manifest, or
+    before the metadata was kept on the versions, leave the metadata as it is.
+
+    Parameters:
+    package_id (ObjectId): The id of the package.
+
+    Returns:
+    dict: The name, tags, latest sort key and deprecation of the updated package, or None.
+    """
+    latest = {"$arrayElemAt": ["$versions", -1]}
+    return db.packages.find_one_and_update(
+        {"_id": package_id},
+        [
+            {
+                "$set": {
+                    "latest_version": {"$arrayElemAt": ["$versions.version", -1]},
+                    "latest_sort_key": {"$arrayElemAt": ["$versions.sort_key", -1]},
+                    **{
+                        field: {
+                            "$let": {
+                                "vars": {"latest": latest},
+                                "in": {
+                                    "$cond": [
+                                        {"$ifNull": ["$$latest.package_metadata", False]},
+                                        "$$latest.package_metadata." + field,
+                                        "$" + field,
+                                    ]
+                                },
+                            }
+                        }
+                        for field in PACKAGE_METADATA_FIELDS
+                    },
+                }
+            }
+        ],
+        projection={"name": 1, "tags": 1, "latest_sort_key": 1, "isDeprecated": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+@app.cli.command("index-versions")
+def index_versions():
+    """Compute the sort keys of every version, and sort the versions by them."""
+    for package in db.packages.find({}, {"versions.version": 1}):
+        sort_keys = {version["version"]: version_sort_key(version["version"]) for version in package["versions"]}
+
+        # The versions are sorted by pushing nothing with a sort, which keeps concurrent changes.
+        for version, sort_key in sort_keys.items():
+            db.packages.update_one(
+                {"_id": package["_id"], "versions.version": version},
+                {"$set": {"versions.$.sort_key": sort_key}},
+            )
+        db.packages.update_one(
+            {"_id": package["_id"]},
+            {"$push": {"versions": {"$each": [], "$sort": {"sort_key": 1}}}},
+        )
+        refresh_latest_version(package["_id"])
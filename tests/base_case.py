@@ -1,6 +1,37 @@
 import unittest
-from mongo import client
+from pymongo import monitoring
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    Records the name of every command sent to MongoDB, so tests can assert
+    on the number of round trips made by a request.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# The listener must be registered before the client in mongo.py is created.
+command_recorder = CommandRecorder()
+monitoring.register(command_recorder)
+
+from mongo import client, ensure_indexes
+from query_plans import CHECK_QUERY_PLANS, query_plan_recorder
 from server import app
+from packages import search_cache
+from search import reset_indexes
+from resolve import resolution_cache
+from sessions import session_cache
 
 class BaseTestClass(unittest.TestCase):
     def setUp(self):
@@ -8,6 +39,19 @@ class BaseTestClass(unittest.TestCase):
         # set up any variables or configurations needed for your tests
         self.client = app.test_client()
 
+        # The database is dropped after every test, so recreate its indexes.
+        ensure_indexes(upgrade=True)
+
+        # Search responses cached by a previous test may refer to dropped packages.
+        search_cache.clear()
+        resolution_cache.clear()
+        session_cache.clear()
+        reset_indexes()
+
     def tearDown(self):
+        # Fail on the queries of the test which are not served by an index.
+        if CHECK_QUERY_PLANS:
+            self.assertEqual([], query_plan_recorder.check(client), "Queries scanning a whole collection")
+
         # tear down any variables or configurations set up in setUp() 
         client.drop_database('testregistry')
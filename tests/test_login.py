@@ -1,4 +1,4 @@
-from base_case import BaseTestClass
+from base_case import BaseTestClass, command_recorder
 from uuid import uuid4
 
 class TestLogin(BaseTestClass):
@@ -116,4 +116,64 @@ class TestLogin(BaseTestClass):
         }
 
         response = self.client.post('/auth/logout', data=data)
-        self.assertEqual(404, response.json["code"])
\ No newline at end of file
+        self.assertEqual(404, response.json["code"])
+
+    def test_concurrent_sessions(self):
+        """
+        Test case to verify that every login opens its own session, and that logging out
+        closes only that session.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from mongo import db
+
+        signup_data = {
+            "email": "testemail@gmail.com",
+            "password": "123456",
+            "username": "testuser"
+        }
+
+        response = self.client.post("/auth/signup", data=signup_data)
+        self.assertEqual(200, response.json["code"])
+        first_uuid = response.json["uuid"]
+
+        response = self.client.post("/auth/login", data={"email": signup_data["email"], "password": signup_data["password"]})
+        self.assertEqual(200, response.json["code"])
+        second_uuid = response.json["uuid"]
+        self.assertNotEqual(first_uuid, second_uuid)
+
+        # The session tokens are only stored hashed.
+        self.assertEqual(2, db.sessions.count_documents({}))
+        self.assertIsNone(db.sessions.find_one({"_id": first_uuid}))
+
+        # A verified session is cached with its user, so nothing is read.
+        response = self.client.post("/users/account", data={"uuid": first_uuid})
+        self.assertEqual(200, response.json["code"])
+        command_recorder.commands.clear()
+        response = self.client.post("/users/account", data={"uuid": first_uuid})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual([], command_recorder.commands)
+
+        # A new login changes the user, so the cached sessions are read again.
+        response = self.client.post("/auth/login", data={"email": signup_data["email"], "password": signup_data["password"]})
+        self.assertEqual(200, response.json["code"])
+        command_recorder.commands.clear()
+        response = self.client.post("/users/account", data={"uuid": first_uuid})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(["aggregate"], command_recorder.commands)
+
+        response = self.client.post("/auth/logout", data={"uuid": first_uuid})
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.post("/users/account", data={"uuid": first_uuid})
+        self.assertEqual(404, response.json["code"])
+
+        response = self.client.post("/users/account", data={"uuid": second_uuid})
+        self.assertEqual(200, response.json["code"])
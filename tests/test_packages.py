@@ -1,5 +1,13 @@
 import io
-from base_case import BaseTestClass
+import base64
+import unittest.mock
+import hashlib
+from base_case import BaseTestClass, command_recorder
+from search import load_indexes
+from packages import parameters
+from sessions import forget_session_users
+from datetime import datetime, timedelta
+from downloads import download_counter, compact_download_stats, STATS_RETENTION_DAYS
 
 class TestPackages(BaseTestClass):
 
@@ -29,6 +37,42 @@ class TestPackages(BaseTestClass):
 
         return tarball
 
+    def upload_test_package(self, **package_data):
+        """
+        Helper to sign up the test user, create the test namespace and upload a package to it.
+
+        Parameters:
+        package_data: Upload form fields overriding the ones of test_package_data.
+
+        Returns:
+        str: The uuid of the test user.
+        """
+        response = self.client.post("/auth/signup", data=TestPackages.test_user_data)
+        self.assertEqual(200, response.json["code"])
+
+        uuid = response.json["uuid"]
+
+        response = self.client.post("/namespaces", data={**TestPackages.test_namespace_data, "uuid": uuid})
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.post(f"/namespaces/{TestPackages.test_namespace_data['namespace']}/uploadToken", 
+            data={
+            "uuid": uuid
+            }
+        )
+        self.assertEqual(200, response.json["code"])
+
+        self.upload_token = response.json["uploadToken"]
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_tarball(),
+            **package_data,
+        })
+        self.assertEqual(200, response.json["code"])
+
+        return uuid
+
    
     def test_successful_package_upload(self):
         """
@@ -456,4 +500,1287 @@ class TestPackages(BaseTestClass):
 
         # Upload the package.
         response = self.client.post("/packages", data={**TestPackages.test_package_data, "package_license": "ABC"})
-        self.assertEqual(400, response.json["code"])
\ No newline at end of file
+        self.assertEqual(400, response.json["code"])
+
+    def test_search_package_by_name_tokens(self):
+        """
+        Test case to verify that a package can be found by the words and partial words of its name.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package(package_name="fortran_stdlib")
+
+        for query in ["stdlib", "std", "Fortran_Stdlib"]:
+            response = self.client.get("/packages", query_string={"query": query})
+            self.assertEqual(200, response.json["code"])
+            self.assertEqual(["fortran_stdlib"], [package["name"] for package in response.json["packages"]])
+
+    def test_search_package_all_terms(self):
+        """
+        Test case to verify that the packages found by a search contain every term of the query.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package(package_name="json_parser")
+
+        for package_name in ["json_writer", "xml_parser"]:
+            response = self.client.post("/packages", data={
+                **TestPackages.test_package_data,
+                "package_name": package_name,
+                "upload_token": self.upload_token,
+                "tarball": TestPackages.generate_tarball(),
+            })
+            self.assertEqual(200, response.json["code"])
+
+        # Only json_parser contains both terms, the other packages contain one of them.
+        response = self.client.get("/packages", query_string={"query": "json parser"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual("json_parser", response.json["packages"][0]["name"])
+        self.assertEqual([{"value": "test_namespace", "count": 1}], response.json["facets"]["namespace"])
+
+    def test_search_package_single_round_trip(self):
+        """
+        Test case to verify that a page of search results is fetched from the database with a single command.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the number of database commands is not as expected.
+        """
+
+        self.upload_test_package()
+
+        # Load the in-memory search indexes before counting the commands.
+        load_indexes()
+
+        command_recorder.commands.clear()
+        response = self.client.get("/packages", query_string={
+            "query": TestPackages.test_package_data["package_name"]
+        })
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual("test_namespace", response.json["packages"][0]["namespace"])
+        self.assertEqual("testuser", response.json["packages"][0]["author"])
+        self.assertEqual(["aggregate"], command_recorder.commands)
+
+    def test_cursor_pagination(self):
+        """
+        Test case to verify that following the next_cursor of the search and list APIs visits every package once.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package(package_name="test_package_0")
+        for i in range(1, 12):
+            response = self.client.post("/packages", data={
+                **TestPackages.test_package_data,
+                "package_name": f"test_package_{i}",
+                "upload_token": self.upload_token,
+                "tarball": TestPackages.generate_tarball(),
+            })
+            self.assertEqual(200, response.json["code"])
+
+        expected_names = sorted(f"test_package_{i}" for i in range(12))
+
+        for url, query_string, key in [
+            ("/packages", {"query": "test_package", "sorted_by": "name"}, "name"),
+            ("/packages/list", {}, "package_name"),
+        ]:
+            response = self.client.get(url, query_string=query_string)
+            names = [package[key] for package in response.json["packages"]]
+            self.assertEqual(10, len(names))
+
+            response = self.client.get(url, query_string={**query_string, "cursor": response.json["next_cursor"]})
+            names += [package[key] for package in response.json["packages"]]
+            self.assertIsNone(response.json["next_cursor"])
+            self.assertEqual(expected_names, sorted(names))
+
+        response = self.client.get("/packages/list", query_string={"cursor": "invalid"})
+        self.assertEqual(400, response.json["code"])
+
+        # The counts of the first page are reused by the next pages, which only read their packages.
+        query_string = {"query": "test_package", "sorted_by": "downloads"}
+        response = self.client.get("/packages", query_string=query_string)
+        facets = response.json["facets"]
+        command_recorder.commands.clear()
+        response = self.client.get("/packages", query_string={**query_string, "cursor": response.json["next_cursor"]})
+        self.assertEqual(["aggregate"], command_recorder.commands)
+        self.assertEqual(facets, response.json["facets"])
+        self.assertEqual(2, response.json["total_pages"])
+
+        # The search cursor holds the sort value of the last package, never a joined document.
+        for sorted_by in ["relevance", *parameters]:
+            query_string = {"query": "test_package", "sorted_by": sorted_by}
+            response = self.client.get("/packages", query_string=query_string)
+            names = [package["name"] for package in response.json["packages"]]
+            next_cursor = response.json["next_cursor"]
+            self.assertNotIn(b"password", base64.urlsafe_b64decode(next_cursor))
+
+            response = self.client.get("/packages", query_string={**query_string, "cursor": next_cursor})
+            self.assertEqual(200, response.json["code"])
+            names += [package["name"] for package in response.json["packages"]]
+            self.assertIsNone(response.json["next_cursor"])
+            self.assertEqual(expected_names, sorted(names), sorted_by)
+
+        # Packages uploaded before the download counter have no downloads, they are
+        # listed after the others instead of being skipped by the cursor.
+        from mongo import db
+        from packages import search_cache
+        db.packages.update_many({"name": {"$in": ["test_package_3", "test_package_11"]}}, {"$unset": {"downloads": ""}})
+        db.packages.update_many({"name": {"$in": ["test_package_0", "test_package_5"]}}, {"$set": {"downloads": 5}})
+        search_cache.clear()
+        query_string = {"query": "test_package", "sorted_by": "downloads"}
+        response = self.client.get("/packages", query_string=query_string)
+        names = [package["name"] for package in response.json["packages"]]
+        self.assertEqual(["test_package_0", "test_package_5"], sorted(names[:2]))
+        response = self.client.get("/packages", query_string={**query_string, "cursor": response.json["next_cursor"]})
+        names += [package["name"] for package in response.json["packages"]]
+        self.assertEqual(expected_names, sorted(names))
+        self.assertEqual(["test_package_11", "test_package_3"], sorted(names[-2:]))
+
+    def test_search_cache(self):
+        """
+        Test case to verify that repeated searches are served from the search cache, and that
+        package writes invalidate the cached results.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        uuid = self.upload_test_package()
+
+        query_string = {"query": TestPackages.test_package_data["package_name"]}
+        response = self.client.get("/packages", query_string=query_string)
+        self.assertEqual(1, len(response.json["packages"]))
+
+        # The same query in a different case is answered from the cache.
+        command_recorder.commands.clear()
+        hits = self.client.get("/metrics").json["search_cache"]["hits"]
+        response = self.client.get("/packages", query_string={"query": "Test_Package"})
+        self.assertEqual(1, len(response.json["packages"]))
+        self.assertEqual([], command_recorder.commands)
+        self.assertEqual(hits + 1, self.client.get("/metrics").json["search_cache"]["hits"])
+
+        # Deprecating the package removes it from the cached results.
+        response = self.client.put("/packages", data={
+            "uuid": uuid,
+            "name": TestPackages.test_package_data["package_name"],
+            "namespace": TestPackages.test_namespace_data["namespace"],
+            "isDeprecated": "true",
+        })
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.get("/packages", query_string=query_string)
+        self.assertEqual([], response.json["packages"])
+
+    def test_suggest_packages(self):
+        """
+        Test case to verify the suggestions returned for a prefix, and that they are updated on upload.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package()
+
+        response = self.client.get("/packages/suggest", query_string={"prefix": "TEST"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual([
+            {"value": "test_namespace", "type": "namespace"},
+            {"value": "test_package", "type": "package"},
+        ], response.json["suggestions"])
+
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "package_name": "test_stdlib",
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(200, response.json["code"])
+
+        command_recorder.commands.clear()
+        response = self.client.get("/packages/suggest", query_string={"prefix": "test_s"})
+        self.assertEqual([{"value": "test_stdlib", "type": "package"}], response.json["suggestions"])
+        self.assertEqual([], command_recorder.commands)
+
+        response = self.client.get("/packages/suggest", query_string={"prefix": "test", "limit": "ten"})
+        self.assertEqual(400, response.json["code"])
+
+        # A namespace created while the indexes are rebuilt is kept by the rebuilt indexes.
+        import search
+        build_indexes = search.build_indexes
+
+        def build_indexes_during_write():
+            indexes = build_indexes()
+            search.index_namespace("test_rebuild")
+            return indexes
+
+        with unittest.mock.patch("search.build_indexes", build_indexes_during_write):
+            with search.refresh_lock:
+                search.refresh_indexes()
+
+        response = self.client.get("/packages/suggest", query_string={"prefix": "test_r"})
+        self.assertEqual([{"value": "test_rebuild", "type": "namespace"}], response.json["suggestions"])
+
+        # A deletion the rebuild already read is replayed without removing the tag
+        # of another package, even when the deletion is replayed twice.
+        from mongo import db
+        namespace_id = db.namespaces.find_one()["_id"]
+        package_ids = db.packages.insert_many([
+            {"name": name, "namespace": namespace_id, "tags": ["test_shared"], "isDeprecated": False}
+            for name in ("test_tagged_a", "test_tagged_b")
+        ]).inserted_ids
+        search.reset_indexes()
+        search.load_indexes()
+        deleted = db.packages.find_one_and_delete({"_id": package_ids[0]})
+
+        def build_indexes_after_delete():
+            indexes = build_indexes()
+            search.unindex_package(deleted, "test_namespace")
+            return indexes
+
+        with unittest.mock.patch("search.build_indexes", build_indexes_after_delete):
+            with search.refresh_lock:
+                search.refresh_indexes()
+        search.unindex_package(deleted, "test_namespace")
+
+        response = self.client.get("/packages/suggest", query_string={"prefix": "test_shared"})
+        self.assertEqual([{"value": "test_shared", "type": "tag"}], response.json["suggestions"])
+
+    def test_fuzzy_search_package(self):
+        """
+        Test case to verify that a misspelled query finds the package with the most similar name.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package(package_name="fortran_stdlib")
+
+        response = self.client.get("/packages", query_string={"query": "stdlb"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(["fortran_stdlib"], [package["name"] for package in response.json["packages"]])
+
+        response = self.client.get("/packages", query_string={"query": "somerandompackage"})
+        self.assertEqual([], response.json["packages"])
+
+    def test_download_counter(self):
+        """
+        Test case to verify that tarball downloads are counted on the version and the package once flushed.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package()
+
+        package_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}"
+        response = self.client.get(package_url)
+        download_url = response.json["data"]["latest_version_data"]["download_url"]
+
+        for _ in range(2):
+            response = self.client.get(download_url)
+            self.assertEqual(200, response.status_code)
+
+        # HEAD requests, as sent by link checkers, are not downloads.
+        pending = download_counter.pending()
+        response = self.client.head(download_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(pending, download_counter.pending())
+
+        # Downloads are not written to the database before a flush.
+        response = self.client.get(package_url)
+        self.assertEqual(0, response.json["data"]["latest_version_data"]["downloads"])
+
+        download_counter.flush()
+
+        response = self.client.get(package_url)
+        self.assertEqual(2, response.json["data"]["latest_version_data"]["downloads"])
+
+    def test_package_download_stats(self):
+        """
+        Test case to verify the download statistics of a package, before and after the daily
+        buckets are compacted into monthly buckets.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package()
+
+        package_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}"
+        response = self.client.get(package_url)
+        download_url = response.json["data"]["latest_version_data"]["download_url"]
+
+        for _ in range(3):
+            self.client.get(download_url)
+        download_counter.flush()
+
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        response = self.client.get(f"{package_url}/stats")
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(3, response.json["data"]["downloads"])
+        self.assertEqual([{"date": today, "downloads": 3}], response.json["data"]["series"])
+
+        response = self.client.get(f"{package_url}/stats", query_string={"version": "0.0.1", "interval": "month"})
+        self.assertEqual(3, response.json["data"]["downloads"])
+        self.assertEqual(3, response.json["data"]["series"][0]["downloads"])
+
+        # The compaction stops once its time budget is spent.
+        later = datetime.utcnow() + timedelta(days=STATS_RETENTION_DAYS + 1)
+        self.assertFalse(compact_download_stats(now=later, time_budget=0))
+
+        # Once compacted, the downloads are only available per month. A second compaction,
+        # as run by another server process, does not count the downloads again.
+        self.assertTrue(compact_download_stats(now=later))
+        self.assertTrue(compact_download_stats(now=later))
+
+        # Buckets claimed by an interrupted compaction are taken over once the claim is stale.
+        from mongo import db
+        from bson.objectid import ObjectId
+        package_id = db.packages.find_one()["_id"]
+        db.download_stats.insert_one({
+            "package": package_id, "version": None, "granularity": "day", "bucket": datetime(2000, 1, 15), "count": 2,
+            "compaction": ObjectId.from_datetime(datetime.utcnow() - timedelta(hours=1)),
+        })
+        compact_download_stats(now=later)
+        month = db.download_stats.find_one({"package": package_id, "version": None, "bucket": datetime(2000, 1, 1)})
+        self.assertEqual(("month", 2), (month["granularity"], month["count"]))
+
+        response = self.client.get(f"{package_url}/stats")
+        self.assertEqual([], response.json["data"]["series"])
+
+        response = self.client.get(f"{package_url}/stats", query_string={"interval": "month"})
+        self.assertEqual(3, response.json["data"]["series"][0]["downloads"])
+
+        response = self.client.get(f"{package_url}/stats", query_string={"interval": "year"})
+        self.assertEqual(400, response.json["code"])
+
+        response = self.client.get(f"{package_url}/stats", query_string={"period": "month"})
+        self.assertEqual(400, response.json["code"])
+
+    def test_search_package_facets(self):
+        """
+        Test case to verify the facet counts of the search results, and the license, tag and namespace filters.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package(package_name="test_package_mit")
+
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "package_name": "test_package_apache",
+            "package_license": "Apache-2.0",
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.get("/packages", query_string={"query": "test_package"})
+        self.assertEqual(2, len(response.json["packages"]))
+        self.assertEqual([
+            {"value": "Apache-2.0", "count": 1},
+            {"value": "MIT", "count": 1},
+        ], response.json["facets"]["license"])
+        self.assertEqual([{"value": "test_namespace", "count": 2}], response.json["facets"]["namespace"])
+        self.assertIn({"value": "fortran", "count": 2}, response.json["facets"]["tag"])
+
+        response = self.client.get("/packages", query_string={"query": "test_package", "license": "MIT"})
+        self.assertEqual(["test_package_mit"], [package["name"] for package in response.json["packages"]])
+        self.assertEqual([{"value": "MIT", "count": 1}], response.json["facets"]["license"])
+
+        response = self.client.get("/packages", query_string={
+            "query": "test_package", "tag": "fortran", "namespace": "test_namespace",
+        })
+        self.assertEqual(2, len(response.json["packages"]))
+
+        response = self.client.get("/packages", query_string={"query": "test_package", "namespace": "other"})
+        self.assertEqual([], response.json["packages"])
+
+    def test_tarball_conditional_and_range_requests(self):
+        """
+        Test case to verify the ETag, conditional and range request handling of tarball downloads.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload_test_package()
+
+        response = self.client.get(f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}")
+        download_url = response.json["data"]["latest_version_data"]["download_url"]
+
+        tarball_contents = TestPackages.generate_tarball().read()
+
+        response = self.client.get(download_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(tarball_contents, response.data)
+        self.assertEqual(f'"{hashlib.sha256(tarball_contents).hexdigest()}"', response.headers["ETag"])
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+        response = self.client.get(download_url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(304, response.status_code)
+
+        response = self.client.get(download_url, headers={"Range": "bytes=5-8"})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(tarball_contents[5:9], response.data)
+
+    def test_tarball_deduplication(self):
+        """
+        Test case to verify that identical tarballs are stored once, and removed with their last version.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from mongo import db
+
+        uuid = self.upload_test_package()
+
+        # Upload the same tarball again under a new version.
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "package_version": "0.0.2",
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(200, response.json["code"])
+
+        digest = hashlib.sha256(TestPackages.generate_tarball().read()).hexdigest()
+        self.assertEqual(1, db.tarballs.files.count_documents({}))
+        self.assertEqual(2, db.blobs.find_one({"_id": digest})["refcount"])
+
+        # An existing version is rejected before the tarball is stored.
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(400, response.json["code"])
+        self.assertEqual(2, db.blobs.find_one({"_id": digest})["refcount"])
+
+        # Both versions have their own download url serving the same tarball.
+        package = db.packages.find_one({"name": TestPackages.test_package_data["package_name"]})
+        download_urls = {version["download_url"] for version in package["versions"]}
+        self.assertEqual(2, len(download_urls))
+        for download_url in download_urls:
+            response = self.client.get(download_url)
+            self.assertEqual(200, response.status_code)
+
+        # An unknown session is refused, by the admin routes too.
+        package_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}"
+        for url in (f"{package_url}/delete", f"{package_url}/0.0.2/delete", f"/namespace/{TestPackages.test_namespace_data['namespace']}/delete"):
+            response = self.client.post(url, data={"uuid": "someinvalidrandomstring"})
+            self.assertEqual(401, response.status_code)
+
+        admin = db.users.find_one_and_update({"username": TestPackages.test_user_data["username"]}, {"$addToSet": {"roles": "admin"}})
+        forget_session_users(admin["_id"])
+        response = self.client.post(
+            f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}/delete",
+            data={"uuid": uuid},
+        )
+        self.assertEqual(200, response.json["code"])
+        self.assertIsNone(db.blobs.find_one({"_id": digest}))
+        self.assertEqual(0, db.tarballs.files.count_documents({}))
+
+        # Content left marked as deleting by an interrupted deletion is written again.
+        from blobs import store_tarball, blob_store, STALE_DELETION_TIMEOUT
+        tarball_contents = b"Test file contents"
+        digest = hashlib.sha256(tarball_contents).hexdigest()
+        db.blobs.insert_one({
+            "_id": digest, "refcount": 0,
+            "deleting": datetime.utcnow() - timedelta(seconds=STALE_DELETION_TIMEOUT + 1),
+        })
+        store_tarball(io.BytesIO(tarball_contents), digest, "test.tar.gz")
+        self.assertEqual(1, db.blobs.find_one({"_id": digest})["refcount"])
+        self.assertIsNone(db.blobs.find_one({"_id": digest}).get("deleting"))
+        self.assertTrue(blob_store.exists(digest))
+
+        # A failed write drops its reference, and content referenced but not written
+        # yet is written by the next upload instead of being referenced as stored.
+        tarball_contents = b"Other test file contents"
+        digest = hashlib.sha256(tarball_contents).hexdigest()
+        with unittest.mock.patch.object(blob_store, "put", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                store_tarball(io.BytesIO(tarball_contents), digest, "test.tar.gz")
+        self.assertIsNone(db.blobs.find_one({"_id": digest}))
+
+        db.blobs.insert_one({"_id": digest, "refcount": 1})
+        store_tarball(io.BytesIO(tarball_contents), digest, "test.tar.gz")
+        self.assertEqual(2, db.blobs.find_one({"_id": digest})["refcount"])
+        self.assertTrue(db.blobs.find_one({"_id": digest})["stored"])
+        self.assertTrue(blob_store.exists(digest))
+
+    def test_local_blob_store_accel_redirect(self):
+        """
+        Test case to verify that tarballs of the local tarball store are handed over to nginx.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        import os
+        import tempfile
+        import blobs
+
+        tarball_contents = TestPackages.generate_tarball().read()
+        digest = hashlib.sha256(tarball_contents).hexdigest()
+
+        with tempfile.TemporaryDirectory() as path:
+            gridfs_store, blobs.blob_store = blobs.blob_store, blobs.LocalBlobStore(path, "/internal/tarballs/")
+            try:
+                self.upload_test_package()
+
+                with open(os.path.join(path, digest[:2], digest), "rb") as file:
+                    self.assertEqual(tarball_contents, file.read())
+
+                response = self.client.get(f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}")
+                download_url = response.json["data"]["latest_version_data"]["download_url"]
+
+                response = self.client.get(download_url)
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(f"/internal/tarballs/{digest[:2]}/{digest}", response.headers["X-Accel-Redirect"])
+                self.assertEqual(b"", response.data)
+                self.assertEqual(1, download_counter.pending())
+
+                response = self.client.get(download_url, headers={"If-None-Match": f'"{digest}"'})
+                self.assertEqual(304, response.status_code)
+                self.assertNotIn("X-Accel-Redirect", response.headers)
+            finally:
+                blobs.blob_store = gridfs_store
+                download_counter.flush()
+
+    def test_upload_package_too_large(self):
+        """
+        Test case to verify that tarballs larger than the maximum package size are refused before anything is stored.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        import uploads
+        from mongo import db
+
+        self.upload_test_package()
+
+        max_package_size, uploads.MAX_PACKAGE_SIZE = uploads.MAX_PACKAGE_SIZE, 8
+        try:
+            response = self.client.post("/packages", data={
+                **TestPackages.test_package_data,
+                "package_version": "0.0.2",
+                "upload_token": self.upload_token,
+                "tarball": TestPackages.generate_tarball(),
+            })
+        finally:
+            uploads.MAX_PACKAGE_SIZE = max_package_size
+
+        self.assertEqual(413, response.status_code)
+        self.assertEqual(413, response.json["code"])
+        self.assertEqual(1, db.blobs.find_one()["refcount"])
+        self.assertEqual(1, len(db.packages.find_one()["versions"]))
+
+    def test_resumable_upload(self):
+        """
+        Test case to verify the behaviour of the system when a package is uploaded in chunks.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        self.upload_test_package()
+
+        response = self.client.post("/uploads", data={
+            "package_name": TestPackages.test_package_data["package_name"],
+            "package_version": "0.0.2",
+            "package_license": TestPackages.test_package_data["package_license"],
+            "upload_token": self.upload_token,
+        })
+        self.assertEqual(200, response.json["code"])
+        upload_id = response.json["upload_id"]
+
+        tarball_contents = b"Chunked test file contents"
+        chunks = [tarball_contents[:10], tarball_contents[10:20], tarball_contents[20:]]
+        digest = hashlib.sha256(tarball_contents).hexdigest()
+        headers = {"Authorization": f"Bearer {self.upload_token}"}
+
+        # The token is not accepted in the URL.
+        response = self.client.get(f"/uploads/{upload_id}?upload_token={self.upload_token}")
+        self.assertEqual(404, response.status_code)
+
+        # The second chunk is lost on the way.
+        for index in (0, 2):
+            response = self.client.put(f"/uploads/{upload_id}/chunks/{index}", data=chunks[index], headers=headers)
+            self.assertEqual(200, response.json["code"])
+            self.assertEqual(hashlib.sha256(chunks[index]).hexdigest(), response.json["digest"])
+
+        response = self.client.post(f"/uploads/{upload_id}/finalize", data={"upload_token": self.upload_token, "digest": digest})
+        self.assertEqual(400, response.json["code"])
+        self.assertEqual([1], response.json["missing"])
+
+        response = self.client.get(f"/uploads/{upload_id}", headers=headers)
+        self.assertEqual([0, 2], [chunk["index"] for chunk in response.json["chunks"]])
+
+        # Only the missing chunk is resent.
+        response = self.client.put(f"/uploads/{upload_id}/chunks/1", data=chunks[1], headers=headers)
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.post(f"/uploads/{upload_id}/finalize", data={"upload_token": self.upload_token, "digest": "0" * 64})
+        self.assertEqual(400, response.json["code"])
+
+        response = self.client.post(f"/uploads/{upload_id}/finalize", data={"digest": digest}, headers=headers)
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.get(f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}/0.0.2")
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.get(response.json["data"]["version_data"]["download_url"])
+        self.assertEqual(tarball_contents, response.data)
+
+        # The session is deleted once finalized.
+        response = self.client.get(f"/uploads/{upload_id}", headers=headers)
+        self.assertEqual(404, response.status_code)
+
+    def test_package_validation_jobs(self):
+        """
+        Test case to verify that uploaded versions are validated by the job queue.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from validate_package import FakeRunner, process_next_job
+
+        self.upload_test_package()
+        status_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}/{TestPackages.test_package_data['package_version']}/status"
+
+        response = self.client.get(status_url)
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual("pending", response.json["status"])
+
+        self.assertTrue(process_next_job("test-worker", FakeRunner(passed=False)))
+        self.assertFalse(process_next_job("test-worker", FakeRunner()))
+
+        response = self.client.get(status_url)
+        self.assertEqual("failed", response.json["status"])
+        self.assertEqual(1, response.json["attempts"])
+        self.assertIsNotNone(response.json["log"])
+
+    def test_package_validation_cache(self):
+        """
+        Test case to verify that identical tarballs are built once per toolchain.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from mongo import db
+        from validate_package import FakeRunner, process_next_job, enqueue_validation
+
+        class CountingRunner(FakeRunner):
+            builds = 0
+
+            def run(self, tarball, package_name):
+                CountingRunner.builds += 1
+                return super().run(tarball, package_name)
+
+        self.upload_test_package()
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "package_version": "0.0.2",
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(200, response.json["code"])
+
+        # One build validates both versions sharing the tarball.
+        self.assertTrue(process_next_job("test-worker", CountingRunner()))
+        self.assertFalse(process_next_job("test-worker", CountingRunner()))
+        self.assertEqual(1, CountingRunner.builds)
+
+        package = db.packages.find_one()
+        self.assertEqual(["passed", "passed"], [version["status"] for version in package["versions"]])
+
+        # Validating the tarball again with the same toolchain is answered from the cache.
+        version = package["versions"][0]
+        enqueue_validation(package["_id"], package["name"], version["version"], version["digest"])
+        self.assertTrue(process_next_job("test-worker", CountingRunner()))
+        self.assertEqual(1, CountingRunner.builds)
+
+        # A new toolchain builds it again.
+        enqueue_validation(package["_id"], package["name"], version["version"], version["digest"])
+        runner = CountingRunner()
+        runner.toolchain = "fake-2"
+        self.assertTrue(process_next_job("test-worker", runner))
+        self.assertEqual(2, CountingRunner.builds)
+
+    @staticmethod
+    def generate_package_tarball(manifest):
+        """
+        Helper to create a gzip compressed package tarball with an fpm.toml manifest.
+
+        Parameters:
+        manifest (str): The content of the fpm.toml file.
+
+        Returns:
+        BytesIO: The tarball.
+        """
+        import tarfile
+
+        tarball = io.BytesIO()
+        with tarfile.open(fileobj=tarball, mode="w:gz") as archive:
+            for name, content in (("test_package/src/test.f90", b"module test\nend module test\n"), ("test_package/fpm.toml", manifest.encode())):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        tarball.seek(0)
+        tarball.name = "test.tar.gz"
+
+        return tarball
+
+    def test_upload_package_manifest(self):
+        """
+        Test case to verify that the metadata of a package is read from the fpm.toml file of its tarball.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        manifest = "\n".join([
+            'name = "test_package"',
+            'version = "0.0.1"',
+            'license = "MIT"',
+            'author = "Test Author"',
+            'description = "Linear algebra routines"',
+            'keywords = ["linear-algebra", "blas"]',
+            '[dependencies]',
+            'stdlib = "*"',
+            'toml-f = { git = "https://github.com/toml-f/toml-f", tag = "v0.4.0" }',
+            'M_strings = { namespace = "urbanjost", v = "^1.0" }',
+        ])
+        uuid = self.upload_test_package(tarball=TestPackages.generate_package_tarball(manifest))
+
+        response = self.client.get(f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}/{TestPackages.test_package_data['package_version']}")
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual("Linear algebra routines", response.json["data"]["description"])
+        self.assertEqual(["linear-algebra", "blas"], response.json["data"]["tags"])
+
+        dependencies = response.json["data"]["version_data"]["dependencies"]
+        self.assertEqual(["M_strings", "stdlib", "toml-f"], [dependency["name"] for dependency in dependencies])
+        self.assertEqual({"namespace": "urbanjost", "requirement": "^1.0"}, {key: dependencies[0][key] for key in ("namespace", "requirement")})
+        self.assertEqual("*", dependencies[1]["requirement"])
+        self.assertEqual(("https://github.com/toml-f/toml-f", "v0.4.0"), (dependencies[2]["git"], dependencies[2]["ref"]))
+        self.assertEqual(["Test Author"], response.json["data"]["version_data"]["authors"])
+        self.assertNotIn("package_metadata", response.json["data"]["version_data"])
+
+        # The metadata of the package is the one of its latest version, also once the latest is deleted.
+        package_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}"
+        response = self.client.post("/packages", data={
+            **TestPackages.test_package_data,
+            "package_version": "0.0.2",
+            "upload_token": self.upload_token,
+            "tarball": TestPackages.generate_package_tarball(
+                manifest.replace("Linear algebra routines", "Sparse solvers").replace('["linear-algebra", "blas"]', '["sparse"]')
+            ),
+        })
+        self.assertEqual(200, response.json["code"])
+        response = self.client.get(package_url)
+        self.assertEqual(("Sparse solvers", ["sparse"]), (response.json["data"]["description"], response.json["data"]["tags"]))
+
+        from mongo import db
+        admin = db.users.find_one_and_update({"username": TestPackages.test_user_data["username"]}, {"$addToSet": {"roles": "admin"}})
+        forget_session_users(admin["_id"])
+        response = self.client.post(f"{package_url}/0.0.2/delete", data={"uuid": uuid})
+        self.assertEqual(200, response.status_code)
+
+        response = self.client.get(package_url)
+        self.assertEqual("Linear algebra routines", response.json["data"]["description"])
+        self.assertEqual(["linear-algebra", "blas"], response.json["data"]["tags"])
+        self.assertIn("linear", db.packages.find_one()["search"]["description"])
+
+        response = self.client.get("/packages/suggest", query_string={"prefix": "sparse"})
+        self.assertEqual([], response.json["suggestions"])
+        response = self.client.get("/packages/suggest", query_string={"prefix": "blas"})
+        self.assertEqual([{"value": "blas", "type": "tag"}], response.json["suggestions"])
+
+    def test_resolve_dependencies(self):
+        """
+        Test case to verify the resolution of the transitive dependencies of a package version.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        namespace = TestPackages.test_namespace_data["namespace"]
+
+        def manifest(name, version, dependencies):
+            lines = [f'name = "{name}"', f'version = "{version}"', "[dependencies]"]
+            lines += [f'{dependency} = {{ namespace = "{namespace}", v = "{requirement}" }}' for dependency, requirement in dependencies.items()]
+            return "\n".join(lines)
+
+        def upload(name, version, dependencies):
+            response = self.client.post("/packages", data={
+                "package_name": name,
+                "package_version": version,
+                "package_license": "MIT",
+                "upload_token": self.upload_token,
+                "tarball": TestPackages.generate_package_tarball(manifest(name, version, dependencies)),
+            })
+            self.assertEqual(200, response.json["code"])
+
+        self.upload_test_package(tarball=TestPackages.generate_package_tarball(
+            manifest("test_package", "0.0.1", {"dep_a": ">=1.0.0", "dep_b": "^0.1", "dep_c": "*"})
+        ))
+        for version in ("1.0.0", "1.1.0", "2.0.0"):
+            upload("dep_a", version, {})
+        upload("dep_b", "0.1.0", {"dep_a": "^1.0"})
+
+        resolve_url = f"/packages/{namespace}/test_package/0.0.1/resolve"
+
+        # dep_a is constrained to 1.x by dep_b.
+        response = self.client.get(resolve_url)
+        self.assertEqual(200, response.json["code"])
+        resolved = {dependency["name"]: dependency["version"] for dependency in response.json["data"]["dependencies"]}
+        self.assertEqual({"dep_a": "1.1.0", "dep_b": "0.1.0"}, resolved)
+        self.assertEqual(["dep_c"], [dependency["name"] for dependency in response.json["data"]["unresolved"]])
+
+        # A matching version of a dependency invalidates the cached resolution.
+        upload("dep_a", "1.2.0", {})
+        response = self.client.get(resolve_url)
+        resolved = {dependency["name"]: dependency["version"] for dependency in response.json["data"]["dependencies"]}
+        self.assertEqual("1.2.0", resolved["dep_a"])
+
+        upload("dep_c", "0.1.0", {})
+        response = self.client.get(resolve_url)
+        self.assertEqual([], response.json["data"]["unresolved"])
+        self.assertEqual(3, len(response.json["data"]["dependencies"]))
+
+    def test_package_dependents(self):
+        """
+        Test case to verify the listing of the packages depending on a package.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from mongo import db
+
+        namespace = TestPackages.test_namespace_data["namespace"]
+        uuid = self.upload_test_package()
+
+        for name in ("dependent_a", "dependent_b", "dependent_c"):
+            for version in ("0.1.0", "0.2.0"):
+                manifest = f'name = "{name}"\nversion = "{version}"\n[dependencies]\ntest_package = {{ namespace = "{namespace}", v = "^0.0.1" }}\n'
+                response = self.client.post("/packages", data={
+                    "package_name": name,
+                    "package_version": version,
+                    "package_license": "MIT",
+                    "upload_token": self.upload_token,
+                    "tarball": TestPackages.generate_package_tarball(manifest),
+                })
+                self.assertEqual(200, response.json["code"])
+
+        dependents_url = f"/packages/{namespace}/{TestPackages.test_package_data['package_name']}/dependents"
+        response = self.client.get(dependents_url, query_string={"limit": 2})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(3, response.json["total"])
+        self.assertEqual(["dependent_a", "dependent_b"], [dependent["name"] for dependent in response.json["dependents"]])
+        self.assertEqual(["0.1.0", "0.2.0"], [version["version"] for version in response.json["dependents"][0]["versions"]])
+
+        response = self.client.get(dependents_url, query_string={"limit": "two"})
+        self.assertEqual(400, response.json["code"])
+
+        response = self.client.get(dependents_url, query_string={"limit": 2})
+        response = self.client.get(dependents_url, query_string={"limit": 2, "cursor": response.json["next_cursor"]})
+        self.assertEqual(["dependent_c"], [dependent["name"] for dependent in response.json["dependents"]])
+        self.assertIsNone(response.json["next_cursor"])
+
+        # Deleting the versions of a dependent removes it from the dependents.
+        admin = db.users.find_one_and_update({"username": TestPackages.test_user_data["username"]}, {"$addToSet": {"roles": "admin"}})
+        forget_session_users(admin["_id"])
+        for version in ("0.1.0", "0.2.0"):
+            response = self.client.post(f"/packages/{namespace}/dependent_c/{version}/delete", data={"uuid": uuid})
+            self.assertEqual(200, response.status_code)
+
+        response = self.client.get(dependents_url)
+        self.assertEqual(["dependent_a", "dependent_b"], [dependent["name"] for dependent in response.json["dependents"]])
+
+    def test_concurrent_version_upload(self):
+        """
+        Test case to verify that two uploads of the same version checked at the same time publish it once.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from mongo import db
+        from packages import check_upload, publish_package
+
+        self.upload_test_package()
+
+        # Both uploads pass the checks before either of them is published.
+        uploads = [
+            check_upload(self.upload_token, TestPackages.test_package_data["package_name"], "0.0.2", "MIT")[1]
+            for _ in range(2)
+        ]
+        tarball_contents = b"Concurrent test file contents"
+        digest = hashlib.sha256(tarball_contents).hexdigest()
+
+        with self.client.application.test_request_context():
+            responses = [publish_package(package_upload, io.BytesIO(tarball_contents), digest) for package_upload in uploads]
+
+        self.assertEqual(200, responses[0].json["code"])
+        self.assertEqual(400, responses[1][0].json["code"])
+
+        package = db.packages.find_one()
+        self.assertEqual(["0.0.1", "0.0.2"], [version["version"] for version in package["versions"]])
+        self.assertEqual(1, db.blobs.find_one({"_id": digest})["refcount"])
+
+        # The package is listed once by its namespace and author.
+        self.assertEqual([package["_id"]], db.namespaces.find_one()["packages"])
+        self.assertEqual([package["_id"]], db.users.find_one()["authorOf"])
+
+    def test_scoped_upload_token(self):
+        """
+        Test case to verify that upload tokens are stored hashed and only publish the packages
+        of their scopes until they expire.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from datetime import datetime, timedelta
+        from mongo import db
+        from upload_tokens import hash_token
+
+        uuid = self.upload_test_package()
+        namespace = TestPackages.test_namespace_data["namespace"]
+
+        # The token is only stored hashed, in its own collection.
+        self.assertNotIn("upload_tokens", db.namespaces.find_one())
+        self.assertIsNone(db.upload_tokens.find_one({"_id": self.upload_token}))
+        self.assertIsNotNone(db.upload_tokens.find_one({"_id": hash_token(self.upload_token)}))
+
+        response = self.client.post(f"/namespaces/{namespace}/uploadToken",
+            data={"uuid": uuid, "packages": "scoped_package", "expires_in_days": "30"})
+        self.assertEqual(200, response.json["code"])
+        scoped_token = response.json["uploadToken"]
+
+        upload_data = {"package_version": "0.1.0", "package_license": "MIT", "upload_token": scoped_token}
+
+        response = self.client.post("/packages", data={
+            **upload_data, "package_name": "other_package", "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(401, response.json["code"])
+
+        response = self.client.post("/packages", data={
+            **upload_data, "package_name": "scoped_package", "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(200, response.json["code"])
+
+        # An expired token is refused, even before the TTL index deletes it.
+        db.upload_tokens.update_one(
+            {"_id": hash_token(scoped_token)}, {"$set": {"expiresAt": datetime.utcnow() - timedelta(minutes=1)}}
+        )
+        response = self.client.post("/packages", data={
+            **upload_data, "package_name": "scoped_package", "package_version": "0.2.0",
+            "tarball": TestPackages.generate_tarball(),
+        })
+        self.assertEqual(401, response.json["code"])
+
+        response = self.client.post(f"/namespaces/{namespace}/uploadToken",
+            data={"uuid": uuid, "expires_in_days": "0"})
+        self.assertEqual(400, response.json["code"])
+
+    def test_version_ordering(self):
+        """
+        Test case to verify that versions are ordered by semver precedence, and that the latest
+        version is kept on the package.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        import semantic_version
+        from mongo import db
+        from versions import version_sort_key
+
+        versions = ["0.9.0", "0.10.0", "1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-alpha.beta",
+                    "1.0.0-beta.2", "1.0.0-beta.11", "1.0.0-rc.1", "1.0.0", "1.0.0+build.5", "10.0.0"]
+        self.assertEqual(
+            sorted(versions, key=semantic_version.Version),
+            sorted(versions, key=version_sort_key),
+        )
+
+        uuid = self.upload_test_package(package_version="0.10.0")
+        for version in ("0.9.0", "1.0.0-rc.1", "0.10.1"):
+            response = self.client.post("/packages", data={
+                "package_name": TestPackages.test_package_data["package_name"],
+                "package_version": version,
+                "package_license": "MIT",
+                "upload_token": self.upload_token,
+                "tarball": TestPackages.generate_tarball(),
+            })
+            self.assertEqual(200, response.json["code"])
+
+        package_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}"
+        response = self.client.get(package_url)
+        self.assertEqual(["0.9.0", "0.10.0", "0.10.1", "1.0.0-rc.1"],
+                         [version["version"] for version in response.json["data"]["version_history"]])
+        self.assertEqual("1.0.0-rc.1", response.json["data"]["latest_version_data"]["version"])
+        self.assertEqual("1.0.0-rc.1", db.packages.find_one()["latest_version"])
+
+        # Deleting the latest version makes the previous one the latest.
+        admin = db.users.find_one_and_update({"username": TestPackages.test_user_data["username"]}, {"$addToSet": {"roles": "admin"}})
+        forget_session_users(admin["_id"])
+        response = self.client.post(f"{package_url}/1.0.0-rc.1/delete", data={"uuid": uuid})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("0.10.1", db.packages.find_one()["latest_version"])
+
+    def test_match_version(self):
+        """
+        Test case to verify that the highest version which is not deprecated and satisfies a
+        requirement is returned.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+        from mongo import db
+
+        self.upload_test_package(package_version="1.0.0")
+        for version in ("1.2.0", "1.10.0", "2.0.0-rc.1", "2.0.0", "2.1.0"):
+            response = self.client.post("/packages", data={
+                "package_name": TestPackages.test_package_data["package_name"],
+                "package_version": version,
+                "package_license": "MIT",
+                "upload_token": self.upload_token,
+                "tarball": TestPackages.generate_tarball(),
+            })
+            self.assertEqual(200, response.json["code"])
+
+        db.packages.update_one(
+            {"versions.version": "2.1.0"}, {"$set": {"versions.$.isDeprecated": True}}
+        )
+
+        match_url = f"/packages/{TestPackages.test_namespace_data['namespace']}/{TestPackages.test_package_data['package_name']}/match"
+        for requirement, version in (
+            ("^1.2", "1.10.0"),
+            ("~1.2.0", "1.2.0"),
+            ("<1.10.0", "1.2.0"),
+            ("*", "2.0.0"),
+        ):
+            response = self.client.get(match_url, query_string={"req": requirement})
+            self.assertEqual(200, response.json["code"])
+            self.assertEqual(version, response.json["data"]["version_data"]["version"])
+
+        response = self.client.get(match_url, query_string={"req": "^3"})
+        self.assertEqual(404, response.json["code"])
+
+        response = self.client.get(match_url, query_string={"req": "not a requirement"})
+        self.assertEqual(400, response.json["code"])
+
+    def test_resolution_cache_bounded(self):
+        """
+        Test case to verify that the requirements of evicted and expired resolutions are dropped.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the requirements kept by the cache are not as expected.
+        """
+        from resolve import ResolutionCache, parse_requirement
+
+        cache = ResolutionCache(maxsize=1, ttl=0)
+        constraints = {("test_namespace", "stdlib"): {"^0.2": parse_requirement("^0.2")}}
+
+        cache.set(("test_namespace", "a", "0.1.0"), {}, constraints)
+        cache.set(("test_namespace", "b", "0.1.0"), {}, constraints)
+        self.assertEqual(
+            [("test_namespace", "b", "0.1.0")], list(cache._dependents[("test_namespace", "stdlib")])
+        )
+
+        # With no time to live, the resolution is expired when it is read.
+        self.assertIsNone(cache.get(("test_namespace", "b", "0.1.0")))
+        self.assertEqual({}, cache._dependents)
+
+    def test_query_plan_queries(self):
+        """
+        Test case to verify which queries of a command have their plan checked for collection scans.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the queries found in a command are not as expected.
+        """
+        from query_plans import command_queries
+        from packages import SEARCH_RESULT_STAGES
+
+        # Every statement of a write batch is a query of its own.
+        command = {"update": "packages", "updates": [{"q": {"name": "a"}}, {"q": {"author": "b"}}]}
+        self.assertEqual(
+            [{"name": "a"}, {"author": "b"}],
+            [query_filter for _, query_filter, _ in command_queries("update", command)],
+        )
+
+        # The collections read by the lookups of an aggregation are checked, nested in a
+        # $facet too, but not the $match stages filtering the documents already read.
+        pipeline = [
+            {"$match": {"$text": {"$search": "test"}}},
+            {"$match": {"downloads": {"$gt": 0}}},
+            {"$facet": {"packages": SEARCH_RESULT_STAGES}},
+            {"$unionWith": {"coll": "namespaces", "pipeline": [{"$match": {"namespace": "a"}}]}},
+            {"$lookup": {"from": "users", "let": {"author": "$author"}, "pipeline": [], "as": "author"}},
+        ]
+        queries = command_queries("aggregate", {"aggregate": "packages", "pipeline": pipeline})
+        self.assertEqual(
+            [
+                ("packages", {"$text": {"$search": "test"}}),
+                ("namespaces", {"_id": None}),
+                ("users", {"_id": None}),
+                ("namespaces", {"namespace": "a"}),
+            ],
+            [(collection, query_filter) for collection, query_filter, _ in queries],
+        )